@@ -53,8 +53,11 @@ from Products.CPSCore.interfaces import IEventSubscriber
 from Products.CMFCore.utils import UniqueObject, SimpleItemWithProperties
 from Products.CMFCore.utils import getToolByName
 from Products.CMFCore.permissions import ViewManagementScreens
+from Products.CMFCore.permissions import ManagePortal
 
 from Products.CPSCore.events import securityModificationEvent
+from Products.CPSCore.commitprofiler import get_commit_profiler
+from Products.CPSCore.bulkoperation import get_bulk_operation
 
 logger = logging.getLogger('CPSCore.EventServiceTool')
 CPSSubscriberDefinition_type = 'CPS Subscriber Definition'
@@ -265,7 +268,14 @@ class EventServiceTool(UniqueObject, OrderedFolder):
 
         This features backward compatibility method for notifications and
         redispatches as events the Zope3 way.
+
+        During a bulk operation, modification events are coalesced and
+        dispatched at its end (see bulkoperation).
         """
+        bulk = get_bulk_operation()
+        if bulk is not None and bulk.recordEvent(self, event_type, ob, infos):
+            return
+
         # Older CPS event tool subscribers notification
         self.notifyCompat(event_type, ob, infos)
 
@@ -392,7 +402,12 @@ class EventServiceTool(UniqueObject, OrderedFolder):
             'label': 'Subscribers',
             'action': 'manage_editSubscribersForm',
         },
-        ) + OrderedFolder.manage_options[1:]
+        ) + OrderedFolder.manage_options[1:] + (
+        {
+            'label': 'Commit Profile',
+            'action': 'manage_commitProfile',
+        },
+        )
 
 
     security.declareProtected(ViewManagementScreens, 'manage_editSubscribersForm')
@@ -401,6 +416,52 @@ class EventServiceTool(UniqueObject, OrderedFolder):
     manage_editSubscribersForm._setName('manage_main')
     manage_main = manage_editSubscribersForm
 
+    security.declareProtected(ViewManagementScreens, 'manage_commitProfile')
+    manage_commitProfile = DTMLFile('zmi/commitProfile', globals())
+
+    security.declareProtected(ViewManagementScreens, 'getCommitProfile')
+    def getCommitProfile(self):
+        """Return the statistics of the commit subscribers profiler.
+
+        These are about the whole Zope process, see commitprofiler.
+        """
+        return get_commit_profiler().getStatistics()
+
+    security.declareProtected(ViewManagementScreens,
+                              'getCommitProfilerSettings')
+    def getCommitProfilerSettings(self):
+        """Return the settings of the commit subscribers profiler, as a
+        mapping.
+        """
+        profiler = get_commit_profiler()
+        return {
+            'enabled': profiler.enabled,
+            'slow_threshold': profiler.slow_threshold,
+            'slow_commits': profiler.slow_commits,
+            }
+
+    security.declareProtected(ManagePortal, 'manage_editCommitProfiler')
+    def manage_editCommitProfiler(self, enabled=False, slow_threshold='',
+                                  reset=False, REQUEST=None):
+        """Change the settings of the commit subscribers profiler.
+
+        Settings are not persistent: they last until Zope restarts.
+        """
+        profiler = get_commit_profiler()
+        if enabled:
+            profiler.enable()
+        else:
+            profiler.disable()
+        if slow_threshold in ('', None):
+            profiler.setSlowThreshold(None)
+        else:
+            profiler.setSlowThreshold(float(slow_threshold))
+        if reset:
+            profiler.reset()
+        if REQUEST is not None:
+            REQUEST.RESPONSE.redirect(
+                '%s/manage_commitProfile' % (self.absolute_url(),))
+
     security.declareProtected(ViewManagementScreens, 'getSubscribers')
     def getSubscribers(self):
         """Return subscriber definitions."""
@@ -27,6 +27,7 @@ Asynchronous by default.
 import logging
 import transaction
 import zope.interface
+from time import time
 
 from Acquisition import aq_base
 
@@ -35,8 +36,13 @@ from Products.CMFCore.utils import getToolByName
 from Products.CPSCore.interfaces import IBeforeCommitSubscriber
 from Products.CPSCore.commithooks import BeforeCommitSubscriber
 from Products.CPSCore.commithooks import get_before_commit_subscribers_manager
+from Products.CPSCore.commithooks import get_after_commit_subscribers_manager
+# Counters of the indexation done during a transaction
+from Products.CPSCore.indexationstats import COUNTERS, TIMERS
+from Products.CPSCore.indexationstats import get_indexation_statistics
 
 _TXN_MGR_ATTRIBUTE = '_cps_idx_manager'
+_TXN_COUNTERS_ATTRIBUTE = '_cps_idx_counters'
 
 ACTION_INDEX = 'index'
 ACTION_REINDEX = 'reindex'
@@ -46,6 +52,11 @@ ACTION_UNINDEX = 'un_index'
 # will have an order of -100
 _TXN_MGR_ORDER = -100
 
+# Indexes that have to be up to date at commit time, for the security
+# and the structure of the site: these are never deferred.
+NEVER_DEFERRED_INDEXES = ('allowedRolesAndUsers', 'localUsersWithRoles',
+                          'path')
+
 logger = logging.getLogger("CPSCore.IndexationManager")
 
 class IndexationManager(BeforeCommitSubscriber):
@@ -53,11 +64,43 @@ class IndexationManager(BeforeCommitSubscriber):
 
     zope.interface.implements(IBeforeCommitSubscriber)
 
+    # Queues at least that long are processed in batches (see
+    # processBatch). None disables batch processing.
+    # XXX This may be monkey-patched by unit-tests.
+    BATCH_THRESHOLD = 100
+
+    # Once that many objects are queued, objects to (re)index are queued
+    # by path only, and traversed again at commit time, so that very big
+    # transactions don't keep all of them in memory. None disables it.
+    SPILL_THRESHOLD = None
+
+    # In deferred mode, indexations are not done at commit time but
+    # stored in the persistent queue of the catalog (see indexationqueue)
+    # XXX This may be monkey-patched by unit-tests or at startup.
+    DEFAULT_DEFERRED = False
+
+    # Indexes (typically expensive text indexes such as SearchableText)
+    # that are not updated at commit time but stored in the persistent
+    # queue of the catalog, the other indexes and the metadata being
+    # updated right away. Needs batch processing.
+    # XXX This may be monkey-patched by unit-tests or at startup.
+    DEFAULT_DEFERRED_INDEXES = ()
+
     def __init__(self, mgr):
         """Initialize and register this manager with the transaction."""
         BeforeCommitSubscriber.__init__(self, mgr, order=_TXN_MGR_ORDER)
+        self._deferred = self.DEFAULT_DEFERRED
+        self.setDeferredIndexes(self.DEFAULT_DEFERRED_INDEXES)
+        # List of (key, info). An entry is current only if info is still
+        # the one in _infos for this key: moving an object to the end of
+        # the queue or cancelling it is done in constant time by
+        # appending or removing in _infos, outdated entries are skipped.
         self._queue = []
         self._infos = {}
+        # Root used to traverse spilled objects
+        self._root = None
+        # In bulk mode, all objects to (re)index are spilled
+        self._bulk = False
 
     def push(self, ob, idxs=None, with_security=False, action=ACTION_INDEX):
         """Add / update an object to reindex or unindex to the reindexing queue.
@@ -73,6 +116,8 @@ class IndexationManager(BeforeCommitSubscriber):
             logger.debug("is DISABLED. object %r won't be processed", ob)
             return
 
+        get_indexation_counters()['pushes'] += 1
+
         if self.isSynchronous():
             logger.debug("Doing %s on object %r", action, ob)
             self.process(action, ob, idxs=idxs, secu=with_security)
@@ -96,19 +141,20 @@ class IndexationManager(BeforeCommitSubscriber):
         if info is None:
             info = {
                 'action': action,
-                'object': ob,
+                'object': self._spill(ob),
                 'idxs': idxs,
                 'secu': with_security,
                 }
-            self._queue.append(i)
+            self._queue.append((i, info))
             self._infos[i] = info
         elif info['action'] == ACTION_UNINDEX:
             # me must consider this as a full indexing
-            self._infos[i] = dict(action=ACTION_REINDEX, object=ob, idxs=[],
-                                  secu=with_security)
-            self._queue.remove(i)
-            self._queue.append(i)
+            info = dict(action=ACTION_REINDEX, object=self._spill(ob),
+                        idxs=[], secu=with_security)
+            self._infos[i] = info
+            self._queue.append((i, info))
         else:
+            get_indexation_counters()['idxs_merges'] += 1
             # Update idxs
             if idxs is not None:
                 if idxs == []:
@@ -132,18 +178,125 @@ class IndexationManager(BeforeCommitSubscriber):
     def pushUnIndex(self, i, ob):
         """Schedule for unindexing or cancels scheduled indexing."""
 
+        # The object itself is always kept: it can't be traversed
+        # anymore once deleted.
         info = self._infos.get(i)
         if info is None: # first call about ob in this txn
-            self._infos[i] = dict(action=ACTION_UNINDEX, object=ob)
-            self._queue.append(i)
+            info = self._infos[i] = dict(action=ACTION_UNINDEX, object=ob)
+            self._queue.append((i, info))
         elif info['action'] == ACTION_INDEX:
             # creation and destruction in the same txn, just unschedule
             del self._infos[i]
+            get_indexation_counters()['cancellations'] += 1
         elif info['action'] == ACTION_REINDEX:
             # still needs to be removed
-            info['action'] = ACTION_UNINDEX
-            self._queue.remove(i)
-            self._queue.append(i)
+            info = self._infos[i] = dict(action=ACTION_UNINDEX, object=ob)
+            self._queue.append((i, info))
+            get_indexation_counters()['cancellations'] += 1
+
+    def _spill(self, ob):
+        """Return what to keep of an object to (re)index.
+
+        None if it has to be traversed again at commit time.
+        """
+        threshold = self.SPILL_THRESHOLD
+        if not self._bulk and (threshold is None or
+                               len(self._infos) < threshold):
+            return ob
+        root = ob.getPhysicalRoot()
+        if self._root is None:
+            self._root = root
+        elif aq_base(root) is not aq_base(self._root):
+            return ob
+        return None
+
+    def _getObject(self, i, info):
+        """Return the object queued in info, None if it disappeared."""
+        ob = info['object']
+        if ob is None:
+            path = ('',) + tuple(i[1].split('/'))
+            ob = self._root.unrestrictedTraverse(path, None)
+            if ob is None:
+                logger.debug("Object %s disappeared" % i[1])
+        return ob
+
+    def queueSize(self):
+        """Number of objects waiting to be processed."""
+        return len(self._infos)
+
+    def setDeferred(self, deferred):
+        self._deferred = deferred
+
+    def isDeferred(self):
+        return self._deferred
+
+    def startBulk(self):
+        """Start a bulk operation (see bulkoperation).
+
+        Objects to (re)index are queued by path only.
+        """
+        self._bulk = True
+
+    def endBulk(self):
+        self._bulk = False
+
+    def isBulk(self):
+        return self._bulk
+
+    def _getSavepointState(self):
+        queue = [(i, _copyInfo(info)) for i, info in self._queue
+                 if self._infos.get(i) is info]
+        return queue, self._root
+
+    def _restoreSavepointState(self, state):
+        queue, root = state
+        self._queue = [(i, _copyInfo(info)) for i, info in queue]
+        self._infos = dict(self._queue)
+        self._root = root
+
+    def detachQueue(self):
+        """Remove the queue from the manager and return it.
+
+        Returns a list of (key, info) and the root used to traverse
+        spilled objects. Used to process the queue in other transactions
+        (see attachQueue).
+        """
+        queue = [(i, info) for i, info in self._queue
+                 if self._infos.get(i) is info]
+        root = self._root
+        self._queue = []
+        self._infos = {}
+        return queue, root
+
+    def attachQueue(self, queue, root=None):
+        """Queue entries returned by detachQueue.
+
+        Entries already queued for the same object are newer: they are
+        kept, merged with the attached ones unless there's unindexing.
+        """
+        for i, info in queue:
+            current = self._infos.get(i)
+            if current is None:
+                self._infos[i] = info
+                self._queue.append((i, info))
+            elif (current['action'] != ACTION_UNINDEX and
+                  info['action'] != ACTION_UNINDEX):
+                self.pushIndex(info['action'], i, info['object'],
+                               idxs=info['idxs'],
+                               with_security=info['secu'])
+        if root is not None:
+            self._root = root
+
+    def setDeferredIndexes(self, idxs):
+        """Set the indexes whose update is deferred.
+
+        Indexes from NEVER_DEFERRED_INDEXES are ignored.
+        """
+        self._deferred_idxs = tuple([idx for idx in idxs
+                                     if idx not in NEVER_DEFERRED_INDEXES])
+
+    def getDeferredIndexes(self):
+        return self._deferred_idxs
 
     def __call__(self):
         """Called when transaction commits.
@@ -160,19 +313,207 @@ class IndexationManager(BeforeCommitSubscriber):
 
         logger.debug("__call__")
 
-        for i in self._queue:
-            info = self._infos.pop(i, None)
-            if info is None:
-                # cancelled by later unindexing
+        counters = get_indexation_counters()
+        start = time()
+        coalesced = self._coalesceSecurity()
+        middle = time()
+        counters['time_coalesce'] += middle - start
+
+        secu_time = counters['time_security']
+        self._processQueue()
+        self._notifySecurity(coalesced)
+        # Security reindexings are timed separately
+        counters['time_index'] += (time() - middle -
+                                   (counters['time_security'] - secu_time))
+
+        logger.debug("__call__ done, counters: %r", counters)
+
+    def _processQueue(self):
+        if self.isDeferred():
+            self.processDeferred()
+            return
+
+        threshold = self.BATCH_THRESHOLD
+        if ((threshold is not None and len(self._infos) >= threshold)
+            or self._deferred_idxs):
+            self.processBatch()
+            return
+
+        for i, info in self._queue:
+            if self._infos.get(i) is not info:
+                # cancelled by later unindexing, or moved further
                 continue
+            del self._infos[i]
 
+            if info['action'] != ACTION_UNINDEX and _isNoop(info):
+                continue
             logger.debug("__call__ processing %r" % info)
-            self.process(info.pop('action'), info.pop('object'), path=i[1],
-                         **info)
+            ob = self._getObject(i, info)
+            if ob is None:
+                continue
+            del info['object']
+            self.process(info.pop('action'), ob, path=i[1], **info)
 
         self._queue = [] # for what it matters
 
-        logger.debug("__call__ done")
+    def _coalesceSecurity(self):
+        """Cancel security reindexings done by an ancestor's one.
+
+        Reindexing the security of an object recurses in its subtree in
+        the catalog, so only the top-most of the queued security
+        reindexings are needed. Returns the (key, object) of the
+        cancelled ones, whose objects still have to be notified (see
+        _notifySecurity).
+        """
+        secu = [] # (key, info)
+        rpaths = {}
+        for i, info in self._queue:
+            if info.get('secu') and self._infos.get(i) is info:
+                secu.append((i, info))
+                rpaths[i[1]] = None
+        coalesced = []
+        if len(secu) < 2:
+            return coalesced
+        for i, info in secu:
+            rpath = i[1]
+            path = rpath.split('/')
+            for k in range(1, len(path)):
+                if '/'.join(path[:k]) in rpaths:
+                    logger.debug("security of %s done with its ancestor's",
+                                 rpath)
+                    info['secu'] = False
+                    coalesced.append((i, info['object']))
+                    break
+        return coalesced
+
+    def _notifySecurity(self, coalesced):
+        """Notify objects whose security reindexing was cancelled.
+
+        Only the catalog work is done by the ancestor's reindexing:
+        objects having a _notifySecurityModified method (proxies) still
+        send the events their own security reindexing sends, on which
+        other listeners such as the tree caches rely.
+        """
+        for i, ob in coalesced:
+            ob = self._getObject(i, {'object': ob})
+            if ob is None:
+                continue
+            if getattr(aq_base(ob), '_notifySecurityModified',
+                       None) is not None:
+                ob._notifySecurityModified()
+
+    def processBatch(self):
+        """Process the whole queue in batches.
+
+        Unindexings are done first. Objects to reindex are then
+        re-traversed in one pass sorted by path, so that each container
+        is traversed only once, and handed to their catalog in one call,
+        grouped by set of indexes. Security reindexings are done last.
+        Updates of deferred indexes are stored in the persistent queue of
+        the catalog.
+
+        Indexings triggered while processing are done in a further batch.
+        """
+        while self._queue:
+            queue = self._queue
+            self._queue = []
+            unindex = []
+            index = []
+            for i, info in queue:
+                if self._infos.get(i) is not info:
+                    # cancelled by later unindexing, or moved further
+                    continue
+                del self._infos[i]
+                ob = info['object']
+                if info['action'] == ACTION_UNINDEX:
+                    unindex.append((i[1], ob))
+                elif _isNoop(info):
+                    continue
+                else:
+                    if ob is None:
+                        path = ('',) + tuple(i[1].split('/'))
+                    else:
+                        path = ob.getPhysicalPath()
+                    index.append((path, len(index), info))
+            logger.debug("processBatch: %s unindexings, %s indexings",
+                         len(unindex), len(index))
+
+            for path, ob in unindex:
+                self.processUnIndex(ob, path=path)
+            index.sort()
+            self.processIndexBatch(index)
+
+    def processDeferred(self):
+        """Store the queue in the deferred queues of the catalogs.
+
+        Objects that have no catalog able to process a deferred queue
+        are processed right away, as well as security reindexings, which
+        have to be up to date at commit time (see NEVER_DEFERRED_INDEXES).
+        """
+        from Products.CPSCore.indexationqueue import get_indexation_queue
+        queues = {} # container path -> deferred queue
+        index = [] # (path, position, info) of the security reindexings
+        for i, info in self._queue:
+            if self._infos.get(i) is not info:
+                # cancelled by later unindexing, or moved further
+                continue
+            del self._infos[i]
+            if info['action'] != ACTION_UNINDEX and _isNoop(info):
+                continue
+            rpath = i[1]
+            container_path = ('',) + tuple(rpath.split('/')[:-1])
+            if container_path in queues:
+                queue = queues[container_path]
+            else:
+                context = info['object']
+                if context is None:
+                    context = self._root.unrestrictedTraverse(
+                        container_path, None)
+                catalog = getToolByName(context, 'portal_catalog', None)
+                if getattr(aq_base(catalog), 'unindexCPSPath', None) is None:
+                    queue = None
+                else:
+                    queue = get_indexation_queue(catalog)
+                queues[container_path] = queue
+
+            if queue is None:
+                ob = self._getObject(i, info)
+                if ob is not None:
+                    self.process(info['action'], ob, idxs=info.get('idxs'),
+                                 secu=info.get('secu'), path=rpath)
+                continue
+            if info['action'] != ACTION_UNINDEX and info.get('secu'):
+                ob = info['object']
+                if ob is None:
+                    path = ('',) + tuple(rpath.split('/'))
+                else:
+                    path = ob.getPhysicalPath()
+                index.append((path, len(index), info))
+                continue
+            idxs = info.get('idxs')
+            if info['action'] != ACTION_UNINDEX and idxs is not None:
+                # The work on the object is done now, in the transaction
+                # that modified it, only the catalog is updated later
+                ob = self._getObject(i, info)
+                if ob is None:
+                    continue
+                idxs = prepare_reindex(ob, idxs)
+            logger.debug("processDeferred: queue %s %r" % (rpath, info))
+            queue.push(rpath, info['action'], idxs=idxs,
+                       secu=info.get('secu', False))
+            get_indexation_counters()['processed'] += 1
+
+        self._queue = []
+        if index:
+            logger.debug("processDeferred: %s security reindexings",
+                         len(index))
+            index.sort()
+            self.processIndexBatch(index)
+
+    def processIndexBatch(self, items):
+        """Reindex a sequence of (path, position, info), sorted by path.
+        """
+        process_index_batch(items, self._root, self._deferred_idxs)
 
     def processIndex(self, ob, idxs, secu):
         """Process an object, to reindex it."""
@@ -188,6 +529,7 @@ class IndexationManager(BeforeCommitSubscriber):
         if ob is None:
             logger.debug("Object %r disappeared" % old_ob)
             return
+        get_indexation_counters()['processed'] += 1
         if idxs is not None:
             logger.debug("reindexObject %r idxs=%r" % (ob, idxs))
             ob._reindexObject(idxs=idxs)
@@ -195,7 +537,7 @@ class IndexationManager(BeforeCommitSubscriber):
             skip_self = (idxs == [] or
                          (idxs and 'allowedRolesAndUsers' in idxs))
             logger.debug("reindexObjectSecurity %r skip=%s" % (ob, skip_self))
-            ob._reindexObjectSecurity(skip_self=skip_self)
+            reindex_object_security(ob, skip_self)
 
     def processUnIndex(self, ob, path):
         """unindexes the object.
@@ -204,6 +546,7 @@ class IndexationManager(BeforeCommitSubscriber):
         We use the path passed at push time, because it's more reliable
         than the one read from ob (see #2004(
         """
+        get_indexation_counters()['processed'] += 1
         cat = getToolByName(ob, 'portal_catalog')
         if path is None:
             cat.unindexObject(ob)
@@ -218,6 +561,144 @@ class IndexationManager(BeforeCommitSubscriber):
             self.processIndex(ob, idxs, secu)
 
 
+def split_deferred_idxs(idxs, deferred_idxs, all_idxs):
+    """Split idxs in the indexes to update now and the deferred ones.
+
+    idxs being [] means all the indexes, that is all_idxs. It is kept as
+    is if none of them is deferred.
+    """
+    if idxs == []:
+        later = [idx for idx in all_idxs if idx in deferred_idxs]
+        if not later:
+            return idxs, later
+        idxs = all_idxs
+    else:
+        later = [idx for idx in idxs if idx in deferred_idxs]
+    now = [idx for idx in idxs if idx not in deferred_idxs]
+    return now, later
+
+def _copyInfo(info):
+    """Copy a queue entry, which is modified when processed."""
+    info = info.copy()
+    if info.get('idxs') is not None:
+        info['idxs'] = list(info['idxs'])
+    return info
+
+def _isNoop(info):
+    """Tell if nothing is left to do for a queued indexation."""
+    return info['idxs'] is None and not info['secu']
+
+def prepare_reindex(ob, idxs):
+    """Do the work on an object to reindex before it is cataloged.
+
+    As its _reindexObject does: CPS proxies are updated from their
+    revision, and a full reindexing updates the modification date.
+    Returns the indexes to update.
+    """
+    if getattr(aq_base(ob), '_prepareReindexObject', None) is not None:
+        idxs = ob._prepareReindexObject(idxs=idxs)
+    if idxs == []:
+        # As CMFCatalogAware.reindexObject does
+        if getattr(aq_base(ob), 'notifyModified', None) is not None:
+            ob.notifyModified()
+    return idxs
+
+def process_index_batch(items, root=None, deferred_idxs=(), prepared=False):
+    """Reindex a sequence of (path, position, info), sorted by path.
+
+    info is a mapping with object, idxs and secu keys. If object is None,
+    it is traversed from root.
+
+    Updates of the deferred_idxs indexes are stored in the deferred
+    indexation queue of the catalog instead of being done.
+
+    If prepared is true, the objects have already been prepared (see
+    prepare_reindex), and only the catalog is updated.
+    """
+    from Products.CPSCore.indexationqueue import get_indexation_queue
+    containers = {} # container path -> (container, catalog)
+    batches = {} # catalog id -> (catalog, [(ob, uid, idxs)])
+    deferred = {} # catalog id -> (indexes, deferred indexation queue)
+    secu = []
+    counters = get_indexation_counters()
+    for path, pos, info in items:
+        ob = info['object']
+        container_path = path[:-1]
+        cached = containers.get(container_path)
+        if cached is None:
+            if ob is None:
+                start = root
+            else:
+                start = ob.getPhysicalRoot()
+            container = start.unrestrictedTraverse(container_path, None)
+            catalog = None
+            if container is not None:
+                catalog = getToolByName(container, 'portal_catalog', None)
+            if getattr(aq_base(catalog), 'catalogCPSObjects',
+                       None) is None:
+                # Not a CPS catalog, objects will reindex themselves
+                catalog = None
+            cached = containers[container_path] = (container, catalog)
+        container, catalog = cached
+        ob = None
+        if container is not None:
+            ob = container.unrestrictedTraverse(path[-1], None)
+        if ob is None:
+            logger.debug("Object %s disappeared" % '/'.join(path))
+            continue
+        counters['processed'] += 1
+
+        idxs = info['idxs']
+        if idxs is not None:
+            if catalog is None or (not prepared and getattr(aq_base(ob),
+                    '_prepareReindexObject', None) is None):
+                logger.debug("reindexObject %r idxs=%r" % (ob, idxs))
+                ob._reindexObject(idxs=idxs)
+            else:
+                if not prepared:
+                    idxs = prepare_reindex(ob, idxs)
+                key = id(aq_base(catalog))
+                uid = '/'.join(path)
+                now, later = idxs, []
+                if deferred_idxs:
+                    if key not in deferred:
+                        deferred[key] = (list(catalog.indexes()),
+                                         get_indexation_queue(catalog))
+                    all_idxs, queue = deferred[key]
+                    now, later = split_deferred_idxs(idxs, deferred_idxs,
+                                                     all_idxs)
+                    if later:
+                        logger.debug("deferring %r idxs=%r" % (ob, later))
+                        queue.push(uid[1:], ACTION_REINDEX, later)
+                if later and not now:
+                    # All deferred, the metadata is still updated now
+                    now = ()
+                if key not in batches:
+                    batches[key] = (catalog, [])
+                batches[key][1].append((ob, uid, now))
+        if info['secu']:
+            secu.append((ob, idxs))
+
+    for catalog, batch in batches.values():
+        # Group by set of indexes
+        batch.sort(key=lambda item: tuple(item[2]))
+        logger.debug("catalogCPSObjects: %s objects", len(batch))
+        catalog.catalogCPSObjects(batch)
+
+    for ob, idxs in secu:
+        skip_self = (idxs == [] or
+                     (idxs and 'allowedRolesAndUsers' in idxs))
+        logger.debug("reindexObjectSecurity %r skip=%s" % (ob, skip_self))
+        reindex_object_security(ob, skip_self)
+
+def reindex_object_security(ob, skip_self):
+    """Reindex the security of an object, counting and timing it."""
+    counters = get_indexation_counters()
+    start = time()
+    ob._reindexObjectSecurity(skip_self=skip_self)
+    counters['time_security'] += time() - start
+    counters['secu_reindexes'] += 1
+
 def del_indexation_manager():
     txn = transaction.get()
     setattr(txn, _TXN_MGR_ATTRIBUTE, None)
@@ -233,3 +714,29 @@ def get_indexation_manager():
         mgr = IndexationManager(get_before_commit_subscribers_manager())
         setattr(txn, _TXN_MGR_ATTRIBUTE, mgr)
     return mgr
+
+def get_indexation_counters():
+    """Get the indexation counters of the current transaction.
+
+    This is a mapping of the COUNTERS names to the number of pushes,
+    objects processed, merges, cancellations, security reindexings, and
+    indexes and metadata records written or skipped because they didn't
+    change, and of the TIMERS names to the time spent in each phase (see
+    indexationstats).
+
+    They are recorded in the indexation statistics after commit.
+    """
+    txn = transaction.get()
+    counters = getattr(txn, _TXN_COUNTERS_ATTRIBUTE, None)
+    if counters is None:
+        counters = dict([(name, 0) for name in COUNTERS])
+        for name in TIMERS:
+            counters[name] = 0.0
+        setattr(txn, _TXN_COUNTERS_ATTRIBUTE, counters)
+        get_after_commit_subscribers_manager().addSubscriber(
+            _recordCounters, args=(counters,))
+    return counters
+
+def _recordCounters(status, counters):
+    if status:
+        get_indexation_statistics().record(counters)
@@ -417,10 +417,13 @@ class ProxyBase(Base):
     # Security
     #
 
-    def _reindexObject(self, idxs=[]):
-        """Called to reindex when the object has changed."""
-        logger.debug("reindex idxs=%s for %s", idxs,
-                     '/'.join(self.getPhysicalPath()))
+    def _prepareReindexObject(self, idxs=[]):
+        """Prepare the object to be reindexed.
+
+        Returns the indexes to reindex. This is used as well by the
+        batched processing of the indexation manager, which does the
+        cataloging itself.
+        """
         # Update the effective date
         # Optim: we only modify the effective_date if this is a global
         # reindexing, ie after the object has been modified,
@@ -432,7 +435,14 @@ class ProxyBase(Base):
                 self.effective_date = effective_date
         if 'allowedRolesAndUsers' in idxs:
             # Both must be updated
-            idxs.append('localUsersWithRoles')
+            idxs = list(idxs) + ['localUsersWithRoles']
+        return idxs
+
+    def _reindexObject(self, idxs=[]):
+        """Called to reindex when the object has changed."""
+        logger.debug("reindex idxs=%s for %s", idxs,
+                     '/'.join(self.getPhysicalPath()))
+        idxs = self._prepareReindexObject(idxs=idxs)
         return CMFCatalogAware.reindexObject(self, idxs=idxs)
 
     # overloaded
@@ -456,12 +466,19 @@ class ProxyBase(Base):
         """Called to security-related indexes."""
         logger.debug("reindex security for %s",
                      '/'.join(self.getPhysicalPath()))
-        # Notify that this proxy's security has changed.
+        self._notifySecurityModified()
+        return CMFCatalogAware.reindexObjectSecurity(self, skip_self)
+
+    def _notifySecurityModified(self):
+        """Notify that this proxy's security has changed.
+
+        Also called by the indexation manager when the reindexing is done
+        by an ancestor's one.
+        """
         # Listeners will have to recurse if necessary.
         # (The notification for the object repo is done by the repo.)
         evtool = getEventService(self)
         evtool.notify('sys_modify_security', self, {})
-        return CMFCatalogAware.reindexObjectSecurity(self, skip_self)
 
     # overloaded
     def reindexObjectSecurity(self):
@@ -23,8 +23,10 @@ Asynchronous by default.
 """
 
 import logging
+from copy import deepcopy
 import transaction
 import zope.interface
+from Acquisition import aq_base
 
 from Products.CPSCore.interfaces import IBeforeCommitSubscriber
 from Products.CPSCore.commithooks import BeforeCommitSubscriber
@@ -32,6 +34,7 @@ from Products.CPSCore.commithooks import get_before_commit_subscribers_manager
 
 from Products.CPSCore.treemodification import TreeModification
 from Products.CPSCore.treemodification import printable_op
+from Products.CPSCore.treemodification import ADD, REMOVE
 
 _TXN_MGR_ATTRIBUTE = '_cps_tc_manager'
 
@@ -40,6 +43,21 @@ _TXN_MGR_ORDER = 0
 
 logger = logging.getLogger("CPSCore.TreeCacheManager")
 
+def exists(root, path):
+    """Tell if there is an object at a physical path.
+
+    The path is walked without acquisition: an object acquired from an
+    ancestor, e.g. under the id of a removed one, isn't there.
+    """
+    ob = root
+    for id in path[1:]:
+        if getattr(aq_base(ob), '_getOb', None) is None:
+            return False
+        ob = ob._getOb(id, None)
+        if ob is None:
+            return False
+    return True
+
 class TreeCacheManager(BeforeCommitSubscriber):
     """Holds data about treecache rebuilts to be done."""
 
@@ -51,6 +69,8 @@ class TreeCacheManager(BeforeCommitSubscriber):
         super(TreeCacheManager, self).__init__(mgr, order=_TXN_MGR_ORDER)
         self.clear()
         self._sync = False
+        # During a bulk operation, touched paths for each cache
+        self._bulk = None
 
     def clear(self):
         self._trees = {} # modification tree for each cache
@@ -74,9 +94,15 @@ class TreeCacheManager(BeforeCommitSubscriber):
                 % (cache.getId(), printable_op(op), '/'.join(path), info))
             return
         
+        cache_path = cache.getPhysicalPath()
+        if self._bulk is not None:
+            if cache_path not in self._bulk:
+                self._bulk[cache_path] = (cache, {})
+            self._bulk[cache_path][1][tuple(path)] = None
+            return
+
         logger.debug("push for %s: %s %s %r"
                      % (cache.getId(), printable_op(op), '/'.join(path), info))
-        cache_path = cache.getPhysicalPath()
         if cache_path not in self._trees:
             tree = TreeModification()
             self._trees[cache_path] = tree
@@ -85,6 +111,48 @@ class TreeCacheManager(BeforeCommitSubscriber):
             tree = self._trees[cache_path]
         tree.do(op, path, info, strict=False)
 
+    def startBulk(self):
+        """Start a bulk operation (see bulkoperation).
+
+        Only the touched paths are recorded.
+        """
+        if self._bulk is None:
+            self._bulk = {}
+
+    def endBulk(self):
+        """End a bulk operation.
+
+        Each touched subtree is rebuilt once: the top-most recorded
+        paths are replayed as additions, or as removals if they don't
+        exist anymore (see exists).
+        """
+        bulk = self._bulk
+        if bulk is None:
+            return
+        self._bulk = None
+        for cache, paths in bulk.values():
+            root = cache.getPhysicalRoot()
+            paths = paths.keys()
+            # Sorting tuples puts descendants right after their ancestor
+            paths.sort()
+            top = None
+            for path in paths:
+                if top is not None and path[:len(top)] == top:
+                    continue
+                top = path
+                if exists(root, path):
+                    op = ADD
+                else:
+                    op = REMOVE
+                self.push(cache, op, path, None)
+
+    def isBulk(self):
+        return self._bulk is not None
+
+    def queueSize(self):
+        """Number of operations waiting to be replayed."""
+        return sum([len(tree) for tree in self._trees.values()])
+
     def _getModificationTree(self, cache):
         """Debugging: get the modification tree for a tree cache.
         """
@@ -96,12 +164,41 @@ class TreeCacheManager(BeforeCommitSubscriber):
         Does the actual rebuild work
         """
         logger.debug("__call__")
+        # Catch up with a bulk operation that's not been finished
+        self.endBulk()
+        self._replay()
+        logger.debug("__call__ DONE")
+
+    def _replay(self):
         for cache_path, tree in self._trees.items():
             cache = self._caches[cache_path]
             logger.debug("replaying for cache %s" % cache.getId())
             cache.updateTree(tree)
         self.clear()
-        logger.debug("__call__ DONE")
+
+    def _getSavepointState(self):
+        trees = dict([(cache_path, deepcopy(tree))
+                      for cache_path, tree in self._trees.items()])
+        bulk = self._bulk
+        if bulk is not None:
+            bulk = dict([(cache_path, (cache, paths.copy()))
+                         for cache_path, (cache, paths) in bulk.items()])
+        return trees, self._caches.copy(), bulk
+
+    def _restoreSavepointState(self, state):
+        trees, caches, bulk = state
+        # Later pushes modify the trees, the state may be restored again
+        self._trees = dict([(cache_path, deepcopy(tree))
+                            for cache_path, tree in trees.items()])
+        self._caches = caches.copy()
+        if bulk is not None:
+            bulk = dict([(cache_path, (cache, paths.copy()))
+                         for cache_path, (cache, paths) in bulk.items()])
+        self._bulk = bulk
+
+    def _flushAtSavepoint(self):
+        # The paths touched by a bulk operation are kept until its end
+        self._replay()
 
 def get_treecache_manager():
     """Get the treecache manager.
@@ -20,15 +20,23 @@
 """
 
 import logging
+import weakref
+import transaction
+from itertools import chain
 from ZODB.loglevels import TRACE, BLATHER
+from ZODB.POSException import ConflictError
 from AccessControl import ClassSecurityInfo
 from AccessControl import Unauthorized
 from AccessControl import getSecurityManager
 from AccessControl.SecurityManagement import newSecurityManager
 from AccessControl.SecurityManagement import setSecurityManager
 from AccessControl.User import UnrestrictedUser as BaseUnrestrictedUser
+from AccessControl.PermissionRole import rolesForPermissionOn
 from Acquisition import aq_base, aq_inner
-from BTrees.OOBTree import OOBTree
+from Persistence import Persistent
+from BTrees.OIBTree import OIBTree
+from BTrees.IOBTree import IOBTree
+from BTrees.Length import Length
 from Globals import InitializeClass, DTMLFile
 from OFS.Folder import Folder
 
@@ -39,10 +47,20 @@ from Products.CMFCore.permissions import View
 from Products.CMFCore.permissions import ManagePortal
 from Products.CMFCore.permissions import ViewManagementScreens
 
+from App.Common import rfc1123_date
+from DateTime import DateTime
+
 from Products.CPSUtil.text import truncateText
 from Products.CPSCore.utils import getAllowedRolesAndUsersOfUser
 from Products.CPSCore.utils import getAllowedRolesAndUsersOfObject
+from Products.CPSCore.utils import hasDefaultAllowedRolesAndUsers
 from Products.CPSCore.TreeCacheManager import get_treecache_manager
+from Products.CPSCore.treelistcache import get_tree_list_cache
+from Products.CPSCore.treestorage import TreeNode
+from Products.CPSCore.treestorage import TreePartitions
+from Products.CPSCore.treestorage import TreePositions
+from Products.CPSCore.treestorage import child_key
+from Products.CPSCore.treestorage import RPATH_KEYS, POSITION_KEYS
 
 from Products.CPSCore.treemodification import ADD, REMOVE, MODIFY
 from Products.CPSCore.treemodification import printable_op
@@ -60,6 +78,54 @@ def intersects(a, b):
             return True
     return False
 
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        json = None
+
+# Encoding of the non unicode strings of the nodes, for getListJSON
+JSON_ENCODING = 'iso-8859-15'
+
+# Keys of the entries served by getListJSON, the others (notably the
+# principals of allowed_roles_and_users and local_roles) aren't public
+JSON_KEYS = ('id', 'rpath', 'portal_type', 'depth', 'nb_children',
+             'visible', 'title', 'title_or_id', 'short_title',
+             'description')
+
+# Nodes store their allowed roles and users as the ids interned by the
+# cache, under this key (see TreeCacheUpdater.internSecurity)
+ALLOWED_KEY = '_allowed'
+
+# Nodes store their own setting of the View permission under this key
+# (see TreeCacheUpdater.updateSecurityUnder)
+VIEW_KEY = '_view'
+VIEW_PERMISSION_ATTR = '_View_Permission'
+
+# Stored settings of the View permission that can't be used
+_UNKNOWN_SETTING = object()
+
+# Nodes store their localized fields for each of their languages under
+# this key (see get_localized_fields)
+LOCALIZED_KEY = '_localized'
+
+# Attributes holding the data of a cache (see init_storage)
+STORAGE_ATTRS = ('_infos', '_structure', '_order', '_positions',
+                 '_principals', '_principal_names')
+
+# Nodes built per transaction by TreeCache.rebuildInChunks
+REBUILD_COMMIT_EVERY = 1000
+
+# Consecutive conflicts on a chunk before a chunked rebuild gives up
+REBUILD_MAX_CONFLICTS = 5
+
 from zope.interface import implements
 from Products.CPSCore.interfaces import ITreeTool
 from Products.CPSCore.interfaces import ITreeCache
@@ -74,6 +140,91 @@ class UnrestrictedUser(BaseUnrestrictedUser):
 logger = logging.getLogger('CPSCore.TreesTool')
 
 
+def init_storage(ob, root):
+    """Set up empty data of a cache on ob (see treestorage)."""
+    ob._infos = TreePartitions(RPATH_KEYS, root) # rpath -> info dict
+    ob._structure = TreePartitions(RPATH_KEYS, root) # -> TreeNode
+    ob._order = TreePartitions(POSITION_KEYS) # position key -> rpath
+    ob._positions = TreePartitions(RPATH_KEYS, root) # -> position key
+    ob._principals = OIBTree() # principal -> id
+    ob._principal_names = IOBTree() # id -> principal
+
+
+def get_localized_fields(info, locale):
+    """Compute the fields of a node info localized in a language.
+
+    Returns a mapping with title, title_or_id and short_title if the
+    node has a title in that language, and description if it has a
+    description in that language.
+    """
+    res = {}
+    titles = info.get('l10n_titles')
+    if titles and titles.has_key(locale):
+        title = titles[locale]
+        if title:
+            title_or_id = title
+        else:
+            title_or_id = info['id']
+        res['title'] = title
+        res['title_or_id'] = title_or_id
+        res['short_title'] = truncateText(title_or_id)
+    descriptions = info.get('l10n_descriptions')
+    if descriptions and descriptions.has_key(locale):
+        res['description'] = descriptions[locale]
+    return res
+
+def normalize_locale_keys(locale_keys):
+    """Get the locale_keys of a listing as a tuple, or None.
+
+    A string, as passed from the web without the :list marshalling,
+    holds comma-separated keys.
+    """
+    if locale_keys is None:
+        return None
+    if isinstance(locale_keys, basestring):
+        locale_keys = [key.strip() for key in locale_keys.split(',')
+                       if key.strip()]
+    return tuple(locale_keys)
+
+def normalize_boolean(value):
+    """Get a boolean passed from the web, maybe as a string."""
+    if isinstance(value, basestring):
+        return value.strip().lower() not in ('', '0', 'false', 'no', 'off')
+    return bool(value)
+
+def encode_list_token(position, order):
+    """Make the continuation token of a listing stopped at position.
+
+    position is the position key of the last entry if order is true,
+    else its rpath (see TreeCache._iterList).
+    """
+    if order:
+        return 'p' + '/'.join(['%d:%s' % step for step in position])
+    return 'r' + position
+
+def decode_list_token(token, order):
+    """Get the position a listing is continued after.
+
+    Raises ValueError for tokens not made by encode_list_token.
+    """
+    if order:
+        kind = 'p'
+    else:
+        kind = 'r'
+    if not isinstance(token, str) or not token.startswith(kind):
+        raise ValueError("Invalid continuation token %r" % (token,))
+    token = token[1:]
+    if not order:
+        return token
+    if not token:
+        return ()
+    res = []
+    for step in token.split('/'):
+        index, id = step.split(':', 1)
+        res.append((int(index), id))
+    return tuple(res)
+
+
 class TreesTool(UniqueObject, Folder):
     """Trees Tool that caches information about the site's hierarchies.
     """
@@ -87,6 +238,7 @@ class TreesTool(UniqueObject, Folder):
 
     manage_options = Folder.manage_options + (
     {'label': 'Export', 'action': 'manage_genericSetupExport.html'},
+    {'label': 'List Cache', 'action': 'manage_listCache'},
                     )
 
     _properties = Folder._properties + (
@@ -117,7 +269,7 @@ class TreesTool(UniqueObject, Folder):
         path = ob.getPhysicalPath()
         logger.log(TRACE, "Got %s for %s", event_type, '/'.join(path))
         for cache in self.objectValues():
-            if cache.isCandidate(ob):
+            if cache.isCandidate(ob, path):
                 if event_type in ('sys_add_cmf_object', 'sys_add_object'):
                     op = ADD
                     info = None
@@ -166,21 +318,116 @@ class TreesTool(UniqueObject, Folder):
         if REQUEST is not None:
             REQUEST.RESPONSE.redirect(ob.absolute_url()+'/manage_workspace')
 
+    security.declareProtected(ViewManagementScreens, 'manage_listCache')
+    manage_listCache = DTMLFile('zmi/tree_list_cache', globals())
+
+    security.declareProtected(ViewManagementScreens, 'getListCacheStatistics')
+    def getListCacheStatistics(self):
+        """Return the statistics of the memo of getList results.
+
+        The memo is shared by all the tree caches of the Zope process, see
+        treelistcache.
+        """
+        return get_tree_list_cache().getStatistics()
+
+    security.declareProtected(ManagePortal, 'manage_clearListCache')
+    def manage_clearListCache(self, REQUEST=None):
+        """Forget the memoized getList results and their statistics."""
+        get_tree_list_cache().clear()
+        if REQUEST is not None:
+            REQUEST.RESPONSE.redirect(self.absolute_url()+'/manage_listCache')
+
 InitializeClass(TreesTool)
 
 
+class TreeCacheFilter(object):
+    """Compiled test of the objects a cache keeps (see isCandidate).
+
+    Compiled from the properties of the cache it checks, given as
+    sources, and kept by the cache until they change.
+    """
+
+    def __init__(self, cache, sources):
+        root, meta_types, type_names, excluded_rpaths = sources
+        self.sources = sources
+        portal = getToolByName(cache, 'portal_url').getPortalObject()
+        self.plen = len(portal.getPhysicalPath())
+        if root:
+            self.root = tuple(root.split('/'))
+        else:
+            self.root = None
+        self.meta_types = frozenset(meta_types or ())
+        self.type_names = frozenset(type_names or ())
+        # Trie of the steps of the excluded rpaths, None marking their end
+        excluded = {}
+        for rpath in excluded_rpaths:
+            node = excluded
+            for step in rpath.split('/'):
+                node = node.setdefault(step, {})
+            node[None] = None
+        self.excluded = excluded
+
+    def __call__(self, ob, path=None):
+        """Return True if the object should be cached."""
+        # Check under root
+        root = self.root
+        if root is None:
+            return False
+
+        # Check types (right away: this is quick)
+        # GR: this has in particular the effect of filtering objects from
+        # the repository, that appear to be inside their proxy and would break
+        # the update
+        bob = aq_base(ob)
+        if (self.meta_types and
+            getattr(bob, 'meta_type', None) not in self.meta_types):
+            return False
+        if getattr(bob, 'portal_type', None) not in self.type_names:
+            return False
+
+        if path is None:
+            path = ob.getPhysicalPath()
+        start = self.plen
+        if tuple(path[start:start+len(root)]) != root:
+            return False
+        # Check excluded rpaths, an rpath excludes itself and what's under
+        node = self.excluded
+        for step in path[start:]:
+            node = node.get(step)
+            if node is None:
+                return True
+            if None in node:
+                return False
+        return True
+
+
 class TreeCacheUpdater(object):
     """Get or update info about a cache.
+
+    The data updated is the one of the cache, or of a TreeCacheBuild
+    given as storage.
     """
-    def __init__(self, cache):
+    def __init__(self, cache, storage=None):
+        if storage is None:
+            storage = cache
         self.cache = cache
-        self.infos = getattr(cache, '_infos', None)
+        self.infos = getattr(storage, '_infos', None)
+        self.structure = getattr(storage, '_structure', None)
+        self.positions = TreePositions(storage)
+        self.principals = getattr(storage, '_principals', None)
+        self.principal_names = getattr(storage, '_principal_names', None)
         self.portal = getToolByName(cache, 'portal_url').getPortalObject()
         self.plen = len(self.portal.getPhysicalPath())
         self.info_method = cache.info_method
         tmp_user = UnrestrictedUser('manager', '', ['Manager'], '')
         self.tmp_user = tmp_user.__of__(aq_inner(cache.acl_users))
         self.root = cache.getRoot()
+        self.filter = cache._getFilter()
+        # rpaths of the nodes whose security changed in the replayed
+        # modifications, and of the ones already updated from their
+        # object (see updateSecurityUnder)
+        self.security_changed = {}
+        self.security_updated = {}
 
     def getRpathFromPath(self, path):
         return '/'.join(path[self.plen:])
@@ -192,32 +439,7 @@ class TreeCacheUpdater(object):
 
     def isCandidate(self, ob):
         """Return True if the object should be cached."""
-        # Check under root
-        if not self.root:
-            return False
-
-        # Check types (right away: this is quick)
-        # GR: this has in particular the effect of filtering objects from
-        # the repository, that appear to be inside their proxy and would break
-        # the update
-        bob = aq_base(ob)
-        if (self.cache.meta_types and
-            getattr(bob, 'meta_type', None) not in self.cache.meta_types):
-            return False
-
-        type_names = self.cache.type_names or ()
-        if getattr(bob, 'portal_type', None) not in type_names:
-            return False
-
-        rpath_slash = self.getRpath(ob)+'/'
-        if not rpath_slash.startswith(self.root+'/'):
-            return False
-        # Check excluded rpaths
-        for excluded_rpath in self.cache.excluded_rpaths:
-            if rpath_slash.startswith(excluded_rpath+'/'):
-                return False
-
-        return True
+        return self.filter(ob)
 
     def getNodeInfo(self, ob):
         """Compute info about one object.
@@ -264,35 +486,106 @@ class TreeCacheUpdater(object):
             'local_roles': local_roles,
             }
 
+    def internPrincipals(self, names):
+        """Return the tuple of the ids interned for principals.
+
+        New principals get the next id.
+        """
+        principals = self.principals
+        ids = []
+        for name in names:
+            id = principals.get(name)
+            if id is None:
+                names_by_id = self.principal_names
+                if names_by_id:
+                    id = names_by_id.maxKey() + 1
+                else:
+                    id = 0
+                principals[name] = id
+                names_by_id[id] = name
+            ids.append(id)
+        return tuple(ids)
+
+    def internSecurity(self, info):
+        """Replace the allowed roles and users of a node by their ids.
+
+        A tuple of small integers is smaller to store than the list of
+        names, and quicker to check against the principals of a user.
+        """
+        allowed = info.pop('allowed_roles_and_users', None)
+        if allowed is not None:
+            info[ALLOWED_KEY] = self.internPrincipals(allowed)
+        return info
+
+    def getChildren(self, rpath):
+        """Get the rpaths of the children of a node."""
+        node = self.structure.get(rpath)
+        if node is None:
+            return ()
+        return node.children
+
+    def getViewSetting(self, ob):
+        """Get the own setting of the View permission of an object.
+
+        None if it acquires it, a list of roles if it acquires it and
+        adds roles, a tuple of roles if it doesn't acquire it.
+        """
+        setting = getattr(aq_base(ob), VIEW_PERMISSION_ATTR, None)
+        if isinstance(setting, list):
+            setting = list(setting)
+        return setting
+
+    def getStoredNodeInfo(self, ob):
+        """Compute info about one object, as stored in the cache."""
+        info = self.internSecurity(self.getNodeInfo(ob))
+        info[VIEW_KEY] = self.getViewSetting(ob)
+        info[LOCALIZED_KEY] = self.getLocalizedFields(info)
+        return info
+
+    def getLocalizedFields(self, info):
+        """Precompute the localized fields of a node for getList.
+
+        Returns a mapping of the languages of its titles and descriptions
+        to their localized fields (see get_localized_fields).
+        """
+        locales = {}
+        for key in ('l10n_titles', 'l10n_descriptions'):
+            for locale in info.get(key) or ():
+                locales[locale] = None
+        res = {}
+        for locale in locales:
+            res[locale] = get_localized_fields(info, locale)
+        return res
+
     def updateNode(self, ob):
         """Compute one node in the tree.
 
         Keeps children info from previous node if available.
         """
         rpath = self.getRpath(ob)
-        old_info = self.infos.get(rpath)
-        info = self.getNodeInfo(ob)
-        if old_info is not None:
-            info['depth'] = old_info['depth']
-            info['children'] = old_info['children']
-            info['nb_children'] = old_info['nb_children']
-            self.infos[rpath] = info
-        else:
+        self.infos[rpath] = self.getStoredNodeInfo(ob)
+        if not self.structure.has_key(rpath):
             # Compute depth
             root = self.root
             depth = rpath.count('/') - root.count('/')
-            info['depth'] = depth
-            self.infos[rpath] = info
+            self.structure[rpath] = TreeNode(depth)
             self.updateChildrenInfo(ob)
 
     def updateChildrenInfo(self, ob):
         """Recompute the list of children a node has.
         """
         rpath = self.getRpath(ob)
-        info = self.infos.get(rpath)
-        if info is None:
+        node = self.structure.get(rpath)
+        if node is None:
             # Parent is outside of the tree
             return
+        children = self.getCandidateChildren(ob)
+        if children != node.children:
+            node.children = children
+        self.positions.renumberChildren(rpath)
+
+    def getCandidateChildren(self, ob):
+        """Get the rpaths of the subobjects of ob to cache, as a tuple."""
         children = []
         ptype = getattr(aq_base(ob), 'portal_type', None)
         if ptype not in self.cache.terminal_nodes:
@@ -300,9 +593,57 @@ class TreeCacheUpdater(object):
                 if self.isCandidate(subob):
                     subrpath = self.getRpath(subob)
                     children.append(subrpath)
-        info['children'] = children
-        info['nb_children'] = len(children)
-        self.infos[rpath] = info
+        return tuple(children)
+
+    def buildNodes(self, todo, count):
+        """Build the nodes of a stack of (rpath, index), the last one first.
+
+        Used by chunked rebuilds: the children of a built node are pushed
+        on todo with their index in the children of the node, and the
+        walk stops after count nodes, returning the number of nodes
+        built. A node is built only if it's still a child of its parent
+        in the storage, modifications replayed since it was pushed may
+        have moved or removed it. The index of the root is None.
+        """
+        portal = self.portal
+        structure = self.structure
+        positions = self.positions
+        keys = positions.positions
+        root = self.root
+        done = 0
+        while todo and done < count:
+            rpath, i = todo.pop()
+            if rpath == root:
+                key = ()
+            else:
+                prpath = rpath[:rpath.rfind('/')]
+                pnode = structure.get(prpath)
+                if pnode is None:
+                    continue
+                siblings = pnode.children
+                if i >= len(siblings) or siblings[i] != rpath:
+                    # Moved or removed since it was pushed
+                    if rpath not in siblings:
+                        continue
+                    i = list(siblings).index(rpath)
+                key = keys.get(prpath)
+                if key is not None:
+                    key = child_key(key, i, rpath)
+            ob = portal.unrestrictedTraverse(rpath, None)
+            if ob is None:
+                continue
+            self.infos[rpath] = self.getStoredNodeInfo(ob)
+            depth = rpath.count('/') - root.count('/')
+            children = self.getCandidateChildren(ob)
+            structure[rpath] = TreeNode(depth, children)
+            if key is not None:
+                positions.indexNode(rpath, key)
+            i = len(children)
+            while i:
+                i -= 1
+                todo.append((children[i], i))
+            done += 1
+        return done
 
     def makeTree(self, ob):
         """Recompute the tree starting from ob."""
@@ -310,13 +651,15 @@ class TreeCacheUpdater(object):
         root = self.root
         depth = rpath.count('/') - root.count('/')
         self._makeTree(ob, depth)
+        if rpath == root:
+            self.positions.index(rpath, ())
 
     def _makeTree(self, ob, depth):
         """Recompute the tree starting from ob.
 
         Recursive method.
         """
-        info = self.getNodeInfo(ob)
+        info = self.getStoredNodeInfo(ob)
         subdepth = depth+1
         children = []
         ptype = getattr(aq_base(ob), 'portal_type', None)
@@ -325,25 +668,116 @@ class TreeCacheUpdater(object):
                 if self.isCandidate(subob):
                     subrpath = self._makeTree(subob, subdepth)
                     children.append(subrpath)
-        info['depth'] = depth
-        info['children'] = children
-        info['nb_children'] = len(children)
         rpath = info['rpath']
         self.infos[rpath] = info
+        self.structure[rpath] = TreeNode(depth, children)
         return rpath
 
     def updateSecurityUnder(self, ob):
         """Update security under an object.
+
+        The descendants are walked through the children lists of the
+        cache. The allowed roles and users of a descendant are derived
+        from its parent's when its View permission gives the same roles
+        and it blocks no local role: they are then the parent's plus the
+        principals having one of these roles as own local role, and the
+        object doesn't have to be loaded. Other descendants are loaded
+        and computed from scratch, as are the ones whose own security
+        changed (their stored local roles are outdated), and all of them
+        if the user folder computes the allowed roles and users itself.
         """
-        rpath = self.getRpath(ob)
-        info = self.infos.get(rpath)
-        if info is not None:
-            info.update(self.getNodeSecurityInfo(ob))
-            self.infos[rpath] = info
-        # Recurse
-        for subob in ob.objectValues(self.cache.meta_types):
-            if self.isCandidate(subob):
-                self.updateSecurityUnder(subob)
+        top = self.getRpath(ob)
+        info = self.infos.get(top)
+        if info is None:
+            # Outside of the tree, recurse on objects
+            for subob in ob.objectValues(self.cache.meta_types):
+                if self.isCandidate(subob):
+                    self.updateSecurityUnder(subob)
+            return
+        derive = hasDefaultAllowedRolesAndUsers(ob)
+        changed = self.security_changed
+        updated = self.security_updated
+        roles, allowed = self.updateNodeSecurity(ob, info)
+        updated[top] = None
+        loaded = 1
+        derived = 0
+        todo = [(child, roles, allowed) for child in self.getChildren(top)]
+        while todo:
+            rpath, roles, allowed = todo.pop()
+            info = self.infos.get(rpath)
+            if info is None:
+                # Inconsistent tree
+                continue
+            res = None
+            if derive and rpath not in changed:
+                res = self.deriveNodeSecurity(info, roles, allowed)
+            if res is None:
+                ob = self.portal.unrestrictedTraverse(rpath, None)
+                if ob is None:
+                    continue
+                roles, allowed = self.updateNodeSecurity(ob, info)
+                updated[rpath] = None
+                loaded += 1
+            else:
+                allowed = res
+                derived += 1
+            for child in self.getChildren(rpath):
+                todo.append((child, roles, allowed))
+        logger.log(TRACE, "Security updated under %s: %d nodes loaded, "
+                   "%d derived", top, loaded, derived)
+
+    def updateNodeSecurity(self, ob, info):
+        """Recompute the security of a node from its object.
+
+        Returns the roles having View and the allowed roles and users.
+        """
+        info.update(self.getNodeSecurityInfo(ob))
+        allowed = info['allowed_roles_and_users']
+        info[VIEW_KEY] = self.getViewSetting(ob)
+        self.infos[info['rpath']] = self.internSecurity(info)
+        roles = {}
+        for role in rolesForPermissionOn('View', ob):
+            roles[role] = None
+        return roles, allowed
+
+    def deriveNodeSecurity(self, info, roles, allowed):
+        """Derive the security of a node from its parent's.
+
+        roles are the roles having View on the parent, and allowed its
+        allowed roles and users. Returns the allowed roles and users of
+        the node, or None if they can't be derived.
+        """
+        setting = info.get(VIEW_KEY, _UNKNOWN_SETTING)
+        if setting is None:
+            pass
+        elif isinstance(setting, (list, tuple)):
+            own = {}
+            for role in setting:
+                own[role] = None
+            if isinstance(setting, list):
+                own.update(roles)
+            if own != roles:
+                return None
+        else:
+            return None
+        added = []
+        for principal, local_roles in info['local_roles'].items():
+            has_view = False
+            for role in local_roles:
+                if role.startswith('-'):
+                    # Blocking changes what's merged from above
+                    return None
+                if role in roles:
+                    has_view = True
+            if has_view and principal not in allowed:
+                added.append(principal)
+        if added:
+            allowed = list(allowed) + added
+        ids = self.internPrincipals(allowed)
+        if ids != info[ALLOWED_KEY]:
+            info[ALLOWED_KEY] = ids
+            self.infos[info['rpath']] = info
+        return allowed
 
     # Operations on physical paths
 
@@ -369,27 +803,27 @@ class TreeCacheUpdater(object):
         """Delete all nodes at or under a given physical path.
         """
         rpath = self.getRpathFromPath(path)
-        for key in list(self.infos.keys(rpath+'/', rpath+'/\xFF')):
-            del self.infos[key]
-        if rpath in self.infos:
-            del self.infos[rpath]
+        self.positions.unindexPath(rpath)
+        for tree in (self.infos, self.structure):
+            for key in list(tree.keys(rpath+'/', rpath+'/\xFF')):
+                del tree[key]
+            if tree.has_key(rpath):
+                del tree[rpath]
 
     def fixParentOfPathAfterDelete(self, path):
         """Fix a parent's children info after a remove.
         """
         rpath = self.getRpathFromPath(path)
         prpath = self.getRpathFromPath(path[:-1])
-        parent_info = self.infos.get(prpath)
-        if parent_info is None:
+        node = self.structure.get(prpath)
+        if node is None:
             # Parent is outside of the tree
             return
-        try:
-            parent_info['children'].remove(rpath)
-        except ValueError:
-            pass
-        else:
-            parent_info['nb_children'] -= 1
-            self.infos[prpath] = parent_info
+        children = node.children
+        if rpath in children:
+            node.children = tuple([child for child in children
+                                   if child != rpath])
+            self.positions.renumberChildren(prpath)
 
     def updateSecurityUnderPath(self, path):
         """Update security info under a path.
@@ -405,7 +839,11 @@ class TreeCacheUpdater(object):
         Here events have been compressed, and we have to recurse for ADD
         and REMOVE.
         """
-        for op, path, info in tree.get():
+        ops = tree.get()
+        for op, path, info in ops:
+            if op == MODIFY and 'security' in info and 'full' not in info:
+                self.security_changed[self.getRpathFromPath(path)] = None
+        for op, path, info in ops:
             logger.log(TRACE, "  replaying %s %s %s",
                        printable_op(op), '/'.join(path), info)
             if op == ADD:
@@ -423,12 +861,28 @@ class TreeCacheUpdater(object):
                 if 'full' in info:
                     self.updateNodeAtPath(path)
                 else:
-                    if 'security' in info:
+                    if ('security' in info and self.getRpathFromPath(path)
+                        not in self.security_updated):
+                        # Unless updated with an ancestor's subtree
                         self.updateSecurityUnderPath(path)
                     if 'order' in info:
                         self.updateChildrenInfoAtPath(path)
 
 
+class TreeCacheBuild(Persistent):
+    """Data of a tree cache being rebuilt in several transactions.
+
+    Holds the same data as the cache (see init_storage), and the stack of
+    (rpath, index) still to visit (see TreeCacheUpdater.buildNodes). Each commit
+    of the build is a checkpoint it can be resumed from.
+    """
+
+    def __init__(self, root):
+        init_storage(self, root)
+        self.todo = ((root, None),)
+        self.done = 0
+
+
 class TreeCache(SimpleItemWithProperties):
     """Tree cache object, caches information about one hierarchy.
 
@@ -505,17 +959,75 @@ class TreeCache(SimpleItemWithProperties):
     info_method = ''
     terminal_nodes = ()
 
+    # Rebuild in progress (see rebuildInChunks)
+    _build = None
+
     def __init__(self, id, **kw):
         self._setId(id)
         self._clear()
 
     def _clear(self):
-        self._infos = OOBTree() # rpath -> info dict
+        init_storage(self, self.getRoot())
 
     def _maybeUpgrade(self):
         """Upgrade from the old format if needed."""
         if self.__dict__.has_key('_tree'):
             self._upgrade()
+            return
+        if not self.__dict__.has_key('_structure'):
+            self._upgradeStructure()
+        if not self.__dict__.has_key('_principals'):
+            self._upgradePrincipals()
+        if not isinstance(self._infos, TreePartitions):
+            self._upgradePartitions()
+        elif not self.__dict__.has_key('_order'):
+            self._upgradePositions()
+
+    def _upgradePrincipals(self):
+        """Intern the allowed roles and users of a cache."""
+        logger.info("Interning the principals of tree %s", self.getId())
+        self._principals = OIBTree()
+        self._principal_names = IOBTree()
+        updater = TreeCacheUpdater(self)
+        infos = self._infos
+        for rpath, info in list(infos.items()):
+            infos[rpath] = updater.internSecurity(info)
+
+    def _upgradeStructure(self):
+        """Move the depth and children out of the infos of a cache."""
+        logger.info("Splitting the structure of tree %s", self.getId())
+        structure = TreePartitions(RPATH_KEYS, self.getRoot())
+        self._structure = structure
+        infos = self._infos
+        for rpath, info in list(infos.items()):
+            children = tuple(info.pop('children', ()))
+            structure[rpath] = TreeNode(info.pop('depth'), children)
+            info.pop('nb_children', None)
+            infos[rpath] = info
+
+    def _upgradePartitions(self):
+        """Move the data of a cache to partitioned storage."""
+        logger.info("Partitioning tree %s", self.getId())
+        root = self.getRoot()
+        for attr in ('_infos', '_structure'):
+            old = getattr(self, attr)
+            new = TreePartitions(RPATH_KEYS, root)
+            for rpath, value in old.items():
+                if isinstance(value, tuple):
+                    # Structure records were (depth, children)
+                    value = TreeNode(value[0], value[1])
+                new[rpath] = value
+            setattr(self, attr, new)
+        self._upgradePositions()
+
+    def _upgradePositions(self):
+        """Compute the positions of a cache that has none."""
+        logger.info("Computing the positions of tree %s", self.getId())
+        root = self.getRoot()
+        self._order = TreePartitions(POSITION_KEYS)
+        self._positions = TreePartitions(RPATH_KEYS, root)
+        if root and self._infos.has_key(root):
+            TreePositions(self).index(root, ())
 
     def _upgrade(self):
         """Upgrade from the old format."""
@@ -540,14 +1052,79 @@ class TreeCache(SimpleItemWithProperties):
         return res
 
     security.declareProtected(View, 'isCandidate')
-    def isCandidate(self, ob):
-        """Return True if the object should be cached."""
-        return TreeCacheUpdater(self).isCandidate(ob)
+    def isCandidate(self, ob, path=None):
+        """Return True if the object should be cached.
+
+        path is the physical path of the object, if already known.
+        """
+        return self._getFilter()(ob, path)
+
+    def _getFilter(self):
+        """Get the compiled test of the objects to cache.
+
+        It's recompiled when the properties it depends on change.
+        """
+        sources = (self.getRoot(), self.meta_types, self.type_names,
+                   self.excluded_rpaths)
+        filter = self.__dict__.get('_v_filter')
+        if filter is None or filter.sources != sources:
+            filter = TreeCacheFilter(self, sources)
+            self._v_filter = filter
+        return filter
+
+    def _bumpVersion(self):
+        """Change the version of the cache, part of the getList memo keys.
+
+        Length resolves the conflicts of concurrent updates.
+        """
+        version = self.__dict__.get('_version')
+        if version is None:
+            self._version = version = Length()
+        version.change(1)
+        # The change isn't committed before the end of the transaction
+        self._v_changed_in = weakref.ref(transaction.get())
+
+    def _getVersionKey(self):
+        """Get a key identifying the committed state of the cache, or None.
+
+        The key holds the serial of the committed version, bumped by each
+        change of the cache. There is none for caches that have no stored
+        version yet, or that have been changed in the current
+        transaction, even in a savepoint: other threads could see the
+        same version with different data.
+        """
+        version = self.__dict__.get('_version')
+        if version is None or version._p_oid is None:
+            return None
+        if self._hasUncommittedChanges():
+            return None
+        version._p_activate()
+        return (self.getPhysicalPath(), version._p_oid, version._p_serial)
+
+    def _hasUncommittedChanges(self):
+        """Tell if the cache has been changed in the current transaction.
+
+        Changes go with a bump of the version (see _bumpVersion), which
+        records the transaction: they stay uncommitted after a savepoint.
+        """
+        if self._p_changed or self._version._p_changed:
+            return True
+        changed_in = self.__dict__.get('_v_changed_in')
+        return changed_in is not None and changed_in() is transaction.get()
+
+    def _getMemoKey(self, args, whoami):
+        """Get the key of getList results in the memo, or None."""
+        version_key = self._getVersionKey()
+        if version_key is None:
+            return None
+        return version_key + (args, frozenset(whoami))
 
     security.declarePrivate('rebuild')
     def rebuild(self):
         """Rebuild all the tree."""
         self._clear()
+        self._build = None
+        self._bumpVersion()
         portal = getToolByName(self, 'portal_url').getPortalObject()
         root = self.getRoot()
         if not root:
@@ -560,6 +1137,97 @@ class TreeCache(SimpleItemWithProperties):
             return
         TreeCacheUpdater(self).makeTree(root_ob)
 
+    security.declarePrivate('startBuild')
+    def startBuild(self):
+        """Start a chunked rebuild, dropping any rebuild in progress.
+
+        Returns False if there is nothing to build.
+        """
+        self._maybeUpgrade()
+        self._build = None
+        root = self.getRoot()
+        portal = getToolByName(self, 'portal_url').getPortalObject()
+        if not root or portal.unrestrictedTraverse(root, None) is None:
+            self.rebuild()
+            return False
+        logger.info("Starting a rebuild of tree %s", self.getId())
+        self._build = TreeCacheBuild(root)
+        return True
+
+    security.declarePrivate('buildChunk')
+    def buildChunk(self, count=REBUILD_COMMIT_EVERY):
+        """Build up to count more nodes of the rebuild in progress.
+
+        The built tree replaces the current one when it's complete.
+        Returns True when the rebuild is finished.
+        """
+        build = self._build
+        if build is None:
+            return True
+        todo = list(build.todo)
+        done = TreeCacheUpdater(self, build).buildNodes(todo, count)
+        build.todo = tuple(todo)
+        build.done += done
+        logger.info("Rebuilding tree %s: %s nodes built, %s pending",
+                    self.getId(), build.done, len(todo))
+        if todo:
+            return False
+        for attr in STORAGE_ATTRS:
+            setattr(self, attr, getattr(build, attr))
+        self._build = None
+        self._bumpVersion()
+        logger.info("Rebuilt tree %s", self.getId())
+        return True
+
+    security.declarePrivate('rebuildInChunks')
+    def rebuildInChunks(self, commit_every=REBUILD_COMMIT_EVERY,
+                        resume=True):
+        """Rebuild all the tree, committing every commit_every nodes.
+
+        The walk is iterative, and the new tree is built aside: the
+        current one is still served and maintained until the new one
+        replaces it in the last transaction. Modifications replayed in
+        the meantime are replayed on the new tree as well.
+
+        If a previous chunked rebuild was interrupted, it's resumed from
+        its last commit, unless resume is false. A chunk that conflicts
+        is retried. Meant to be run from a script (zopectl run), as it
+        commits the current transaction.
+        """
+        if self._build is None or not resume:
+            if not self.startBuild():
+                return
+            transaction.commit()
+        else:
+            logger.info("Resuming the rebuild of tree %s", self.getId())
+        conflicts = 0
+        while True:
+            finished = self.buildChunk(commit_every)
+            try:
+                transaction.commit()
+            except ConflictError:
+                transaction.abort()
+                conflicts += 1
+                if conflicts >= REBUILD_MAX_CONFLICTS:
+                    raise
+                logger.info("Conflict rebuilding tree %s, retrying",
+                            self.getId())
+                continue
+            conflicts = 0
+            if finished:
+                break
+
+    security.declareProtected(ViewManagementScreens, 'getBuildStatus')
+    def getBuildStatus(self):
+        """Get the progress of the rebuild in progress, or None.
+
+        Returns a mapping with the number of nodes built and pending.
+        """
+        build = self._build
+        if build is None:
+            return None
+        return {'done': build.done, 'pending': len(build.todo)}
+
     # Called by the TreeCacheManager
 
     security.declarePrivate('updateTree')
@@ -568,13 +1236,17 @@ class TreeCache(SimpleItemWithProperties):
         """
         self._maybeUpgrade()
         TreeCacheUpdater(self).updateTree(tree)
+        if self._build is not None:
+            # Keep the tree being rebuilt up to date
+            TreeCacheUpdater(self, self._build).updateTree(tree)
+        self._bumpVersion()
 
     def _getModificationTree(self):
         """Debugging: get the current modification tree.
         """
         return get_treecache_manager()._getModificationTree(self)
 
-    def _localize(self, info, locale_keys, locale):
+    def _localize(self, info, locale_keys, locale, localized=None):
         """Localize info attributes specified in locale_keys into the locale
         language.
 
@@ -584,25 +1256,26 @@ class TreeCache(SimpleItemWithProperties):
           - short_title
         - description
         Other keys are ignored
+
+        localized are the localized fields precomputed for the node, if
+        stored (see TreeCacheUpdater.getLocalizedFields).
         """
-        if ('title' in locale_keys
-            and info.has_key('l10n_titles')
-            and info['l10n_titles'].has_key(locale)):
-            info['title'] = info['l10n_titles'][locale]
-            if info['title']:
-                title_or_id = info['title']
-            else:
-                title_or_id = info['id']
-            if 'title_or_id' in locale_keys:
-                info['title_or_id'] = title_or_id
-            if 'short_title' in locale_keys:
-                info['short_title'] = truncateText(title_or_id)
+        if localized is None:
+            # Stored before they were precomputed
+            fields = get_localized_fields(info, locale)
+        else:
+            fields = localized.get(locale)
+            if not fields:
+                return info
+
+        if 'title' in locale_keys and fields.has_key('title'):
+            for key in ('title', 'title_or_id', 'short_title'):
+                if key in locale_keys:
+                    info[key] = fields[key]
 
         # XXX: make this part generic (any key instead of description)
-        if ('description' in locale_keys
-            and info.has_key('l10n_descriptions')
-            and info['l10n_descriptions'].has_key(locale)):
-            info['description'] = info['l10n_descriptions'][locale]
+        if 'description' in locale_keys and fields.has_key('description'):
+            info['description'] = fields['description']
 
         return info
 
@@ -640,7 +1313,8 @@ class TreeCache(SimpleItemWithProperties):
 
         If filter is true, skips unviewable entries (slower).
 
-        If order is true, keeps original zodb order (slower).
+        If order is true, keeps original zodb order (using the preorder
+        positions maintained by the cache, see TreePositions).
 
         If count_children is true, get info about nb_children (slower).
 
@@ -656,6 +1330,9 @@ class TreeCache(SimpleItemWithProperties):
           allowed_roles_and_users
           local_roles (local roles without merging)
           visible     (boolean)
+
+        Results are memoized for the version of the cache and the
+        principals of the user (see treelistcache).
         """
         if REQUEST is not None:
             raise Unauthorized
@@ -665,83 +1342,298 @@ class TreeCache(SimpleItemWithProperties):
         user = getSecurityManager().getUser()
         whoami = getAllowedRolesAndUsersOfUser(user)
 
-        infos = self._infos
-        if prefix is None:
-            rpaths = infos.keys()
-        else:
-            rpaths = infos.keys(prefix+'/', prefix+'/\xFF')
-            if infos.has_key(prefix):
-                rpaths = list(rpaths)
-                rpaths.insert(0, prefix)
+        locale_keys = normalize_locale_keys(locale_keys)
+        key = self._getMemoKey((prefix, start_depth, stop_depth, filter,
+                                order, count_children, locale_keys,
+                                locale_lang), whoami)
+        if key is not None:
+            memo = get_tree_list_cache()
+            res = memo.get(key)
+            if res is not None:
+                return res
+
+        res = self._computeList(prefix, start_depth, stop_depth, filter,
+                                order, count_children, locale_keys,
+                                locale_lang, whoami)
+        if key is not None:
+            memo.set(key, res)
+        return res
 
+    security.declareProtected(View, 'iterList')
+    def iterList(self, prefix=None, start_depth=0, stop_depth=999,
+                 filter=True, order=True, locale_keys=None, locale_lang=None,
+                 token=None, REQUEST=None):
+        """Iterate over the entries of getList, computed as consumed.
+
+        The entries are the ones of getList without count_children, the
+        tree being walked only as far as they're consumed. If token is
+        a continuation token returned by getListPage, starts after the
+        last entry of that page.
+        """
+        if REQUEST is not None:
+            raise Unauthorized
+        entries = self._iterEntries(prefix, start_depth, stop_depth, filter,
+                                    order, locale_keys, locale_lang, token)
+        return (info for position, info in entries)
+
+    security.declareProtected(View, 'getListPage')
+    def getListPage(self, prefix=None, start_depth=0, stop_depth=999,
+                    filter=True, order=True, offset=0, limit=50, token=None,
+                    locale_keys=None, locale_lang=None, REQUEST=None):
+        """Return a page of the entries of getList.
+
+        The page holds at most limit entries, after the first offset
+        ones. They start after the last entry of the previous page if
+        token is its continuation token, at the beginning if it's None.
+
+        Returns (entries, token), token being the continuation token for
+        the next page, None if there are no more entries. Only the
+        entries up to the end of the page are computed. The entries are
+        the ones of getList without count_children, and aren't memoized.
+        """
+        if REQUEST is not None:
+            raise Unauthorized
+        if limit < 1:
+            raise ValueError("Invalid page size %r" % (limit,))
+        entries = self._iterEntries(prefix, start_depth, stop_depth, filter,
+                                    order, locale_keys, locale_lang, token)
         res = []
+        end = offset + limit
+        last = None
+        i = 0
+        for position, info in entries:
+            if i == end:
+                # There are more
+                return res, encode_list_token(last, order)
+            if i >= offset:
+                res.append(info)
+            last = position
+            i += 1
+        return res, None
+
+    def _iterEntries(self, prefix, start_depth, stop_depth, filter, order,
+                     locale_keys, locale_lang, token):
+        """Iterate over the (position, info) of a listing for the user."""
+        if token is None:
+            after = None
+        else:
+            after = decode_list_token(token, order)
+        self._maybeUpgrade()
+        user = getSecurityManager().getUser()
+        whoami = getAllowedRolesAndUsersOfUser(user)
+        return self._iterList(prefix, start_depth, stop_depth, filter,
+                              order, locale_keys, locale_lang, whoami, after)
+
+    security.declareProtected(View, 'getListETag')
+    def getListETag(self, prefix=None, start_depth=0, stop_depth=999,
+                    filter=True, order=True, count_children=False,
+                    locale_keys=None, locale_lang=None):
+        """Return the HTTP entity tag of a getList view, or None.
+
+        It changes with the version of the cache, the arguments and the
+        principals of the user. There is none when the cache has changes
+        that aren't committed yet.
+        """
+        version_key = self._getVersionKey()
+        if version_key is None:
+            return None
+        locale_keys = normalize_locale_keys(locale_keys)
+        user = getSecurityManager().getUser()
+        whoami = list(getAllowedRolesAndUsersOfUser(user))
+        whoami.sort()
+        data = repr((version_key, prefix, start_depth, stop_depth, filter,
+                     order, count_children, locale_keys, locale_lang,
+                     whoami))
+        return '"%s"' % md5(data).hexdigest()
+
+    security.declareProtected(View, 'getListLastModified')
+    def getListLastModified(self):
+        """Return the time of the last committed change (seconds), or None.
+        """
+        if self._getVersionKey() is None:
+            return None
+        return self._version._p_mtime
+
+    if json is not None:
+        security.declareProtected(View, 'getListJSON')
+        def getListJSON(self, prefix=None, start_depth=0, stop_depth=999,
+                        filter=True, order=True, count_children=False,
+                        locale_keys=None, locale_lang=None, REQUEST=None):
+            """Return getList results as JSON, with HTTP conditional caching.
+
+            Arguments are those of getList, as passed from the web: the
+            depths and booleans may be strings, locale_keys a string of
+            comma-separated keys (or locale_keys:list= for each one).
+            filter is ignored, entries the user can't view are always
+            skipped, and only the JSON_KEYS of the entries are served.
+            The response has an ETag and a Last-Modified header, and is a
+            304 Not Modified if the client's copy is still valid
+            (If-None-Match or If-Modified-Since). It is private to the
+            user.
+
+            Only available with the json or simplejson module.
+            """
+            start_depth = int(start_depth)
+            stop_depth = int(stop_depth)
+            args = (prefix, start_depth, stop_depth, True,
+                    normalize_boolean(order),
+                    normalize_boolean(count_children),
+                    normalize_locale_keys(locale_keys), locale_lang)
+            if REQUEST is not None:
+                RESPONSE = REQUEST.RESPONSE
+                etag = self.getListETag(*args)
+                mtime = self.getListLastModified()
+                if etag is not None:
+                    RESPONSE.setHeader('ETag', etag)
+                    RESPONSE.setHeader('Cache-Control',
+                                       'private, must-revalidate')
+                if mtime is not None:
+                    RESPONSE.setHeader('Last-Modified', rfc1123_date(mtime))
+                if self._isNotModified(REQUEST, etag, mtime):
+                    RESPONSE.setStatus(304)
+                    return ''
+                RESPONSE.setHeader('Content-Type', 'application/json')
+            res = []
+            for info in self.getList(*args):
+                entry = {}
+                for key in JSON_KEYS:
+                    if key in info:
+                        entry[key] = info[key]
+                res.append(entry)
+            return json.dumps(res, encoding=JSON_ENCODING)
+
+    def _isNotModified(self, REQUEST, etag, mtime):
+        """Check the conditional headers of a request.
+
+        If-None-Match has precedence over If-Modified-Since.
+        """
+        header = REQUEST.get_header('If-None-Match', None)
+        if header is not None:
+            if etag is None:
+                return False
+            tags = [tag.strip() for tag in header.split(',')]
+            return etag in tags or '*' in tags
+        header = REQUEST.get_header('If-Modified-Since', None)
+        if header is not None and mtime is not None:
+            header = header.split(';')[0]
+            try:
+                since = long(DateTime(header).timeTime())
+            except Exception:
+                return False
+            return long(mtime) <= since
+        return False
 
-        if not order:
-            for rpath in rpaths:
-                info = infos[rpath]
+    def _iterList(self, prefix, start_depth, stop_depth, filter, order,
+                  locale_keys, locale_lang, whoami, after=None):
+        """Iterate over the entries of a listing for the given principals.
+
+        Yields (position, info), position being the position key of the
+        entry if order is true, else its rpath. If after is given, starts
+        after the entry at that position. The tree is walked as the
+        entries are consumed.
+        """
+        # Interned ids of the user's principals (see internSecurity)
+        principals = self._principals
+        whoami_ids = {}
+        for name in whoami:
+            id = principals.get(name)
+            if id is not None:
+                whoami_ids[id] = None
+        names = self._principal_names
+
+        infos = self._infos
+        structure = self._structure
 
+        if not order:
+            if prefix is None:
+                items = structure.items(after)
+            else:
+                min = prefix+'/'
+                if after is not None and after > min:
+                    min = after
+                items = structure.items(min, prefix+'/\xFF')
+                node = structure.get(prefix)
+                if node is not None and after is None:
+                    items = chain([(prefix, node)], items)
+
+            for rpath, node in items:
+                if rpath == after:
+                    continue
                 # Check depth
-                depth = info['depth']
+                depth = node.depth
                 if depth < start_depth or depth > stop_depth:
                     continue
+                info = infos.get(rpath)
+                if info is None:
+                    # Inconsistent tree, don't break completely
+                    continue
 
                 # Check filter
-                visible = intersects(info['allowed_roles_and_users'], whoami)
+                visible = intersects(info[ALLOWED_KEY], whoami_ids)
                 if filter and not visible:
                     continue
                 info = info.copy()
                 info['visible'] = visible
-                del info['children']
+                info['depth'] = depth
+                info['nb_children'] = len(node.children)
+                info['allowed_roles_and_users'] = [
+                    names[id] for id in info.pop(ALLOWED_KEY)]
+                info.pop(VIEW_KEY, None)
+                localized = info.pop(LOCALIZED_KEY, None)
+                if locale_keys is not None:
+                    self._localize(info, locale_keys, locale_lang, localized)
 
-                res.append(info)
+                yield rpath, info
 
         else: # order
-            done = {}
-            rest = list(rpaths)
-            while rest:
-                rpath = rest.pop(0)
-                if done.has_key(rpath):
+            # Range scan of the preorder positions (see TreePositions)
+            root = self.getRoot()
+            if prefix is None or (root+'/').startswith(prefix+'/'):
+                key = ()
+            else:
+                key = self._positions.get(prefix)
+            if key is None:
+                positions = ()
+            else:
+                positions = TreePositions(self).iterPositions(
+                    key, stop_depth, after)
+            for subkey, rpath in positions:
+                node = structure.get(rpath)
+                info = infos.get(rpath)
+                if node is None or info is None:
+                    # Inconsistent tree, don't break completely
                     continue
 
-                # The todo list is a list of paths to process in order,
-                # with their children.
-                todo = [rpath]
-                while todo:
-                    rpath = todo.pop(0)
-                    if done.has_key(rpath):
-                        continue
-                    done[rpath] = None
-                    info = infos.get(rpath)
-                    if info is None:
-                        # Inconsistent tree, don't break completely
-                        continue
-
-                    # update todo list if appropriate before any filering
-                    # so that discarding doesn't break order
-                    # Process children in order (depth first)
-                    depth = info['depth']
-                    children = info['children']
-                    if depth < stop_depth:
-                        todo = children + todo
-
-                    # Check depth (second statement there for safety)
-                    if depth < start_depth or depth > stop_depth:
-                        continue
-
-                    # Check visibility filter
-                    visible = intersects(info['allowed_roles_and_users'],
-                                         whoami)
-                    if filter and not visible:
-                        continue
-
-                    # Keep it
-                    info = info.copy()
-                    info['visible'] = visible
-                    del info['children']
-
-                    res.append(info)
+                # Check depth
+                depth = node.depth
+                if depth < start_depth or depth > stop_depth:
+                    continue
 
+                # Check visibility filter
+                visible = intersects(info[ALLOWED_KEY], whoami_ids)
+                if filter and not visible:
+                    continue
 
+                # Keep it
+                info = info.copy()
+                info['visible'] = visible
+                info['depth'] = depth
+                info['nb_children'] = len(node.children)
+                info['allowed_roles_and_users'] = [
+                    names[id] for id in info.pop(ALLOWED_KEY)]
+                info.pop(VIEW_KEY, None)
+                localized = info.pop(LOCALIZED_KEY, None)
+                if locale_keys is not None:
+                    self._localize(info, locale_keys, locale_lang, localized)
+
+                yield subkey, info
+
+    def _computeList(self, prefix, start_depth, stop_depth, filter, order,
+                     count_children, locale_keys, locale_lang, whoami):
+        """Compute the results of getList for the given principals."""
+        res = [info for position, info
+               in self._iterList(prefix, start_depth, stop_depth, filter,
+                                 order, locale_keys, locale_lang, whoami)]
 
         if count_children and (filter or stop_depth != 999):
             # Compute nb_children for each level
@@ -755,11 +1647,6 @@ class TreeCache(SimpleItemWithProperties):
             for info in res:
                 info['nb_children'] = counters.get(info['rpath'], 0)
 
-
-        # Check locale
-        if locale_keys is not None:
-            res = [self._localize(info, locale_keys, locale_lang)
-                    for info in res]
         return res
 
     #
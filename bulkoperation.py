@@ -0,0 +1,199 @@
+# -*- coding: iso-8859-15 -*-
+# (C) Copyright 2012 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Bulk operations.
+
+Mass imports, pastes or migrations make each object trigger its own
+indexation, tree cache update and events. During a bulk operation:
+
+- the IndexationManager queues objects to (re)index by path only, to be
+  processed in one batch, in path order;
+
+- the TreeCacheManager only records the touched paths, and rebuilds
+  each touched subtree once at the end;
+
+- the event service coalesces the modification events of each object
+  (COALESCED_EVENTS), and dispatches them at the end. Other events are
+  dispatched right away.
+
+Usage::
+
+  bulk = start_bulk_operation()
+  try:
+      ... do the work ...
+  except:
+      bulk.abort()
+      raise
+  bulk.finish()
+
+or, with Python >= 2.5::
+
+  with bulk_operation():
+      ... do the work ...
+
+The catch-up is done by finish(), or at commit if it hasn't been
+called. With commit_every, finish() commits the transaction, then
+processes the queued indexations in further transactions of that many
+objects each.
+
+A bulk operation is bound to the transaction it's started in.
+"""
+
+import logging
+import transaction
+
+from Acquisition import aq_base
+
+from Products.CPSCore.commithooks import get_before_commit_subscribers_manager
+from Products.CPSCore.IndexationManager import get_indexation_manager
+from Products.CPSCore.TreeCacheManager import get_treecache_manager
+
+_TXN_BULK_ATTRIBUTE = '_cps_bulk_operation'
+
+# Before the IndexationManager, so that the events dispatched at commit
+# can still queue indexations
+_TXN_MGR_ORDER = -200
+
+# Events coalesced per object during a bulk operation
+COALESCED_EVENTS = ('sys_modify_object', 'modify_object',
+                    'sys_modify_security', 'sys_order_object')
+
+logger = logging.getLogger('CPSCore.bulkoperation')
+
+
+class BulkOperation(object):
+    """Suspends per-object maintenance during a bulk operation."""
+
+    def __init__(self, commit_every=None):
+        self.commit_every = commit_every
+        self._active = False
+        self._events = []
+        self._event_keys = {}
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.finish()
+        else:
+            self.abort()
+        return False
+
+    def start(self):
+        """Put the managers of the transaction in bulk mode."""
+        if self._active:
+            raise ValueError("Bulk operation already started")
+        txn = transaction.get()
+        if getattr(txn, _TXN_BULK_ATTRIBUTE, None) is not None:
+            raise ValueError("A bulk operation is already running")
+        setattr(txn, _TXN_BULK_ATTRIBUTE, self)
+        self._active = True
+        get_indexation_manager().startBulk()
+        get_treecache_manager().startBulk()
+        get_before_commit_subscribers_manager().addSubscriber(
+            self._beforeCommit, order=_TXN_MGR_ORDER)
+        logger.debug("started")
+
+    def isActive(self):
+        return self._active
+
+    def recordEvent(self, evtool, event_type, ob, infos):
+        """Record an event sent to evtool during the operation.
+
+        Returns False if the event has to be dispatched right away.
+        """
+        if not self._active or event_type not in COALESCED_EVENTS:
+            return False
+        key = (id(aq_base(evtool)), event_type, ob.getPhysicalPath())
+        if key not in self._event_keys:
+            self._event_keys[key] = None
+            self._events.append((evtool, event_type, ob, infos))
+        return True
+
+    def finish(self):
+        """End the operation and catch up."""
+        if not self._active:
+            return
+        self._catchUp()
+        if self.commit_every:
+            self._commitIndexations(self.commit_every)
+
+    def abort(self):
+        """End the operation without catching up.
+
+        The transaction is expected to be aborted.
+        """
+        if not self._active:
+            return
+        self._stop()
+        self._events = []
+        self._event_keys = {}
+        get_indexation_manager().endBulk()
+        get_treecache_manager().endBulk()
+        logger.debug("aborted")
+
+    def _stop(self):
+        self._active = False
+        txn = transaction.get()
+        if getattr(txn, _TXN_BULK_ATTRIBUTE, None) is self:
+            setattr(txn, _TXN_BULK_ATTRIBUTE, None)
+
+    def _catchUp(self):
+        """Dispatch the recorded events and end the managers bulk mode."""
+        self._stop()
+        events = self._events
+        self._events = []
+        self._event_keys = {}
+        logger.debug("catching up: %s events", len(events))
+        for evtool, event_type, ob, infos in events:
+            evtool.notify(event_type, ob, infos)
+        get_treecache_manager().endBulk()
+        get_indexation_manager().endBulk()
+
+    def _beforeCommit(self):
+        if self._active:
+            self._catchUp()
+
+    def _commitIndexations(self, size):
+        """Process the queued indexations in transactions of size objects.
+        """
+        queue, root = get_indexation_manager().detachQueue()
+        transaction.commit()
+        for start in xrange(0, len(queue), size):
+            logger.debug("indexing %s/%s", start, len(queue))
+            get_indexation_manager().attachQueue(queue[start:start+size],
+                                                 root)
+            transaction.commit()
+
+
+def get_bulk_operation():
+    """Get the bulk operation running in the current transaction, or None.
+    """
+    return getattr(transaction.get(), _TXN_BULK_ATTRIBUTE, None)
+
+def start_bulk_operation(commit_every=None):
+    """Start a bulk operation and return it."""
+    bulk = BulkOperation(commit_every)
+    bulk.start()
+    return bulk
+
+def bulk_operation(commit_every=None):
+    """Return a bulk operation to be used with the with statement."""
+    return BulkOperation(commit_every)
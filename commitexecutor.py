@@ -0,0 +1,307 @@
+# -*- coding: iso-8859-15 -*-
+# (C) Copyright 2012 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Background executor for after commit subscribers.
+
+After commit subscribers registered with background=True (see
+AfterCommitSubscribersManager.addSubscriber) are handed to a process wide
+pool of worker threads instead of being run by the thread that committed,
+so that the response doesn't wait for them.
+
+This is meant for subscribers having non ZODB side effects only (sending
+mails, purging caches, notifying external services): they run outside of
+any request and transaction, and must not use persistent objects.
+
+The executor is disabled by default, in which case background subscribers
+are run inline as before. Enable it at startup with::
+
+  from Products.CPSCore.commitexecutor import get_after_commit_executor
+  get_after_commit_executor().enable(workers=2)
+
+Properties:
+
+- The queue is bounded. When it is full, the committing thread waits up to
+  `put_timeout` seconds for a slot, then runs the subscriber inline
+  (back-pressure instead of unbounded memory growth).
+
+- Each call taking more than `call_timeout` seconds is logged. Python
+  threads can't be interrupted, so the call is not aborted; the calls
+  currently running and for how long can be seen with getRunning().
+
+- Errors are logged and don't stop the worker.
+
+- On shutdown (atexit), the executor waits at most `drain_timeout`
+  seconds for the queued and running calls to be done; what is left is
+  logged and dropped.
+
+- The counters (submitted, executed, errors, overruns, rejected) are
+  updated under a lock, as the workers update them concurrently.
+
+- With a single worker, subscribers are executed in the order they were
+  submitted.
+"""
+
+import atexit
+import logging
+import threading
+import Queue
+from time import time
+
+from Products.CPSCore.commitprofiler import subscriber_name
+
+logger = logging.getLogger('CPSCore.commitexecutor')
+
+DEFAULT_WORKERS = 1
+DEFAULT_QUEUE_SIZE = 1000
+DEFAULT_PUT_TIMEOUT = 1.0
+DEFAULT_CALL_TIMEOUT = 30.0
+DEFAULT_DRAIN_TIMEOUT = 10.0
+
+# Worker stop marker
+_STOP = object()
+
+
+class AfterCommitExecutor(object):
+    """Bounded pool of threads running after commit subscribers."""
+
+    def __init__(self):
+        self.enabled = False
+        self.workers = DEFAULT_WORKERS
+        self.queue_size = DEFAULT_QUEUE_SIZE
+        self.put_timeout = DEFAULT_PUT_TIMEOUT
+        self.call_timeout = DEFAULT_CALL_TIMEOUT
+        self.drain_timeout = DEFAULT_DRAIN_TIMEOUT
+        self._lock = threading.Lock()
+        # Protects the counters, and signals when no call is unfinished
+        self._tasks = threading.Condition(threading.Lock())
+        self._unfinished = 0 # calls queued or running
+        self._queue = None
+        self._threads = []
+        self._running = {} # thread name -> (subscriber name, start)
+        self._atexit_registered = False
+        self.submitted = 0
+        self.executed = 0
+        self.errors = 0
+        self.overruns = 0
+        self.rejected = 0
+
+    def enable(self, workers=None, queue_size=None, put_timeout=None,
+               call_timeout=None, drain_timeout=None):
+        """Enable the executor, with optional new settings.
+
+        Worker threads are started on the first submission.
+        """
+        self._lock.acquire()
+        try:
+            if workers is not None:
+                self.workers = workers
+            if queue_size is not None:
+                self.queue_size = queue_size
+            if put_timeout is not None:
+                self.put_timeout = put_timeout
+            if call_timeout is not None:
+                self.call_timeout = call_timeout
+            if drain_timeout is not None:
+                self.drain_timeout = drain_timeout
+            self.enabled = True
+        finally:
+            self._lock.release()
+
+    def disable(self):
+        """Disable the executor, draining what is already queued."""
+        self.enabled = False
+        self.drain()
+
+    def isEnabled(self):
+        return self.enabled
+
+    def _start(self):
+        # Called with the lock held
+        self._queue = Queue.Queue(self.queue_size)
+        self._threads = []
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work,
+                                      args=(self._queue,),
+                                      name='CPSAfterCommitWorker-%d' % i)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+        if not self._atexit_registered:
+            atexit.register(self.drain)
+            self._atexit_registered = True
+
+    def _count(self, counter):
+        self._tasks.acquire()
+        try:
+            setattr(self, counter, getattr(self, counter) + 1)
+        finally:
+            self._tasks.release()
+
+    def _taskDone(self, count=1):
+        # Same as Queue.task_done(), which Python 2.4 doesn't have
+        self._tasks.acquire()
+        try:
+            self._unfinished -= count
+            if self._unfinished <= 0:
+                self._unfinished = 0
+                self._tasks.notifyAll()
+        finally:
+            self._tasks.release()
+
+    def submit(self, subscriber, args=(), kws=None):
+        """Queue a call for the workers.
+
+        Return False if the call has not been queued, because the
+        executor is disabled or its queue stayed full for too long; the
+        caller is then expected to make the call itself.
+        """
+        if not self.enabled:
+            return False
+        if kws is None:
+            kws = {}
+        self._lock.acquire()
+        try:
+            if self._queue is None:
+                self._start()
+            queue = self._queue
+        finally:
+            self._lock.release()
+        self._tasks.acquire()
+        try:
+            self._unfinished += 1
+        finally:
+            self._tasks.release()
+        try:
+            queue.put((subscriber, args, kws), True, self.put_timeout)
+        except Queue.Full:
+            self._taskDone()
+            self._count('rejected')
+            logger.warning("Queue full, running %s inline",
+                           subscriber_name(subscriber))
+            return False
+        self._count('submitted')
+        return True
+
+    def _work(self, queue):
+        me = threading.currentThread().getName()
+        while True:
+            item = queue.get()
+            if item is _STOP:
+                return
+            subscriber, args, kws = item
+            name = subscriber_name(subscriber)
+            start = time()
+            self._running[me] = (name, start)
+            try:
+                try:
+                    subscriber(*args, **kws)
+                except Exception:
+                    self._count('errors')
+                    logger.exception("Error in background subscriber %s",
+                                     name)
+            finally:
+                del self._running[me]
+                self._count('executed')
+                elapsed = time() - start
+                if (self.call_timeout is not None
+                    and elapsed > self.call_timeout):
+                    self._count('overruns')
+                    logger.warning("Background subscriber %s took %.3fs "
+                                   "(timeout is %ss)", name, elapsed,
+                                   self.call_timeout)
+                self._taskDone()
+
+    def getRunning(self):
+        """Return the (thread, subscriber, seconds) of the running calls.
+        """
+        now = time()
+        res = [(thread, name, now - start)
+               for thread, (name, start) in self._running.items()]
+        res.sort()
+        return res
+
+    def getQueueSize(self):
+        queue = self._queue
+        if queue is None:
+            return 0
+        return queue.qsize()
+
+    def drain(self, timeout=None):
+        """Stop the workers once they've run what is queued.
+
+        Waits at most `timeout` seconds (default drain_timeout) for the
+        queued calls and the ones already taken by a worker to be done.
+        Return the number of calls that were not done. The workers are
+        started again by the next submission if the executor is enabled.
+        """
+        if timeout is None:
+            timeout = self.drain_timeout
+        self._lock.acquire()
+        try:
+            queue, threads = self._queue, self._threads
+            self._queue = None
+            self._threads = []
+        finally:
+            self._lock.release()
+        if queue is None:
+            return 0
+
+        deadline = time() + timeout
+        tasks = self._tasks
+        tasks.acquire()
+        try:
+            while self._unfinished:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    break
+                tasks.wait(remaining)
+        finally:
+            tasks.release()
+
+        for thread in threads:
+            try:
+                queue.put(_STOP, True, max(deadline - time(), 0))
+            except Queue.Full:
+                break
+        for thread in threads:
+            thread.join(max(deadline - time(), 0))
+
+        left = 0
+        while True:
+            try:
+                item = queue.get_nowait()
+            except Queue.Empty:
+                break
+            if item is not _STOP:
+                left += 1
+        if left:
+            self._taskDone(left)
+            logger.error("Dropped %d background subscribers calls not "
+                         "executed after %ss", left, timeout)
+        running = self.getRunning()
+        for thread, name, seconds in running:
+            logger.error("Background subscriber %s still running in %s "
+                         "after %.3fs", name, thread, seconds)
+        return left + len(running)
+
+
+_executor = AfterCommitExecutor()
+
+def get_after_commit_executor():
+    """Return the process wide after commit executor."""
+    return _executor
@@ -40,20 +40,27 @@ subcscribers :
 """
 
 import logging
-import bisect
+import heapq
 
 import transaction
 import zope.interface
 from ZODB.loglevels import TRACE
+from transaction.interfaces import IDataManager
+from transaction.interfaces import ISavepointDataManager
+from transaction.interfaces import IDataManagerSavepoint
 
 from Products.CPSCore.interfaces import ICommitSubscriber
 from Products.CPSCore.interfaces import IBeforeCommitSubscriber
 from Products.CPSCore.interfaces import IAfterCommitSubscriber
 from Products.CPSCore.interfaces import IZODBBeforeCommitHook
 from Products.CPSCore.interfaces import IZODBAfterCommitHook
+from Products.CPSCore.commitprofiler import get_commit_profiler
+from Products.CPSCore.commitprofiler import BEFORE_COMMIT, AFTER_COMMIT
+from Products.CPSCore.commitexecutor import get_after_commit_executor
 
 _CPS_BCH_TXN_ATTRIBUTE = '_cps_before_commit_hooks_manager'
 _CPS_ACH_TXN_ATTRIBUTE = '_cps_after_commit_hooks_manager'
+_CPS_FLUSHERS_TXN_ATTRIBUTE = '_cps_savepoint_flushers'
 
 
 class Logger(object):
@@ -77,10 +84,18 @@ class CommitSubscriber(object):
     # XXX This may be monkey-patched by unit-tests.
     DEFAULT_SYNC = False
 
+    # Not flushed at savepoints by default
+    # XXX This may be monkey-patched by unit-tests or at startup.
+    DEFAULT_FLUSH_AT_SAVEPOINT = False
+
+    _flusher = None
+
     def __init__(self, mgr, order=0):
         self._sync = self.DEFAULT_SYNC
         self.enabled = True
         mgr.addSubscriber(self, order=order)
+        if self.DEFAULT_FLUSH_AT_SAVEPOINT:
+            self.setFlushAtSavepoint(True)
 
     def setSynchronous(self, sync):
         if sync:
@@ -102,6 +117,109 @@ class CommitSubscriber(object):
     def disable(self):
         self.enabled = False
 
+    def setFlushAtSavepoint(self, flush):
+        """Set whether the queue is flushed at each savepoint.
+
+        Long batch jobs taking savepoints with savepoint() then don't
+        accumulate the queue until commit. If a savepoint is rolled back,
+        the work queued after it is dropped (see SavepointFlusher).
+        """
+        if flush and self._flusher is None:
+            txn = transaction.get()
+            self._flusher = SavepointFlusher(self)
+            txn.join(self._flusher)
+            flushers = getattr(txn, _CPS_FLUSHERS_TXN_ATTRIBUTE, None)
+            if flushers is None:
+                flushers = []
+                setattr(txn, _CPS_FLUSHERS_TXN_ATTRIBUTE, flushers)
+            flushers.append(self._flusher)
+        if self._flusher is not None:
+            self._flusher.active = bool(flush)
+
+    def isFlushAtSavepoint(self):
+        return self._flusher is not None and self._flusher.active
+
+    def _getSavepointState(self):
+        """Get a copy of the queue, to restore if a savepoint is rolled back.
+        """
+        raise NotImplementedError
+
+    def _restoreSavepointState(self, state):
+        raise NotImplementedError
+
+    def _flushAtSavepoint(self):
+        self()
+
+class SavepointFlusher(object):
+    """Data manager flushing a commit subscriber at savepoints.
+
+    It doesn't take part in the two-phase commit. The savepoint()
+    function of this module flushes the subscriber before taking the
+    transaction savepoint, so that the savepoint includes the flushed
+    work whatever the data managers it touches. The data manager saves
+    the queue of the subscriber at each savepoint, and restores it if
+    the savepoint is rolled back: the work queued after it is dropped,
+    the flushed work is kept.
+    """
+    zope.interface.implements(IDataManager, ISavepointDataManager)
+
+    def __init__(self, subscriber):
+        self.subscriber = subscriber
+        self.active = True
+        self.transaction_manager = transaction.manager
+        # Set during a flush, savepoints taken by it don't flush again
+        self._flushing = False
+
+    def flush(self):
+        if not self.active or self._flushing:
+            return
+        self._flushing = True
+        try:
+            self.subscriber._flushAtSavepoint()
+        finally:
+            self._flushing = False
+
+    def savepoint(self):
+        subscriber = self.subscriber
+        if not self.active:
+            return SavepointFlusherSavepoint(subscriber, None)
+        return SavepointFlusherSavepoint(subscriber,
+                                         subscriber._getSavepointState())
+
+    def sortKey(self):
+        return 'CPSCore.commithooks.SavepointFlusher:%d' % id(self)
+
+    def abort(self, txn):
+        pass
+
+    def tpc_begin(self, txn):
+        pass
+
+    def commit(self, txn):
+        pass
+
+    def tpc_vote(self, txn):
+        pass
+
+    def tpc_finish(self, txn):
+        pass
+
+    def tpc_abort(self, txn):
+        pass
+
+class SavepointFlusherSavepoint(object):
+    """Restores the queue of a subscriber saved at a savepoint.
+    """
+    zope.interface.implements(IDataManagerSavepoint)
+
+    def __init__(self, subscriber, state):
+        self.subscriber = subscriber
+        self.state = state
+
+    def rollback(self):
+        if self.state is not None:
+            self.subscriber._restoreSavepointState(self.state)
+
 class BeforeCommitSubscriber(CommitSubscriber):
     """Before commit subscriber definition
     """
@@ -131,21 +249,25 @@ class BeforeCommitSubscribersManager(BeforeCommitSubscriber):
         self._sync = self.DEFAULT_SYNC
         self.enabled = True
 
-        # List of (order, index, hook, args, kws) tuples added by
-        # addbeforeCommitHook().  `index` is used to resolve ties on equal
-        # `order` values, preserving the order in which the hooks were
-        # registered.  Each time we append a tuple to _before_commit,
+        # Heap (see heapq) of [order, index, hook, args, kws, key] lists
+        # added by addbeforeCommitHook().  `index` is used to resolve ties on
+        # equal `order` values, preserving the order in which the hooks
+        # were registered.  Each time we push an entry to _before_commit,
         # the current value of _before_commit_index is used for the
-        # index, and then the latter is incremented by 1.
+        # index, and then the latter is incremented by 1.  Since indexes
+        # are unique, hooks themselves are never compared.
         self._before_commit = []
         self._before_commit_index = 0
+        # Coalescing key -> queued entry, for registrations made with a key
+        self._before_commit_keys = {}
         txn.addBeforeCommitHook(self)
 
         logger = logging.getLogger(
             "CPSCore.commithooks.BeforeCommitSubscribersManager")
         self.log = Logger(logger)
 
-    def addSubscriber(self, subscriber, args=(), kws=None, order=0):
+    def addSubscriber(self, subscriber, args=(), kws=None, order=0,
+                      key=None, merge=None):
         """Register a subscriber to call before the transaction is committed.
 
         The specified subscriber function will be called after the
@@ -170,6 +292,16 @@ class BeforeCommitSubscribersManager(BeforeCommitSubscriber):
         was registered first.  When two subscribers are registered
         with the same order, the first one registered is called first.
 
+        If a hashable `key` is given, registrations made with the same
+        key are coalesced: as long as the first one has not been
+        executed, the next ones do not queue a new call.  The queued
+        entry keeps its position.  If `merge` is given, it is called as
+        merge(queued_args, queued_kws, args, kws) and must return the new
+        (args, kws) of the queued entry; by default, the queued entry is
+        kept as is.  Keys are shared by all the subscribers of the
+        manager, so they should identify the subscriber as well, e.g.
+        (subscriber, rpath).
+
         Subscribers are called only for a top-level commit.  A
         subtransaction commit or savepoint creation does not call any
         subscribers.  If the transaction is aborted, subscribers are
@@ -189,8 +321,8 @@ class BeforeCommitSubscribersManager(BeforeCommitSubscriber):
         # new one, and then be activated again and start adding some
         # again.
         if not self.enabled:
-            self.log.trace("Won't register %s with %s and %s with order %s"
-                         %(repr(subscriber), args, kws, str(order)))
+            self.log.trace("Won't register %r with %s and %s with order %s",
+                           subscriber, args, kws, order)
             return
 
         if not isinstance(order, int):
@@ -200,16 +332,29 @@ class BeforeCommitSubscribersManager(BeforeCommitSubscriber):
             kws = {}
 
         if self.isSynchronous():
-            self.log.trace("Executes %s with %s and %s" %
-                           (repr(subscriber), args, kws))
+            self.log.trace("Executes %r with %s and %s",
+                           subscriber, args, kws)
             subscriber(*args, **kws)
             return
 
-        self.log.trace("Register %s with %s and %s with order %s"
-                       %(repr(subscriber), args, kws, str(order)))
-        bisect.insort(self._before_commit, (order, self._before_commit_index,
-                                            subscriber, tuple(args), kws))
+        self.log.trace("Register %r with %s and %s with order %s",
+                       subscriber, args, kws, order)
+        if key is not None:
+            entry = self._before_commit_keys.get(key)
+            if entry is not None:
+                if merge is not None:
+                    args, kws = merge(entry[3], entry[4], tuple(args), kws)
+                    entry[3] = tuple(args)
+                    entry[4] = kws
+                self.log.trace("Coalesced %r with %s and %s on key %r",
+                               subscriber, entry[3], entry[4], key)
+                return
+        entry = [order, self._before_commit_index,
+                 subscriber, tuple(args), kws, key]
+        heapq.heappush(self._before_commit, entry)
         self._before_commit_index += 1
+        if key is not None:
+            self._before_commit_keys[key] = entry
 
     def __call__(self):
 
@@ -222,11 +367,23 @@ class BeforeCommitSubscribersManager(BeforeCommitSubscriber):
         """
         self.log.trace("__call__")
 
-        while self._before_commit:
-            order, index, subscriber, args, kws = self._before_commit.pop(0)
-            self.log.trace("Executes %s with %s and %s" %
-                           (repr(subscriber), args, kws))
-            subscriber(*args, **kws)
+        record = get_commit_profiler().startPhase(BEFORE_COMMIT,
+                                                  len(self._before_commit))
+        try:
+            while self._before_commit:
+                order, index, subscriber, args, kws, key = heapq.heappop(
+                    self._before_commit)
+                if key is not None:
+                    del self._before_commit_keys[key]
+                self.log.trace("Executes %r with %s and %s",
+                               subscriber, args, kws)
+                if record is None:
+                    subscriber(*args, **kws)
+                else:
+                    record.call(subscriber, args, kws)
+        finally:
+            if record is not None:
+                get_commit_profiler().endPhase(record)
         self._before_commit_index = 0
 
         self.log.trace("__call__ done")
@@ -243,21 +400,25 @@ class AfterCommitSubscribersManager(AfterCommitSubscriber):
         self._sync = self.DEFAULT_SYNC
         self.enabled = True
 
-        # List of (order, index, hook, args, kws) tuples added by
-        # addAfterCommitHook().  `index` is used to resolve ties on equal
-        # `order` values, preserving the order in which the hooks were
-        # registered.  Each time we append a tuple to _before_commit,
-        # the current value of _before_commit_index is used for the
-        # index, and then the latter is incremented by 1.
+        # Heap (see heapq) of [order, index, hook, args, kws, key,
+        # background] lists added by addAfterCommitHook().  `index` is
+        # used to resolve ties on equal `order` values, preserving the
+        # order in which the hooks were registered.  Each time we push an
+        # entry to _after_commit, the current value of _after_commit_index
+        # is used for the index, and then the latter is incremented by 1.
+        # Since indexes are unique, hooks themselves are never compared.
         self._after_commit = []
         self._after_commit_index = 0
+        # Coalescing key -> queued entry, for registrations made with a key
+        self._after_commit_keys = {}
         txn.addAfterCommitHook(self)
 
         logger = logging.getLogger(
             "CPSCore.commithooks.AfterCommitSubscribersManager")
         self.log = Logger(logger)
 
-    def addSubscriber(self, subscriber, args=(), kws=None, order=0):
+    def addSubscriber(self, subscriber, args=(), kws=None, order=0,
+                      key=None, merge=None, background=False):
         """Register a subscriber to call after a transaction commit attempt.
 
          The specified subscriber function will be called after the
@@ -284,6 +445,22 @@ class AfterCommitSubscribersManager(AfterCommitSubscriber):
          registered first.  When two hooks are registered with the
          same order, the first one registered is called first.
 
+         If a hashable `key` is given, registrations made with the same
+         key are coalesced: as long as the first one has not been
+         executed, the next ones do not queue a new call.  The queued
+         entry keeps its position.  If `merge` is given, it is called as
+         merge(queued_args, queued_kws, args, kws) and must return the new
+         (args, kws) of the queued entry; by default, the queued entry is
+         kept as is.  Keys are shared by all the subscribers of the
+         manager, so they should identify the subscriber as well, e.g.
+         (subscriber, rpath).
+
+         If `background` is true and the after commit executor is
+         enabled (see commitexecutor), the subscriber is run by a worker
+         thread instead, so that the response doesn't wait for it.  Such
+         a subscriber runs outside of any transaction and must not use
+         persistent objects.
+
          This method can also be called from a subscriber:
          an executing subscriber can register more subscribers.
          Applications should take care to avoid creating infinite
@@ -306,8 +483,8 @@ class AfterCommitSubscribersManager(AfterCommitSubscriber):
         # new one, and then be activated again and start adding some
         # again.
         if not self.enabled:
-            self.log.trace("Won't register %s with %s and %s with order %s"
-                         %(repr(subscriber), args, kws, str(order)))
+            self.log.trace("Won't register %r with %s and %s with order %s",
+                           subscriber, args, kws, order)
             return
 
         if not isinstance(order, int):
@@ -317,17 +494,30 @@ class AfterCommitSubscribersManager(AfterCommitSubscriber):
             kws = {}
 
         if self.isSynchronous():
-            self.log.trace("Executes %s with %s and %s" %
-                           (repr(subscriber), args, kws))
+            self.log.trace("Executes %r with %s and %s",
+                           subscriber, args, kws)
             # False for the fact the the transaction hasn't been commited
             subscriber(False, *args, **kws)
             return
 
-        self.log.trace("Register %s with %s and %s with order %s"
-                       %(repr(subscriber), args, kws, str(order)))
-        bisect.insort(self._after_commit, (order, self._after_commit_index,
-                                           subscriber, tuple(args), kws))
+        self.log.trace("Register %r with %s and %s with order %s",
+                       subscriber, args, kws, order)
+        if key is not None:
+            entry = self._after_commit_keys.get(key)
+            if entry is not None:
+                if merge is not None:
+                    args, kws = merge(entry[3], entry[4], tuple(args), kws)
+                    entry[3] = tuple(args)
+                    entry[4] = kws
+                self.log.trace("Coalesced %r with %s and %s on key %r",
+                               subscriber, entry[3], entry[4], key)
+                return
+        entry = [order, self._after_commit_index,
+                 subscriber, tuple(args), kws, key, background]
+        heapq.heappush(self._after_commit, entry)
         self._after_commit_index += 1
+        if key is not None:
+            self._after_commit_keys[key] = entry
 
     def __call__(self, status=True):
         """Execute the registred subscribers
@@ -341,11 +531,29 @@ class AfterCommitSubscribersManager(AfterCommitSubscriber):
         """
         self.log.trace("__call__")
 
-        while self._after_commit:
-            order, index, subscriber, args, kws = self._after_commit.pop(0)
-            self.log.trace("Executes %s with %s and %s" %
-                           (repr(subscriber), args, kws))
-            subscriber(status, *args, **kws)
+        executor = get_after_commit_executor()
+        record = get_commit_profiler().startPhase(AFTER_COMMIT,
+                                                  len(self._after_commit))
+        try:
+            while self._after_commit:
+                (order, index, subscriber, args, kws, key,
+                 background) = heapq.heappop(self._after_commit)
+                if key is not None:
+                    del self._after_commit_keys[key]
+                if background and executor.submit(subscriber,
+                                                  (status,) + args, kws):
+                    self.log.trace("Queued %r with %s and %s",
+                                   subscriber, args, kws)
+                    continue
+                self.log.trace("Executes %r with %s and %s",
+                               subscriber, args, kws)
+                if record is None:
+                    subscriber(status, *args, **kws)
+                else:
+                    record.call(subscriber, (status,) + args, kws)
+        finally:
+            if record is not None:
+                get_commit_profiler().endPhase(record)
         self._after_commit_index = 0
 
         self.log.trace("__call__ done")
@@ -385,3 +593,17 @@ def get_after_commit_subscribers_manager():
         mgr = AfterCommitSubscribersManager(txn)
         setattr(txn, _CPS_ACH_TXN_ATTRIBUTE, mgr)
     return mgr
+
+def savepoint(optimistic=False):
+    """Take a savepoint of the current transaction.
+
+    The commit subscribers that flush at savepoints (see
+    CommitSubscriber.setFlushAtSavepoint) are flushed first, so that
+    their work is part of the savepoint. Savepoints taken directly with
+    transaction.savepoint(), e.g. by the subtransactions of a catalog,
+    don't flush them.
+    """
+    txn = transaction.get()
+    for flusher in list(getattr(txn, _CPS_FLUSHERS_TXN_ATTRIBUTE, ())):
+        flusher.flush()
+    return txn.savepoint(optimistic)
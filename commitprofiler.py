@@ -0,0 +1,261 @@
+# -*- coding: iso-8859-15 -*-
+# (C) Copyright 2012 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Profiler for the commit subscribers managers.
+
+The before and after commit subscribers managers report, for each
+transaction, the wall time spent in each subscriber, how many times it
+has been called and the size of its own queue (for subscribers that
+provide a ``queueSize()`` method, such as the IndexationManager).
+
+The profiler is process wide. It keeps rolling aggregates over the last
+transactions (median, 95th percentile and max of the time spent per
+transaction) and logs a warning for each commit phase that takes longer
+than a configurable threshold.
+
+It is enabled by default (see DEFAULT_ENABLED), and can be disabled from
+the 'Commit Profile' tab of portal_eventservice.
+
+Recording is cheap (two calls to time() per subscriber and a short locked
+section per transaction), percentiles are only computed when the
+statistics are read.
+"""
+
+import logging
+import threading
+from time import time
+
+logger = logging.getLogger('CPSCore.commitprofiler')
+
+# Whether commits are profiled when the process starts
+DEFAULT_ENABLED = True
+
+# Number of transactions the rolling aggregates are computed on
+DEFAULT_WINDOW = 1000
+
+# Commit phases taking longer than this (seconds) are logged
+DEFAULT_SLOW_THRESHOLD = 2.0
+
+BEFORE_COMMIT = 'before_commit'
+AFTER_COMMIT = 'after_commit'
+
+TOTAL = '(total)'
+
+
+def subscriber_name(subscriber):
+    """Return a stable dotted name for a subscriber, to aggregate on."""
+    im_self = getattr(subscriber, 'im_self', None)
+    if im_self is not None:
+        klass = im_self.__class__
+        return '%s.%s.%s' % (klass.__module__, klass.__name__,
+                             subscriber.__name__)
+    name = getattr(subscriber, '__name__', None)
+    if name is not None:
+        return '%s.%s' % (getattr(subscriber, '__module__', '?'), name)
+    klass = subscriber.__class__
+    return '%s.%s' % (klass.__module__, klass.__name__)
+
+
+def percentile(values, ratio):
+    """Return the given percentile (ratio between 0 and 1) of sorted values.
+    """
+    if not values:
+        return 0.0
+    pos = int(round(ratio * (len(values) - 1)))
+    return values[pos]
+
+
+class RollingStatistics(object):
+    """Aggregates about the last ``window`` transactions for one key.
+
+    Values are kept in a fixed size ring buffer. The number of
+    transactions and calls and the largest queue size are counted since
+    the creation.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.values = []
+        self.pos = 0
+        self.transactions = 0
+        self.calls = 0
+        self.queue_max = 0
+
+    def add(self, elapsed, calls, queue_size):
+        if len(self.values) < self.window:
+            self.values.append(elapsed)
+        else:
+            self.values[self.pos] = elapsed
+            self.pos = (self.pos + 1) % self.window
+        self.transactions += 1
+        self.calls += calls
+        if queue_size is not None and queue_size > self.queue_max:
+            self.queue_max = queue_size
+
+    def summary(self):
+        values = sorted(self.values)
+        if values:
+            max = values[-1]
+        else:
+            max = 0.0
+        return {
+            'transactions': self.transactions,
+            'calls': self.calls,
+            'queue_max': self.queue_max,
+            'p50': percentile(values, 0.5),
+            'p95': percentile(values, 0.95),
+            'max': max,
+            }
+
+
+class PhaseRecord(object):
+    """What happened in one commit phase of one transaction."""
+
+    def __init__(self, phase, queue_size):
+        self.phase = phase
+        self.queue_size = queue_size
+        self.start = time()
+        self.entries = {} # name -> [calls, elapsed, queue size]
+
+    def call(self, subscriber, args, kws):
+        """Call a subscriber, recording how long it took."""
+        queue_size = getattr(subscriber, 'queueSize', None)
+        if queue_size is not None:
+            queue_size = queue_size()
+        start = time()
+        try:
+            subscriber(*args, **kws)
+        finally:
+            elapsed = time() - start
+            name = subscriber_name(subscriber)
+            entry = self.entries.get(name)
+            if entry is None:
+                entry = self.entries[name] = [0, 0.0, None]
+            entry[0] += 1
+            entry[1] += elapsed
+            if queue_size is not None and queue_size > entry[2]:
+                entry[2] = queue_size
+
+
+class CommitProfiler(object):
+    """Process wide profiler of the commit subscribers managers."""
+
+    def __init__(self, window=DEFAULT_WINDOW,
+                 slow_threshold=DEFAULT_SLOW_THRESHOLD):
+        self.enabled = DEFAULT_ENABLED
+        self.window = window
+        self.slow_threshold = slow_threshold
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget all statistics."""
+        self._lock.acquire()
+        try:
+            self._stats = {} # (phase, name) -> RollingStatistics
+            self.slow_commits = 0
+        finally:
+            self._lock.release()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def setSlowThreshold(self, seconds):
+        """Set the duration above which commit phases get logged.
+
+        None disables the logging.
+        """
+        self.slow_threshold = seconds
+
+    def startPhase(self, phase, queue_size):
+        """Start recording a commit phase.
+
+        Return None if the profiler is disabled.
+        """
+        if not self.enabled:
+            return None
+        return PhaseRecord(phase, queue_size)
+
+    def endPhase(self, record):
+        """Merge the record of a commit phase in the rolling aggregates."""
+        elapsed = time() - record.start
+        phase = record.phase
+        self._lock.acquire()
+        try:
+            stats = self._stats
+            total_calls = 0
+            for name, (calls, spent, queue_size) in record.entries.items():
+                key = (phase, name)
+                if key not in stats:
+                    stats[key] = RollingStatistics(self.window)
+                stats[key].add(spent, calls, queue_size)
+                total_calls += calls
+            key = (phase, TOTAL)
+            if key not in stats:
+                stats[key] = RollingStatistics(self.window)
+            stats[key].add(elapsed, total_calls, record.queue_size)
+            threshold = self.slow_threshold
+            slow = threshold is not None and elapsed > threshold
+            if slow:
+                self.slow_commits += 1
+        finally:
+            self._lock.release()
+
+        if slow:
+            details = [(spent, name, calls)
+                       for name, (calls, spent, q) in record.entries.items()]
+            details.sort()
+            details.reverse()
+            logger.warning("Slow commit (%s): %.3fs for %d subscribers; %s",
+                           phase, elapsed, record.queue_size,
+                           ', '.join(['%s: %.3fs (%d calls)' % (n, s, c)
+                                      for s, n, c in details]))
+
+    def getStatistics(self):
+        """Return the rolling aggregates, as a list of mappings.
+
+        Each mapping has the following keys: phase, subscriber,
+        transactions, calls, queue_max, p50, p95, max (durations are in
+        seconds, per transaction). p50, p95 and max are about the last
+        transactions of the window, the others since the last reset. The
+        subscriber named '(total)' is about the whole phase, and its
+        queue_max is the largest number of subscribers seen in it.
+        """
+        self._lock.acquire()
+        try:
+            items = [(key, stats.summary())
+                     for key, stats in self._stats.items()]
+        finally:
+            self._lock.release()
+        res = []
+        for (phase, name), summary in items:
+            summary['phase'] = phase
+            summary['subscriber'] = name
+            res.append(summary)
+        res.sort(key=lambda s: (s['phase'], -s['p95']))
+        return res
+
+
+_profiler = CommitProfiler()
+
+def get_commit_profiler():
+    """Return the process wide commit profiler."""
+    return _profiler
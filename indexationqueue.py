@@ -0,0 +1,245 @@
+# -*- coding: iso-8859-15 -*-
+# (C) Copyright 2012 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Deferred indexation queue.
+
+When the IndexationManager is in deferred mode, the indexations it has
+to do are not applied to the catalog at commit time but stored, in the
+same transaction, in a persistent queue held by the catalog. A worker
+then applies them in batches, out of the users' requests:
+
+- a clock server can call the processIndexationQueue method of the
+  catalog (see patch/cmf/catalog.py), each call being a transaction;
+
+- a script running in a separate ZEO client can call
+  process_indexation_queue() and commit in a loop.
+
+There is one record per path: further indexations of a path are merged
+in its record, with the same rules as in the IndexationManager, so that
+the last action wins (unindexing after indexing, or the converse).
+Records are processed in path order, unindexings first.
+
+The IndexationManager does the work on the objects themselves (such as
+updating their modification date) at commit time: the worker only
+updates the catalog, and doesn't write the objects.
+
+Records are persistent IndexationRecord kept in an OOBTree, whose
+conflict resolution allows concurrent transactions to queue different
+paths, and the size in a BTrees.Length. Concurrent transactions adding
+indexes or security to the same pending record are merged. Other
+concurrent changes of a record, such as a record being pushed again
+while it's processed, or two transactions queuing the same new path,
+raise a ConflictError.
+"""
+
+import logging
+
+from Persistence import Persistent
+from ZODB.POSException import ConflictError
+from BTrees.OOBTree import OOBTree
+from BTrees.Length import Length
+
+from Products.CPSCore.IndexationManager import ACTION_INDEX
+from Products.CPSCore.IndexationManager import ACTION_REINDEX
+from Products.CPSCore.IndexationManager import ACTION_UNINDEX
+from Products.CPSCore.IndexationManager import process_index_batch
+from Products.CPSCore.IndexationManager import get_indexation_counters
+
+logger = logging.getLogger('CPSCore.indexationqueue')
+
+_QUEUE_ATTRIBUTE = '_cps_indexation_queue'
+
+# Number of records processed by a worker call
+DEFAULT_BATCH_SIZE = 500
+
+
+def merge_idxs(idxs, other):
+    """Merge the indexes of two records of the same path.
+
+    None means no index, () all of them.
+    """
+    if other is None:
+        return idxs
+    if idxs is None:
+        return other
+    if idxs == () or other == ():
+        # Reindex everything
+        return ()
+    return idxs + tuple([idx for idx in other if idx not in idxs])
+
+
+class IndexationRecord(Persistent):
+    """Pending indexation of a path.
+
+    state is (action, idxs, secu), idxs being None or a tuple, or None
+    once the record has been processed or cancelled.
+    """
+
+    def __init__(self, state):
+        self.state = state
+
+    def _p_resolveConflict(self, old, committed, new):
+        old_state = old['state']
+        committed_state = committed['state']
+        new_state = new['state']
+        if old_state is None or committed_state is None or new_state is None:
+            raise ConflictError
+        action = old_state[0]
+        if (action == ACTION_UNINDEX or
+            not (committed_state[0] == new_state[0] == action)):
+            raise ConflictError
+        # Both added indexes or security
+        res = committed.copy()
+        res['state'] = (action,
+                        merge_idxs(committed_state[1], new_state[1]),
+                        committed_state[2] or new_state[2])
+        return res
+
+
+class IndexationQueue(Persistent):
+    """Persistent queue of indexations, one record per path.
+
+    Records are (action, idxs, secu), idxs being None or a tuple, kept
+    in IndexationRecord objects.
+    """
+
+    def __init__(self):
+        self._records = OOBTree()
+        self._length = Length()
+
+    def __len__(self):
+        return self._length()
+
+    def get(self, rpath, default=None):
+        record = self._records.get(rpath)
+        if record is None:
+            return default
+        return record.state
+
+    def push(self, rpath, action, idxs=None, secu=False):
+        """Queue an indexation of the object at rpath.
+
+        Merges with the pending record for this path, if any.
+        """
+        if idxs is not None:
+            idxs = tuple(idxs)
+        records = self._records
+        record = records.get(rpath)
+        if record is None:
+            if action == ACTION_UNINDEX:
+                state = (action, None, False)
+            else:
+                state = (action, idxs, secu)
+            records[rpath] = IndexationRecord(state)
+            self._length.change(1)
+            return
+
+        old_action, old_idxs, old_secu = record.state
+        if action == ACTION_UNINDEX:
+            if old_action == ACTION_INDEX:
+                # Created and destroyed before being indexed
+                self._remove(rpath, record)
+                return
+            new = (ACTION_UNINDEX, None, False)
+        elif old_action == ACTION_UNINDEX:
+            # Consider this as a full indexing
+            new = (ACTION_REINDEX, (), secu)
+        else:
+            new = (old_action, merge_idxs(old_idxs, idxs), old_secu or secu)
+        if new != record.state:
+            record.state = new
+
+    def getBatch(self, size=None):
+        """Return at most size (rpath, record), in path order."""
+        res = []
+        for rpath, record in self._records.items():
+            if size is not None and len(res) >= size:
+                break
+            res.append((rpath, record.state))
+        return res
+
+    def remove(self, rpath, record):
+        """Remove the record of rpath, if it is still the given one."""
+        current = self._records.get(rpath)
+        if current is not None and current.state == record:
+            self._remove(rpath, current)
+
+    def _remove(self, rpath, record):
+        # Changes of the record in concurrent transactions conflict
+        record.state = None
+        del self._records[rpath]
+        self._length.change(-1)
+
+    def clear(self):
+        self._records.clear()
+        self._length.set(0)
+
+
+def get_indexation_queue(catalog, create=True):
+    """Return the deferred indexation queue of a catalog.
+
+    Creates it if needed, unless create is false.
+    """
+    queue = getattr(catalog, _QUEUE_ATTRIBUTE, None)
+    if queue is None and create:
+        queue = IndexationQueue()
+        setattr(catalog, _QUEUE_ATTRIBUTE, queue)
+    return queue
+
+def process_indexation_queue(catalog, size=DEFAULT_BATCH_SIZE):
+    """Apply at most size records of the deferred queue of a catalog.
+
+    Doesn't commit. Returns the number of records processed.
+    """
+    queue = get_indexation_queue(catalog, create=False)
+    if queue is None:
+        return 0
+    batch = queue.getBatch(size)
+    if not batch:
+        return 0
+    logger.debug("Processing %s records", len(batch))
+
+    index = []
+    for rpath, (action, idxs, secu) in batch:
+        if action == ACTION_UNINDEX:
+            catalog.unindexCPSPath('/' + rpath)
+            get_indexation_counters()['processed'] += 1
+            continue
+        if idxs is not None:
+            idxs = list(idxs)
+        path = ('',) + tuple(rpath.split('/'))
+        info = {'object': None, 'idxs': idxs, 'secu': secu}
+        index.append((path, len(index), info))
+    process_index_batch(index, catalog.getPhysicalRoot(), prepared=True)
+
+    for rpath, record in batch:
+        queue.remove(rpath, record)
+    return len(batch)
+
+def flush_indexation_queue(catalog):
+    """Apply the whole deferred queue of a catalog now.
+
+    Meant for tests. Doesn't commit. Returns the number of records
+    processed.
+    """
+    total = 0
+    while True:
+        done = process_indexation_queue(catalog)
+        if not done:
+            return total
+        total += done
@@ -0,0 +1,169 @@
+# -*- coding: iso-8859-15 -*-
+# (C) Copyright 2012 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Statistics of the indexation.
+
+The IndexationManager and the catalog count, for each transaction (see
+IndexationManager.get_indexation_counters):
+
+- pushes: indexations and unindexations pushed to the manager,
+
+- processed: objects actually (un)indexed, or stored in the deferred
+  indexation queue,
+
+- idxs_merges: pushes merged in an indexation already queued,
+
+- cancellations: queued (re)indexings cancelled by an unindexing,
+
+- secu_reindexes: security reindexings done,
+
+- the catalog writes, and the indexes and metadata skipped because they
+  didn't change,
+
+and the time spent in each phase of the processing of the queue (TIMERS,
+in seconds): coalescing security reindexings, indexing, and reindexing
+security.
+
+The counters of each committed transaction are recorded here, in process
+wide rolling aggregates over the last transactions, and logged in one
+line if wanted.
+"""
+
+import logging
+import threading
+
+logger = logging.getLogger('CPSCore.indexationstats')
+
+COUNTERS = ('pushes', 'processed', 'idxs_merges', 'cancellations',
+            'secu_reindexes',
+            'indexes_written', 'indexes_skipped',
+            'metadata_written', 'metadata_skipped')
+
+TIMERS = ('time_coalesce', 'time_index', 'time_security')
+
+# Number of transactions the rolling aggregates are computed on
+DEFAULT_WINDOW = 1000
+
+
+def format_counters(counters):
+    """Format counters in one key=value line, for the logs."""
+    res = []
+    for name in COUNTERS:
+        res.append('%s=%d' % (name, counters.get(name, 0)))
+    for name in TIMERS:
+        res.append('%s=%.4f' % (name, counters.get(name, 0.0)))
+    return ' '.join(res)
+
+
+class IndexationStatistics(object):
+    """Process wide statistics of the indexation of transactions."""
+
+    # Log the counters of each committed transaction that indexed something
+    # XXX This may be monkey-patched by unit-tests or at startup.
+    DEFAULT_LOG_TRANSACTIONS = False
+
+    def __init__(self, window=DEFAULT_WINDOW):
+        self.enabled = True
+        self.window = window
+        self.log_transactions = self.DEFAULT_LOG_TRANSACTIONS
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget all statistics."""
+        self._lock.acquire()
+        try:
+            self._records = [] # ring buffer of counters
+            self._pos = 0
+            self.transactions = 0
+            self._totals = dict([(name, 0) for name in COUNTERS + TIMERS])
+        finally:
+            self._lock.release()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def setLogTransactions(self, log):
+        """Set whether the counters of each transaction are logged."""
+        self.log_transactions = bool(log)
+
+    def record(self, counters):
+        """Record the counters of a committed transaction."""
+        if not self.enabled:
+            return
+        if not counters.get('pushes') and not counters.get('processed'):
+            # Nothing indexed, only catalog writes from elsewhere
+            return
+        record = dict([(name, counters.get(name, 0))
+                       for name in COUNTERS + TIMERS])
+        self._lock.acquire()
+        try:
+            if len(self._records) < self.window:
+                self._records.append(record)
+            else:
+                self._records[self._pos] = record
+                self._pos = (self._pos + 1) % self.window
+            self.transactions += 1
+            totals = self._totals
+            for name, value in record.items():
+                totals[name] += value
+        finally:
+            self._lock.release()
+        if self.log_transactions:
+            logger.info("indexation %s", format_counters(record))
+
+    def getStatistics(self):
+        """Return the statistics, as a list of mappings.
+
+        Each mapping has the following keys: name, total (since startup
+        or the last reset), window (sum over the last transactions),
+        mean and max (per transaction, over the last transactions).
+        """
+        self._lock.acquire()
+        try:
+            records = list(self._records)
+            totals = self._totals.copy()
+        finally:
+            self._lock.release()
+        res = []
+        for name in COUNTERS + TIMERS:
+            values = [record[name] for record in records]
+            window = sum(values)
+            if values:
+                mean = float(window) / len(values)
+                max_value = max(values)
+            else:
+                mean = max_value = 0
+            res.append({
+                'name': name,
+                'total': totals[name],
+                'window': window,
+                'mean': mean,
+                'max': max_value,
+                })
+        return res
+
+
+_statistics = IndexationStatistics()
+
+def get_indexation_statistics():
+    """Return the process wide indexation statistics."""
+    return _statistics
@@ -155,7 +155,7 @@ class IZODBBeforeCommitHook(IBeforeCommitSubscriber):
     """Before commit subcriber base interface
     """
 
-    def addSubscriber(hook, args=(), kws=None, order=0):
+    def addSubscriber(hook, args=(), kws=None, order=0, key=None, merge=None):
         """Register a subscriber to call before the transaction is committed.
 
         The specified hook function will be called after the transaction's
@@ -179,6 +179,11 @@ class IZODBBeforeCommitHook(IBeforeCommitSubscriber):
         hooks are registered with the same order, the first one registered is
         called first.
 
+        Registrations made with the same hashable `key` are coalesced into
+        the first one, as long as it has not been called.  `merge`, if
+        given, is called as merge(queued_args, queued_kws, args, kws) and
+        returns the new (args, kws) of the queued hook.
+
         Hooks are called only for a top-level commit.  A subtransaction
         commit or savepoint creation does not call any hooks.  If the
         transaction is aborted, hooks are not called, and are discarded.
@@ -194,7 +199,8 @@ class IZODBAfterCommitHook(IAfterCommitSubscriber):
     """After commit subcriber base interface
     """
 
-    def addSubscriber(subscriber, args=(), kws=None, order=0):
+    def addSubscriber(subscriber, args=(), kws=None, order=0,
+                      key=None, merge=None, background=False):
         """Register a subscriber to call after a transaction commit attempt.
 
          The specified subscriber function will be called after the
@@ -221,6 +227,15 @@ class IZODBAfterCommitHook(IAfterCommitSubscriber):
          registered first.  When two hooks are registered with the
          same order, the first one registered is called first.
 
+         Registrations made with the same hashable `key` are coalesced
+         into the first one, as long as it has not been called.
+         `merge`, if given, is called as merge(queued_args, queued_kws,
+         args, kws) and returns the new (args, kws) of the queued
+         subscriber.
+
+         If `background` is true, the subscriber may be run by a worker
+         thread, outside of any transaction.
+
          This method can also be called from a subscriber:
          an executing subscriber can register more subscribers.
          Applications should take care to avoid creating infinite
@@ -20,17 +20,26 @@
 from ZODB.loglevels import TRACE
 from logging import getLogger
 
+from Globals import DTMLFile
 from Acquisition import aq_base, aq_parent, aq_inner
+from AccessControl.PermissionRole import PermissionRole
 from Products.ZCatalog.ZCatalog import ZCatalog
 from Products.CMFCore.interfaces.portal_catalog import \
      IndexableObjectWrapper as IIndexableObjectWrapper
 from Products.CMFCore.CatalogTool import CatalogTool
 from Products.CMFCore.CMFCatalogAware import CMFCatalogAware
 from Products.CMFCore.utils import getToolByName
+from Products.CMFCore.permissions import ManagePortal
+from Products.CMFCore.permissions import ViewManagementScreens
 from Products.CPSCore.utils import getAllowedRolesAndUsersOfObject, \
      getAllowedRolesAndUsersOfUser
 from Products.CPSCore.utils import KEYWORD_VIEW_LANGUAGE, ALL_LOCALES
 from Products.CPSCore.ProxyBase import ProxyBase
+from Products.CPSCore.IndexationManager import get_indexation_counters
+from Products.CPSCore.indexationqueue import get_indexation_queue
+from Products.CPSCore.indexationqueue import process_indexation_queue
+from Products.CPSCore.indexationqueue import DEFAULT_BATCH_SIZE
+from Products.CPSCore.indexationstats import get_indexation_statistics
 
 logger = getLogger('CPSCore.PatchCMFCoreCatalogTool')
 
@@ -54,11 +63,40 @@ class IndexableObjectWrapper:
         self.__ob = ob
         self.__lang = lang
         self.__uid = uid
+        self.__values = {}
+
+    def _cps_computeValues(self, names):
+        """Compute the values of names once, as indexes get them.
+
+        names are the attributes needed by the indexes and metadata to
+        update. Values of the attributes of the object are kept in a
+        separate dict looked up first by __getattr__, so that indexes and
+        metadata using the same attribute don't compute it again. The
+        methods of the wrapper itself are left untouched. Values that
+        can't be computed are left to the indexes.
+        """
+        values = self.__values
+        vars = self.__vars
+        klass = self.__class__
+        for name in names:
+            if (values.has_key(name) or vars.has_key(name)
+                or hasattr(klass, name)):
+                continue
+            try:
+                value = getattr(self, name)
+                if callable(value):
+                    value = value()
+            except (AttributeError, TypeError):
+                continue
+            values[name] = value
 
     def __getattr__(self, name):
         """This is the indexable wrapper getter for CPS,
         proxy try to get the repository document attributes,
         document in the repository hide some attributes to save some space."""
+        values = self.__values
+        if values.has_key(name):
+            return values[name]
         vars = self.__vars
         if vars.has_key(name):
             return vars[name]
@@ -176,6 +214,90 @@ class IndexableObjectWrapper:
         return languages
 
 
+### Change detection
+
+# When reindexing an already cataloged object, an unchanged metadata
+# record is not written again, nor is an unchanged path in a PathIndex,
+# which doesn't detect it. The other indexes are handed to the catalog,
+# UnIndex based ones already skipping unchanged values.
+# XXX This may be monkey-patched by unit-tests.
+DETECT_UNCHANGED = True
+
+_marker = []
+
+def _getIndexedValue(w, attr):
+    """Return the value of attr as UnIndex gets it, _marker if none."""
+    try:
+        value = getattr(w, attr)
+        if callable(value):
+            value = value()
+    except (AttributeError, TypeError):
+        return _marker
+    return value
+
+def _isPathIndexUnchanged(index, w, rid):
+    old = index._unindex.get(rid)
+    new = _getIndexedValue(w, index.getId())
+    if new is _marker:
+        return False
+    if isinstance(new, (list, tuple)):
+        new = '/' + '/'.join(new[1:])
+    return old == new
+
+# Index meta type -> function telling if the value of a cataloged object
+# is unchanged
+_UNCHANGED_CHECKERS = {
+    'PathIndex': _isPathIndexUnchanged,
+    }
+
+def _catalogWrapper(self, w, uid, idxs, update_metadata, pgharg):
+    """Catalog an indexable wrapper, writing only what changed.
+
+    Writes and skips are counted in the indexation counters of the
+    transaction.
+    """
+    catalog = self._catalog
+    if idxs == []:
+        names = catalog.indexes.keys()
+    else:
+        names = idxs
+    counters = get_indexation_counters()
+    rid = None
+    if DETECT_UNCHANGED or idxs == ():
+        rid = catalog.uids.get(uid)
+    if rid is None:
+        if idxs == ():
+            # Metadata only, but a new object needs all its indexes
+            idxs = []
+            names = catalog.indexes.keys()
+        counters['indexes_written'] += len(names)
+        if update_metadata:
+            counters['metadata_written'] += 1
+        ZCatalog.catalog_object(self, w, uid, idxs, update_metadata, *pgharg)
+        return
+
+    if update_metadata:
+        record = catalog.recordify(w)
+        if catalog.data.get(rid) == record:
+            counters['metadata_skipped'] += 1
+        else:
+            catalog.updateMetadata(w, uid)
+            counters['metadata_written'] += 1
+
+    changed = []
+    for name in names:
+        index = catalog.indexes[name]
+        checker = _UNCHANGED_CHECKERS.get(getattr(index, 'meta_type', None))
+        if checker is None or not checker(index, w, rid):
+            changed.append(name)
+    counters['indexes_written'] += len(changed)
+    counters['indexes_skipped'] += len(names) - len(changed)
+    logger.log(TRACE, '_catalogWrapper: uid %s changed %s', uid, changed)
+    if changed:
+        # Metadata has been updated above
+        ZCatalog.catalog_object(self, w, uid, changed, 0, *pgharg)
+
+
 ### Patching CatalogTool methods
 def cat_catalog_object(self, object, uid=None, idxs=[], update_metadata=1, pghandler=None):
     """Wraps the object before cataloging.
@@ -183,86 +305,184 @@ def cat_catalog_object(self, object, uid=None, idxs=[], update_metadata=1, pghan
     Also takes into account multiple CPS languages.
     """
 
-    # Don't index repository objects or anything under them.
-    repotool = getToolByName(self, 'portal_repository', None)
-    if repotool is not None and repotool.isObjectUnderRepository(object):
-        return
-
     # BBB: for Zope 2.7, which doesn't take a pghandler
     if pghandler is None:
         pgharg = ()
     else:
         pgharg = (pghandler,)
 
-    logger.log(TRACE, 'cat_catalog_object: index uid %s  obj %s', uid, object)
+    # Filter out invalid indexes.
+    if idxs != []:
+        idxs = [i for i in idxs if self._catalog.indexes.has_key(i)]
+
+    repotool = getToolByName(self, 'portal_repository', None)
     wf = getattr(self, 'portal_workflow', None)
+    _catalogCPSObject(self, object, uid, idxs, update_metadata, pgharg,
+                      repotool, wf)
+
+def _catalogCPSObject(self, object, uid, idxs, update_metadata, pgharg,
+                      repotool, wf):
+    """Catalog an object, tools and valid idxs being already computed."""
+    extracted = _extractCPSObject(self, object, uid, idxs, update_metadata,
+                                  repotool, wf)
+    if extracted is not None:
+        _applyCPSObject(self, extracted, idxs, update_metadata, pgharg)
+
+def _getValueNames(self, idxs, update_metadata):
+    """Return the attributes needed to catalog idxs and the metadata.
+
+    Indexes that don't tell their source attributes are left out.
+    """
+    catalog = self._catalog
+    if idxs == []:
+        idxs = catalog.indexes.keys()
+    names = {}
+    for idx in idxs:
+        getter = getattr(aq_base(catalog.indexes[idx]),
+                         'getIndexSourceNames', None)
+        if getter is None:
+            continue
+        for name in getter():
+            names[name] = None
+    if update_metadata:
+        for name in catalog.names:
+            names[name] = None
+    return names.keys()
+
+def _extractCPSObject(self, object, uid, idxs, update_metadata,
+                      repotool, wf, names=None):
+    """Compute what is needed to catalog an object.
+
+    Returns None if the object mustn't be cataloged, or a tuple of the
+    uids to uncatalog and of the (wrapper, uid) to catalog. The values
+    of names, computed from idxs if None, are already computed in the
+    wrappers. Doesn't change the catalog.
+    """
+    # Don't index repository objects or anything under them.
+    if repotool is not None and repotool.isObjectUnderRepository(object):
+        return None
+
+    logger.log(TRACE, 'cat_catalog_object: index uid %s  obj %s', uid, object)
     if wf is not None:
         vars = wf.getCatalogVariablesFor(object)
     else:
         vars = {}
+    if names is None:
+        names = _getValueNames(self, idxs, update_metadata)
+    obsolete = []
+    wrappers = []
 
-    # Filter out invalid indexes.
-    if idxs != []:
-        idxs = [i for i in idxs if self._catalog.indexes.has_key(i)]
-
-    # Not a proxy.
     if not isinstance(object, ProxyBase):
-        w = IndexableObjectWrapper(vars, object)
-        ZCatalog.catalog_object(self, w, uid, idxs, update_metadata, *pgharg)
-        return
-
-    # Proxy with a viewLanguage uid.
-    # Happens when the catalog is reindexed (refreshCatalog)
-    # or when called by reindexObjectSecurity.
-    path = uid.split('/')
-    if KEYWORD_VIEW_LANGUAGE in path:
+        # Not a proxy.
+        wrappers.append((IndexableObjectWrapper(vars, object), uid))
+    elif KEYWORD_VIEW_LANGUAGE in uid.split('/'):
+        # Proxy with a viewLanguage uid.
+        # Happens when the catalog is reindexed (refreshCatalog)
+        # or when called by reindexObjectSecurity.
+        path = uid.split('/')
         if path.index(KEYWORD_VIEW_LANGUAGE) == len(path)-2:
             lang = path[-1]
         else:
             # Weird, but don't crash
             lang = None
-        w = IndexableObjectWrapper(vars, object, lang, uid)
-        ZCatalog.catalog_object(self, w, uid, idxs, update_metadata, *pgharg)
-        return
-
-    # We reindex a normal proxy.
-    # Find what languages are in the catalog for this proxy
-    uid_view = uid+'/'+KEYWORD_VIEW_LANGUAGE
-    had_languages = []
-    for brain in self.unrestrictedSearchResults(path=uid_view):
-        path = brain.getPath()
-        had_languages.append(path[path.rindex('/')+1:])
-
-    # Do we now have only one language?
-    languages = object.getProxyLanguages()
-    if len(languages) == 1:
-        # Remove previous languages
-        for lang in had_languages:
-            self.uncatalog_object(uid_view+'/'+lang)
-        # Index normal proxy
-        w = IndexableObjectWrapper(vars, object)
-        ZCatalog.catalog_object(self, w, uid, idxs, update_metadata, *pgharg)
-        return
-
-    # We now have several languages (or none).
-    # Remove old base proxy path
-    if self._catalog.uids.has_key(uid):
+        wrappers.append((IndexableObjectWrapper(vars, object, lang, uid),
+                         uid))
+    else:
+        # We reindex a normal proxy.
+        # Find what languages are in the catalog for this proxy
+        uid_view = uid+'/'+KEYWORD_VIEW_LANGUAGE
+        had_languages = []
+        for brain in self.unrestrictedSearchResults(path=uid_view):
+            path = brain.getPath()
+            had_languages.append(path[path.rindex('/')+1:])
+
+        languages = object.getProxyLanguages()
+        if len(languages) == 1:
+            # We now have only one language.
+            # Remove previous languages
+            for lang in had_languages:
+                obsolete.append(uid_view+'/'+lang)
+            # Index normal proxy
+            wrappers.append((IndexableObjectWrapper(vars, object), uid))
+        else:
+            # We now have several languages (or none).
+            # Remove old base proxy path
+            if self._catalog.uids.has_key(uid):
+                obsolete.append(uid)
+            # Also remove old languages
+            for lang in had_languages:
+                if lang not in languages:
+                    obsolete.append(uid_view+'/'+lang)
+            # Index all available translations of the proxy
+            # with uid/viewLanguage/language for path
+            for lang in languages:
+                lang_uid = uid_view + '/' + lang
+                w = IndexableObjectWrapper(vars, object, lang, lang_uid)
+                wrappers.append((w, lang_uid))
+
+    for w, w_uid in wrappers:
+        w._cps_computeValues(names)
+    return obsolete, wrappers
+
+def _applyCPSObject(self, extracted, idxs, update_metadata, pgharg):
+    """Update the catalog with what _extractCPSObject computed."""
+    obsolete, wrappers = extracted
+    for uid in obsolete:
         self.uncatalog_object(uid)
-    # Also remove old languages
-    for lang in had_languages:
-        if lang not in languages:
-            self.uncatalog_object(uid_view+'/'+lang)
-    # Index all available translations of the proxy
-    # with uid/viewLanguage/language for path
-    for lang in languages:
-        uid = uid_view + '/' + lang
-        w = IndexableObjectWrapper(vars, object, lang, uid)
-        ZCatalog.catalog_object(self, w, uid, idxs, update_metadata, *pgharg)
+    for w, uid in wrappers:
+        _catalogWrapper(self, w, uid, idxs, update_metadata, pgharg)
 
 
 CatalogTool.catalog_object = cat_catalog_object
 logger.log(TRACE, "Patching CMF CatalogTool.catalog_object")
 
+# Number of objects whose values are computed before the catalog is
+# updated, by cat_catalogCPSObjects
+EXTRACTION_CHUNK_SIZE = 100
+
+def cat_catalogCPSObjects(self, items, update_metadata=1):
+    """Catalog a batch of objects.
+
+    items is a sequence of (object, uid, idxs), preferably grouped by
+    idxs. This does the same as calling reindexObject for each object,
+    but tools are looked up and indexes filtered only once for the whole
+    batch. idxs being [] means all the indexes, and an empty tuple none
+    of them: only the metadata is updated.
+
+    Objects are processed by chunks of EXTRACTION_CHUNK_SIZE: the values
+    to catalog are all computed first, then the catalog is updated.
+    """
+    repotool = getToolByName(self, 'portal_repository', None)
+    wf = getattr(self, 'portal_workflow', None)
+    indexes = self._catalog.indexes
+    valid_idxs = {} # idxs -> (valid idxs, value names)
+    items = list(items)
+    for start in xrange(0, len(items), EXTRACTION_CHUNK_SIZE):
+        extracted = []
+        for object, uid, idxs in items[start:start+EXTRACTION_CHUNK_SIZE]:
+            key = (idxs == [], tuple(idxs))
+            valid = valid_idxs.get(key)
+            if valid is None:
+                if idxs == []:
+                    valid_list = []
+                elif not idxs:
+                    # Metadata only
+                    valid_list = ()
+                else:
+                    valid_list = [i for i in idxs if indexes.has_key(i)]
+                names = _getValueNames(self, valid_list, update_metadata)
+                valid = valid_idxs[key] = (valid_list, names)
+            idxs = valid[0][:]
+            res = _extractCPSObject(self, object, uid, idxs, update_metadata,
+                                    repotool, wf, names=valid[1])
+            if res is not None:
+                extracted.append((res, idxs))
+        for res, idxs in extracted:
+            _applyCPSObject(self, res, idxs, update_metadata, ())
+
+CatalogTool.catalogCPSObjects = cat_catalogCPSObjects
+logger.log(TRACE, "Patching CMF CatalogTool.catalogCPSObjects")
+
 #XXX should be a patch of uncatalog_object
 #GR: no: proxy is needed (for lang revs) and can't be found from the catalog if
 #already removed from ZODB
@@ -305,6 +525,41 @@ logger.log(TRACE, "Patching CMF CatalogTool.unindexObject")
 CatalogTool.unindexCPSObjectWithPath = cat_unindexCPSObjectWithPath
 logger.log(TRACE, "Patching CMF CatalogTool.unindexCPSObjectWithPath")
 
+def cat_unindexCPSPath(self, path):
+    """Remove from catalog the given path and all its translations.
+
+    Used when the object itself isn't available anymore, by the
+    deferred indexation queue.
+    """
+    uids = self._catalog.uids
+    if uids.has_key(path):
+        self.uncatalog_object(path)
+    prefix = path + '/' + KEYWORD_VIEW_LANGUAGE + '/'
+    for uid in list(uids.keys(prefix, prefix + '\xff')):
+        self.uncatalog_object(uid)
+
+CatalogTool.unindexCPSPath = cat_unindexCPSPath
+logger.log(TRACE, "Patching CMF CatalogTool.unindexCPSPath")
+
+def cat_processIndexationQueue(self, size=None, REQUEST=None):
+    """Apply pending records of the deferred indexation queue.
+
+    Meant to be called periodically, by a clock server for instance.
+    """
+    if size is None:
+        size = DEFAULT_BATCH_SIZE
+    else:
+        size = int(size)
+    done = process_indexation_queue(self, size)
+    queue = get_indexation_queue(self, create=False)
+    left = queue is not None and len(queue) or 0
+    logger.debug("processIndexationQueue: %s done, %s left", done, left)
+    return '%s done, %s left' % (done, left)
+
+CatalogTool.processIndexationQueue = cat_processIndexationQueue
+CatalogTool.processIndexationQueue__roles__ = PermissionRole(ManagePortal)
+logger.log(TRACE, "Patching CMF CatalogTool.processIndexationQueue")
+
 
 def cat_listAllowedRolesAndUsers(self, user):
     """Returns a list with all roles this user has + the username"""
@@ -313,8 +568,72 @@ def cat_listAllowedRolesAndUsers(self, user):
 CatalogTool._listAllowedRolesAndUsers = cat_listAllowedRolesAndUsers
 logger.log(TRACE, "Patching CMF CatalogTool._listAllowedRolesAndUsers")
 
-# Adding an 'export' tab in ZMI (view defined in CPSUtil)
+cat_manage_indexationStatistics = DTMLFile('zmi/indexationStatistics',
+                                           globals())
+
+CatalogTool.manage_indexationStatistics = cat_manage_indexationStatistics
+CatalogTool.manage_indexationStatistics__roles__ = PermissionRole(
+    ViewManagementScreens)
+logger.log(TRACE, "Patching CMF CatalogTool.manage_indexationStatistics")
+
+def cat_getIndexationStatistics(self):
+    """Return the indexation statistics.
+
+    These are about the whole Zope process, see indexationstats.
+    """
+    return get_indexation_statistics().getStatistics()
+
+CatalogTool.getIndexationStatistics = cat_getIndexationStatistics
+CatalogTool.getIndexationStatistics__roles__ = PermissionRole(
+    ViewManagementScreens)
+logger.log(TRACE, "Patching CMF CatalogTool.getIndexationStatistics")
+
+def cat_getIndexationStatisticsSettings(self):
+    """Return the settings of the indexation statistics, as a mapping.
+    """
+    stats = get_indexation_statistics()
+    return {
+        'enabled': stats.enabled,
+        'log_transactions': stats.log_transactions,
+        'transactions': stats.transactions,
+        }
+
+CatalogTool.getIndexationStatisticsSettings = \
+    cat_getIndexationStatisticsSettings
+CatalogTool.getIndexationStatisticsSettings__roles__ = PermissionRole(
+    ViewManagementScreens)
+logger.log(TRACE, "Patching CMF CatalogTool.getIndexationStatisticsSettings")
+
+def cat_manage_editIndexationStatistics(self, enabled=False,
+                                        log_transactions=False,
+                                        reset=False, REQUEST=None):
+    """Change the settings of the indexation statistics.
+
+    Settings are not persistent: they last until Zope restarts.
+    """
+    stats = get_indexation_statistics()
+    if enabled:
+        stats.enable()
+    else:
+        stats.disable()
+    stats.setLogTransactions(log_transactions)
+    if reset:
+        stats.reset()
+    if REQUEST is not None:
+        REQUEST.RESPONSE.redirect(
+            '%s/manage_indexationStatistics' % (self.absolute_url(),))
+
+CatalogTool.manage_editIndexationStatistics = \
+    cat_manage_editIndexationStatistics
+CatalogTool.manage_editIndexationStatistics__roles__ = PermissionRole(
+    ManagePortal)
+logger.log(TRACE, "Patching CMF CatalogTool.manage_editIndexationStatistics")
+
+# Adding an 'export' tab in ZMI (view defined in CPSUtil), and the
+# indexation statistics
 old_options = CatalogTool.manage_options
 CatalogTool.manage_options = old_options + (
         {'label': 'Export', 'action': 'manage_genericSetupExport.html'},
+        {'label': 'Indexation Statistics',
+         'action': 'manage_indexationStatistics'},
         )
@@ -0,0 +1,133 @@
+# -*- coding: iso-8859-15 -*-
+# (C) Copyright 2012 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Benchmark of the cataloging of CPS objects.
+
+Catalogs a synthetic tree of documents as CatalogTool.catalogCPSObjects
+does (see patch/cmf/catalog.py), then reindexes it, and reports separately
+the time spent computing the values to catalog (extraction) and the time
+spent updating the catalog (application), as done by chunks in
+catalogCPSObjects.
+
+Computing a value of the documents costs COMPUTE_COST iterations, to
+stand for SearchableText or localized titles. Each value is computed
+once per object, even when used by several indexes and metadata.
+
+This is not a unit test. It needs Zope; run it from an instance::
+
+  $ bin/zopectl run bench_catalog.py [nb_documents]
+"""
+
+import sys
+from time import time
+
+from Testing import ZopeTestCase
+ZopeTestCase.installProduct('CPSCompat')
+ZopeTestCase.installProduct('CPSCore')
+
+from OFS.Folder import Folder
+from OFS.SimpleItem import SimpleItem
+from Products.CMFCore.CatalogTool import CatalogTool
+from Products.CPSCore.patch.cmf import catalog as catalog_patch
+
+DEFAULT_SIZE = 20000
+FOLDER_SIZE = 100
+COMPUTE_COST = 200
+
+
+class Document(SimpleItem):
+
+    def __init__(self, id, title):
+        self._setId(id)
+        self.title = title
+        self.language = 'en'
+
+    def Title(self):
+        value = 0
+        for i in xrange(COMPUTE_COST):
+            value += i
+        return self.title
+
+    def Language(self):
+        return self.language
+
+    def Subject(self):
+        return ('bench', self.title[-1])
+
+
+def build(size):
+    root = Folder('root')
+    catalog = CatalogTool()
+    root._setObject('portal_catalog', catalog)
+    catalog = root.portal_catalog
+    catalog.addIndex('path', 'PathIndex')
+    catalog.addIndex('Title', 'FieldIndex')
+    catalog.addIndex('Language', 'FieldIndex')
+    catalog.addIndex('Subject', 'KeywordIndex')
+    catalog.addColumn('Title')
+    catalog.addColumn('Language')
+    items = []
+    folder = None
+    for i in xrange(size):
+        if i % FOLDER_SIZE == 0:
+            id = 'f%d' % i
+            root._setObject(id, Folder(id))
+            folder = root._getOb(id)
+        id = 'd%d' % i
+        folder._setObject(id, Document(id, 'Document %d' % i))
+        ob = folder._getOb(id)
+        items.append((ob, '/'.join(ob.getPhysicalPath()), []))
+    return catalog, items
+
+def catalog_items(catalog, items):
+    """Return the extraction and application times for items."""
+    extracted = []
+    start = time()
+    for ob, uid, idxs in items:
+        res = catalog_patch._extractCPSObject(catalog, ob, uid, idxs, 1,
+                                              None, None)
+        extracted.append(res)
+    middle = time()
+    for res in extracted:
+        catalog_patch._applyCPSObject(catalog, res, [], 1, ())
+    return middle - start, time() - middle
+
+def main(size):
+    catalog, items = build(size)
+    print "%10s %-24s %12s %12s" % ('documents', 'pass', 'extract (s)',
+                                    'apply (s)')
+    for name, detect, change in (
+        ('initial', True, False),
+        ('unchanged', True, False),
+        ('unchanged, no detection', False, False),
+        ('changed', True, True),
+        ):
+        catalog_patch.DETECT_UNCHANGED = detect
+        if change:
+            for ob, uid, idxs in items:
+                ob.title += ' changed'
+        extract, apply = catalog_items(catalog, items)
+        print "%10d %-24s %12.3f %12.3f" % (size, name, extract, apply)
+    catalog_patch.DETECT_UNCHANGED = True
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        size = int(sys.argv[1])
+    else:
+        size = DEFAULT_SIZE
+    main(size)
@@ -0,0 +1,90 @@
+# -*- coding: iso-8859-15 -*-
+# (C) Copyright 2012 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Benchmark of the commit subscribers managers scheduling.
+
+Registers a large number of subscribers on a BeforeCommitSubscribersManager
+then executes them, to check that both registration and commit time scale
+linearly (up to a log factor) with the number of subscribers.
+
+The former list based scheduling (bisect.insort / pop(0)) is measured as well
+for comparison, but only on the smaller sizes, because it is quadratic.
+
+This is not a unit test. Run it directly::
+
+  $ python bench_commithooks.py [size ...]
+"""
+
+import sys
+import bisect
+from time import time
+
+from Products.CPSCore.commithooks import BeforeCommitSubscribersManager
+
+DEFAULT_SIZES = (10000, 100000, 1000000)
+LIST_MAX_SIZE = 100000
+ORDERS = (-100, 0, 0, 0, 100)
+
+class FakeTransaction:
+    def addBeforeCommitHook(self, hook):
+        pass
+
+class ListBeforeCommitSubscribersManager(BeforeCommitSubscribersManager):
+    """The former, list based, scheduling."""
+
+    def addSubscriber(self, subscriber, args=(), kws=None, order=0):
+        if kws is None:
+            kws = {}
+        bisect.insort(self._before_commit, (order, self._before_commit_index,
+                                            subscriber, tuple(args), kws))
+        self._before_commit_index += 1
+
+    def __call__(self):
+        while self._before_commit:
+            order, index, subscriber, args, kws = self._before_commit.pop(0)
+            subscriber(*args, **kws)
+        self._before_commit_index = 0
+
+def subscriber(*args, **kws):
+    pass
+
+def bench(klass, size):
+    mgr = klass(FakeTransaction())
+    nb_orders = len(ORDERS)
+    start = time()
+    for i in xrange(size):
+        mgr.addSubscriber(subscriber, (i,), order=ORDERS[i % nb_orders])
+    registered = time()
+    mgr()
+    done = time()
+    return registered - start, done - registered
+
+def main(sizes):
+    print "%10s %-6s %12s %12s" % ('size', 'queue', 'register (s)',
+                                   'commit (s)')
+    for size in sizes:
+        candidates = [('heap', BeforeCommitSubscribersManager)]
+        if size <= LIST_MAX_SIZE:
+            candidates.append(('list', ListBeforeCommitSubscribersManager))
+        for name, klass in candidates:
+            reg, commit = bench(klass, size)
+            print "%10d %-6s %12.3f %12.3f" % (size, name, reg, commit)
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES
+    main(sizes)
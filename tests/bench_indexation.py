@@ -0,0 +1,205 @@
+# -*- coding: iso-8859-15 -*-
+# (C) Copyright 2012 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Benchmark of the IndexationManager processing.
+
+Reindexes a large number of proxies in one transaction, with the per
+object processing and with the batched one (see
+IndexationManager.processBatch).
+
+Proxies, folders and catalog are fakes: traversal and tool lookups
+(acquisition) walk the fake tree, and cataloging only costs a dict
+update per index. What is measured is thus the overhead of the
+processing itself, not the cost of the indexes.
+
+This is not a unit test. Run it directly::
+
+  $ python bench_indexation.py [nb_proxies]
+"""
+
+import sys
+from time import time
+
+from Products.CPSCore.IndexationManager import IndexationManager
+
+DEFAULT_SIZE = 10000
+FOLDER_SIZE = 100
+DEPTH = 3
+INDEXES = ('Title', 'SearchableText', 'portal_type', 'review_state',
+           'allowedRolesAndUsers', 'localUsersWithRoles', 'path',
+           'modified', 'effective', 'container_path')
+
+
+class FakeBeforeCommitSubscribersManager:
+    def addSubscriber(self, hook, order):
+        pass
+
+
+class FakeCatalog:
+
+    def __init__(self):
+        self.indexes = dict([(idx, {}) for idx in INDEXES])
+        self.portal_workflow = object()
+        self.portal_repository = object()
+
+    def catalogObject(self, ob, uid, idxs):
+        if not idxs:
+            idxs = INDEXES
+        for idx in idxs:
+            self.indexes[idx][uid] = ob.id
+
+    def reindexObject(self, ob, idxs=[]):
+        # Same lookups as the CMF CatalogTool and its CPS patch
+        uid = '/'.join(ob.getPhysicalPath())
+        if idxs != []:
+            idxs = [i for i in idxs if i in self.indexes]
+        getattr(self, 'portal_repository')
+        getattr(self, 'portal_workflow')
+        self.catalogObject(ob, uid, idxs)
+
+    def catalogCPSObjects(self, items):
+        getattr(self, 'portal_repository')
+        getattr(self, 'portal_workflow')
+        valid_idxs = {}
+        for ob, uid, idxs in items:
+            if idxs != []:
+                key = tuple(idxs)
+                valid = valid_idxs.get(key)
+                if valid is None:
+                    valid = [i for i in idxs if i in self.indexes]
+                    valid_idxs[key] = valid
+                idxs = valid
+            self.catalogObject(ob, uid, idxs)
+
+
+class FakeItem(object):
+
+    def __init__(self, id, parent):
+        self.id = id
+        self.parent = parent
+        if parent is None:
+            self.path = ('',)
+        else:
+            self.path = parent.path + (id,)
+
+    def __getattr__(self, name):
+        # Acquisition
+        if name.startswith('__') or self.parent is None:
+            raise AttributeError(name)
+        return getattr(self.parent, name)
+
+    def getPhysicalPath(self):
+        return self.path
+
+    def getPhysicalRoot(self):
+        ob = self
+        while ob.parent is not None:
+            ob = ob.parent
+        return ob
+
+
+class FakeFolder(FakeItem):
+
+    def __init__(self, id, parent):
+        FakeItem.__init__(self, id, parent)
+        self.items = {}
+
+    def unrestrictedTraverse(self, path, default):
+        if isinstance(path, str):
+            path = path.split('/')
+        ob = self
+        if not path[0]:
+            ob = self.getPhysicalRoot()
+            path = path[1:]
+        for id in path:
+            ob = ob.items.get(id)
+            if ob is None:
+                return default
+        return ob
+
+
+class FakeProxy(FakeItem):
+
+    effective_date = None
+
+    def _prepareReindexObject(self, idxs=[]):
+        if 'allowedRolesAndUsers' in idxs:
+            idxs = list(idxs) + ['localUsersWithRoles']
+        return idxs
+
+    def notifyModified(self):
+        pass
+
+    def _reindexObject(self, idxs=[]):
+        idxs = self._prepareReindexObject(idxs)
+        if idxs == []:
+            self.notifyModified()
+        self.portal_catalog.reindexObject(self, idxs=idxs)
+
+    def _reindexObjectSecurity(self, skip_self=False):
+        pass
+
+
+def build(size):
+    root = FakeFolder('', None)
+    root.portal_catalog = FakeCatalog()
+    proxies = []
+    folders = [root]
+    for depth in range(DEPTH):
+        parent = folders[-1]
+        folder = FakeFolder('folder%d' % depth, parent)
+        parent.items[folder.id] = folder
+        folders.append(folder)
+    container = None
+    for i in xrange(size):
+        if i % FOLDER_SIZE == 0:
+            container = FakeFolder('f%d' % i, folders[-1])
+            folders[-1].items[container.id] = container
+        proxy = FakeProxy('p%d' % i, container)
+        container.items[proxy.id] = proxy
+        proxies.append(proxy)
+    return proxies
+
+def bench(size, threshold):
+    proxies = build(size)
+    mgr = IndexationManager(FakeBeforeCommitSubscribersManager())
+    mgr.BATCH_THRESHOLD = threshold
+    start = time()
+    for i, proxy in enumerate(proxies):
+        if i % 3:
+            mgr.push(proxy, idxs=['Title', 'SearchableText'])
+        else:
+            mgr.push(proxy, idxs=[])
+    queued = time()
+    mgr()
+    done = time()
+    return queued - start, done - queued
+
+def main(size):
+    print "%10s %-10s %12s %12s" % ('proxies', 'processing', 'queue (s)',
+                                    'commit (s)')
+    for name, threshold in (('per object', None), ('batched', 1)):
+        queue, commit = bench(size, threshold)
+        print "%10d %-10s %12.3f %12.3f" % (size, name, queue, commit)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        size = int(sys.argv[1])
+    else:
+        size = DEFAULT_SIZE
+    main(size)
@@ -0,0 +1,148 @@
+# -*- coding: iso-8859-15 -*-
+# (C) Copyright 2012 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Benchmark of the ordered TreeCache.getList.
+
+Compares getList(order=True), which scans the preorder positions of the
+cache, to the previous implementation, which rebuilt the order from the
+children lists on each call, on synthetic trees of 10k and 100k nodes:
+whole tree, one subtree, and the first two levels (navigation).
+
+This is not a unit test. It needs Zope; run it from an instance::
+
+  $ bin/zopectl run bench_treecache.py [nb_nodes...]
+"""
+
+import sys
+from time import time
+
+from Testing import ZopeTestCase
+ZopeTestCase.installProduct('CPSCore')
+
+from Products.CPSCore.TreesTool import TreeCache
+from Products.CPSCore.treestorage import TreeNode
+from Products.CPSCore.treestorage import TreePositions
+
+DEFAULT_SIZES = (10000, 100000)
+FANOUT = 10
+ROOT = 'sections'
+RUNS = 3
+
+
+def build(size):
+    """Build a cache of size nodes, FANOUT children per node."""
+    cache = TreeCache('cache')
+    cache.root = ROOT
+    cache._clear() # partitioned under the root
+    infos = cache._infos
+    structure = cache._structure
+    cache._principals['Anonymous'] = 0
+    cache._principal_names[0] = 'Anonymous'
+    infos[ROOT] = {'rpath': ROOT, '_allowed': (0,)}
+    structure[ROOT] = TreeNode(0)
+    todo = [ROOT]
+    count = 1
+    while count < size:
+        parent = todo.pop(0)
+        node = structure[parent]
+        depth = node.depth
+        children = []
+        for i in xrange(min(FANOUT, size - count)):
+            rpath = '%s/n%d' % (parent, count)
+            infos[rpath] = {'rpath': rpath, '_allowed': (0,)}
+            structure[rpath] = TreeNode(depth + 1)
+            children.append(rpath)
+            todo.append(rpath)
+            count += 1
+        node.children = tuple(children)
+    TreePositions(cache).index(ROOT, ())
+    return cache
+
+def old_getList(cache, prefix=None, start_depth=0, stop_depth=999):
+    """Ordered getList as it was before the preorder positions."""
+    infos = cache._infos
+    structure = cache._structure
+    if prefix is None:
+        rpaths = infos.keys()
+    else:
+        rpaths = infos.keys(prefix+'/', prefix+'/\xFF')
+        if infos.has_key(prefix):
+            rpaths = list(rpaths)
+            rpaths.insert(0, prefix)
+    res = []
+    done = {}
+    rest = list(rpaths)
+    while rest:
+        rpath = rest.pop(0)
+        if done.has_key(rpath):
+            continue
+        todo = [rpath]
+        while todo:
+            rpath = todo.pop(0)
+            if done.has_key(rpath):
+                continue
+            done[rpath] = None
+            info = infos.get(rpath)
+            if info is None:
+                continue
+            node = structure[rpath]
+            depth = node.depth
+            if depth < stop_depth:
+                todo = list(node.children) + todo
+            if depth < start_depth or depth > stop_depth:
+                continue
+            info = info.copy()
+            info['visible'] = True
+            info['depth'] = depth
+            res.append(info)
+    return res
+
+def timed(func, *args, **kw):
+    best = None
+    for i in xrange(RUNS):
+        start = time()
+        res = func(*args, **kw)
+        elapsed = time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, res
+
+def main(sizes):
+    print "%10s %-12s %8s %12s %12s" % ('nodes', 'listing', 'results',
+                                        'old (s)', 'new (s)')
+    for size in sizes:
+        cache = build(size)
+        subtree = cache._structure[ROOT].children[0]
+        for name, kw in (
+            ('whole', {}),
+            ('subtree', {'prefix': subtree}),
+            ('2 levels', {'stop_depth': 2}),
+            ):
+            old, old_res = timed(old_getList, cache, **kw)
+            new, new_res = timed(cache.getList, filter=False, **kw)
+            assert ([info['rpath'] for info in old_res] ==
+                    [info['rpath'] for info in new_res])
+            print "%10d %-12s %8d %12.3f %12.3f" % (size, name, len(new_res),
+                                                   old, new)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        sizes = [int(arg) for arg in sys.argv[1:]]
+    else:
+        sizes = DEFAULT_SIZES
+    main(sizes)
@@ -0,0 +1,207 @@
+# -*- coding: iso-8859-15 -*-
+# (C) Copyright 2012 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Benchmark of the write conflicts of concurrent TreeCache updates.
+
+Threads with their own connections to a FileStorage each commit
+transactions adding a child to a section of a cached tree, as the
+TreeCacheManager does when documents are created concurrently, and
+retry on ConflictError. Compares the conflict rate of:
+
+- the previous layout: one OOBTree per mapping, (depth, children)
+  structure records and positions made of child indexes,
+
+- the partitioned storage (see treestorage): TreePartitions, TreeNode
+  merging concurrent children changes, positions holding child ids.
+
+This is not a unit test. It needs Zope; run it from an instance::
+
+  $ bin/zopectl run bench_treecache_conflicts.py [nb_threads [nb_sections]]
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import random
+from time import time, sleep
+
+import transaction
+from BTrees.OOBTree import OOBTree
+from ZODB.DB import DB
+from ZODB.FileStorage import FileStorage
+from ZODB.POSException import ConflictError
+
+from Products.CPSCore.treestorage import TreeNode
+from Products.CPSCore.treestorage import TreePartitions
+from Products.CPSCore.treestorage import TreePositions
+from Products.CPSCore.treestorage import RPATH_KEYS, POSITION_KEYS
+
+ROOT = 'sections'
+DEFAULT_THREADS = 8
+DEFAULT_SECTIONS = 4
+SECTION_SIZE = 50
+COMMITS = 50 # per thread
+WORK = 0.002 # seconds between the changes and the commit
+
+
+class Cache(object):
+    """Attributes of a TreeCache, as used by TreePositions."""
+
+    def __init__(self, data):
+        self._structure = data['structure']
+        self._order = data['order']
+        self._positions = data['positions']
+
+
+class OldLayout(object):
+    """Single BTrees, structure tuples and positions of child indexes."""
+
+    name = 'single'
+
+    def create(self, root):
+        root['structure'] = OOBTree()
+        root['order'] = OOBTree()
+        root['positions'] = OOBTree()
+
+    def addNode(self, data, parent, rpath):
+        structure = data['structure']
+        if parent is None:
+            structure[rpath] = (0, ())
+            data['order'][()] = rpath
+            data['positions'][rpath] = ()
+            return
+        depth, children = structure[parent]
+        key = data['positions'][parent] + (len(children),)
+        structure[parent] = (depth, children + (rpath,))
+        structure[rpath] = (depth + 1, ())
+        data['order'][key] = rpath
+        data['positions'][rpath] = key
+
+    def getChildren(self, data, rpath):
+        return data['structure'][rpath][1]
+
+
+class PartitionedLayout(object):
+    """Storage of the tree caches."""
+
+    name = 'partitioned'
+
+    def create(self, root):
+        root['structure'] = TreePartitions(RPATH_KEYS, ROOT)
+        root['order'] = TreePartitions(POSITION_KEYS)
+        root['positions'] = TreePartitions(RPATH_KEYS, ROOT)
+
+    def addNode(self, data, parent, rpath):
+        structure = data['structure']
+        positions = TreePositions(Cache(data))
+        if parent is None:
+            structure[rpath] = TreeNode(0)
+            positions.index(rpath, ())
+            return
+        node = structure[parent]
+        structure[rpath] = TreeNode(node.depth + 1)
+        node.children = node.children + (rpath,)
+        positions.renumberChildren(parent)
+
+    def getChildren(self, data, rpath):
+        return data['structure'][rpath].children
+
+
+def setup(db, layout, nb_sections):
+    conn = db.open()
+    root = conn.root()
+    layout.create(root)
+    layout.addNode(root, None, ROOT)
+    for i in xrange(nb_sections):
+        section = '%s/s%d' % (ROOT, i)
+        layout.addNode(root, ROOT, section)
+        for j in xrange(SECTION_SIZE):
+            layout.addNode(root, section, '%s/d%d' % (section, j))
+    transaction.commit()
+    conn.close()
+
+def worker(db, layout, nb_sections, n, stats):
+    tm = transaction.TransactionManager()
+    conn = db.open(transaction_manager=tm)
+    rand = random.Random(n)
+    conflicts = 0
+    for i in xrange(COMMITS):
+        section = '%s/s%d' % (ROOT, rand.randrange(nb_sections))
+        rpath = '%s/t%d-%d' % (section, n, i)
+        while True:
+            tm.begin()
+            layout.addNode(conn.root(), section, rpath)
+            sleep(WORK)
+            try:
+                tm.commit()
+            except ConflictError:
+                tm.abort()
+                conflicts += 1
+            else:
+                break
+    conn.close()
+    stats[n] = conflicts
+
+def run(layout, nb_threads, nb_sections):
+    """Return the number of conflicts and the elapsed time."""
+    dir = tempfile.mkdtemp()
+    try:
+        db = DB(FileStorage(os.path.join(dir, 'Data.fs')))
+        setup(db, layout, nb_sections)
+        stats = {}
+        threads = [threading.Thread(target=worker,
+                                    args=(db, layout, nb_sections, n, stats))
+                   for n in xrange(nb_threads)]
+        start = time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time() - start
+
+        # No addition was lost
+        conn = db.open()
+        data = conn.root()
+        total = 0
+        for i in xrange(nb_sections):
+            section = '%s/s%d' % (ROOT, i)
+            total += len(layout.getChildren(data, section)) - SECTION_SIZE
+        assert total == nb_threads * COMMITS, total
+        conn.close()
+        db.close()
+    finally:
+        shutil.rmtree(dir)
+    return sum(stats.values()), elapsed
+
+def main(nb_threads, nb_sections):
+    commits = nb_threads * COMMITS
+    print "%d threads, %d sections, %d commits" % (nb_threads, nb_sections,
+                                                   commits)
+    print "%-12s %10s %10s %10s" % ('layout', 'conflicts', 'rate', 'time (s)')
+    for layout in (OldLayout(), PartitionedLayout()):
+        conflicts, elapsed = run(layout, nb_threads, nb_sections)
+        rate = float(conflicts) / (commits + conflicts)
+        print "%-12s %10d %10.3f %10.2f" % (layout.name, conflicts, rate,
+                                            elapsed)
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    args += [DEFAULT_THREADS, DEFAULT_SECTIONS][len(args):]
+    main(*args[:2])
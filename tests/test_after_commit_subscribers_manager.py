@@ -226,6 +226,74 @@ class AfterCommitSubscribersManagerTest(unittest.TestCase):
 
         reset_log()
 
+    def test_hooks_registration_from_a_hook(self):
+
+        # A subscriber may register other subscribers while the manager
+        # is executing. They are run according to the same policy.
+
+        mgr = AfterCommitSubscribersManager(FakeTransaction())
+
+        def registering_hook(status):
+            log.append('registering')
+            mgr.addSubscriber(hook, '3', order=1)
+            mgr.addSubscriber(hook, '2', order=0)
+
+        mgr.addSubscriber(registering_hook, order=0)
+        mgr.addSubscriber(hook, '1', order=0)
+        mgr.addSubscriber(hook, '4', order=2)
+
+        mgr()
+
+        self.assertEqual(
+            ["registering",
+             "status True arg '1' kw1 'no_kw1' kw2 'no_kw2'",
+             "status True arg '2' kw1 'no_kw1' kw2 'no_kw2'",
+             "status True arg '3' kw1 'no_kw1' kw2 'no_kw2'",
+             "status True arg '4' kw1 'no_kw1' kw2 'no_kw2'"],
+            log)
+        self.assertEqual(mgr._after_commit, [])
+
+        reset_log()
+
+    def test_hooks_coalescing(self):
+
+        # Registrations with the same key are coalesced in the first one,
+        # keeping its position, until it is executed.
+
+        mgr = AfterCommitSubscribersManager(FakeTransaction())
+
+        def merge(old_args, old_kws, args, kws):
+            kws = kws.copy()
+            kws['kw1'] = old_kws.get('kw1', '') + kws['kw1']
+            return old_args, kws
+
+        mgr.addSubscriber(hook, '1', {'kw1': 'a'}, key='k1', merge=merge)
+        mgr.addSubscriber(hook, '2', key='k2')
+        mgr.addSubscriber(hook, '3', {'kw1': 'b'}, key='k1', merge=merge)
+        mgr.addSubscriber(hook, '4', key='k2')
+        mgr.addSubscriber(hook, '5', order=-1, key='k2')
+        mgr.addSubscriber(hook, '6')
+        self.assertEqual(len(mgr._after_commit), 3)
+
+        mgr()
+
+        self.assertEqual(
+            ["status True arg '1' kw1 'ab' kw2 'no_kw2'",
+             "status True arg '2' kw1 'no_kw1' kw2 'no_kw2'",
+             "status True arg '6' kw1 'no_kw1' kw2 'no_kw2'"],
+            log)
+        self.assertEqual(mgr._after_commit_keys, {})
+        reset_log()
+
+        # Once executed, a key can be registered again
+        def coalesced_hook(status):
+            mgr.addSubscriber(hook, '2', key='k1')
+        mgr.addSubscriber(coalesced_hook, key='k1')
+        mgr()
+        self.assertEqual(["status True arg '2' kw1 'no_kw1' kw2 'no_kw2'"], log)
+
+        reset_log()
+
 class AfterCommitSubscribersManagerIntegrationTest(unittest.TestCase):
 
     # These really test the beforeCommitHook on a real transaction
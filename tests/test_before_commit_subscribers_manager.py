@@ -23,12 +23,16 @@
 import unittest
 
 import transaction
+from ZODB.DB import DB
+from ZODB.MappingStorage import MappingStorage
 
 from Products.CPSCore.interfaces import IBeforeCommitSubscriber
 from Products.CPSCore.commithooks import _CPS_BCH_TXN_ATTRIBUTE
 from Products.CPSCore.commithooks import BeforeCommitSubscribersManager
 from Products.CPSCore.commithooks import get_before_commit_subscribers_manager
 from Products.CPSCore.commithooks import del_before_commits_subscribers_manager
+from Products.CPSCore.commithooks import BeforeCommitSubscriber
+from Products.CPSCore.commithooks import savepoint
 
 class FakeTransaction:
     def addBeforeCommitHook(self, hook):
@@ -220,6 +224,74 @@ class BeforeCommitSubscribersManagerTest(unittest.TestCase):
 
         reset_log()
 
+    def test_hooks_registration_from_a_hook(self):
+
+        # A subscriber may register other subscribers while the manager
+        # is executing. They are run according to the same policy.
+
+        mgr = BeforeCommitSubscribersManager(FakeTransaction())
+
+        def registering_hook():
+            log.append('registering')
+            mgr.addSubscriber(hook, '3', order=1)
+            mgr.addSubscriber(hook, '2', order=0)
+
+        mgr.addSubscriber(registering_hook, order=0)
+        mgr.addSubscriber(hook, '1', order=0)
+        mgr.addSubscriber(hook, '4', order=2)
+
+        mgr()
+
+        self.assertEqual(
+            ["registering",
+             "arg '1' kw1 'no_kw1' kw2 'no_kw2'",
+             "arg '2' kw1 'no_kw1' kw2 'no_kw2'",
+             "arg '3' kw1 'no_kw1' kw2 'no_kw2'",
+             "arg '4' kw1 'no_kw1' kw2 'no_kw2'"],
+            log)
+        self.assertEqual(mgr._before_commit, [])
+
+        reset_log()
+
+    def test_hooks_coalescing(self):
+
+        # Registrations with the same key are coalesced in the first one,
+        # keeping its position, until it is executed.
+
+        mgr = BeforeCommitSubscribersManager(FakeTransaction())
+
+        def merge(old_args, old_kws, args, kws):
+            kws = kws.copy()
+            kws['kw1'] = old_kws.get('kw1', '') + kws['kw1']
+            return old_args, kws
+
+        mgr.addSubscriber(hook, '1', {'kw1': 'a'}, key='k1', merge=merge)
+        mgr.addSubscriber(hook, '2', key='k2')
+        mgr.addSubscriber(hook, '3', {'kw1': 'b'}, key='k1', merge=merge)
+        mgr.addSubscriber(hook, '4', key='k2')
+        mgr.addSubscriber(hook, '5', order=-1, key='k2')
+        mgr.addSubscriber(hook, '6')
+        self.assertEqual(len(mgr._before_commit), 3)
+
+        mgr()
+
+        self.assertEqual(
+            ["arg '1' kw1 'ab' kw2 'no_kw2'",
+             "arg '2' kw1 'no_kw1' kw2 'no_kw2'",
+             "arg '6' kw1 'no_kw1' kw2 'no_kw2'"],
+            log)
+        self.assertEqual(mgr._before_commit_keys, {})
+        reset_log()
+
+        # Once executed, a key can be registered again
+        def coalesced_hook():
+            mgr.addSubscriber(hook, '2', key='k1')
+        mgr.addSubscriber(coalesced_hook, key='k1')
+        mgr()
+        self.assertEqual(["arg '2' kw1 'no_kw1' kw2 'no_kw2'"], log)
+
+        reset_log()
+
 class BeforeCommitSubscribersManagerIntegrationTest(unittest.TestCase):
 
     # These really test the beforeCommitHook on a real transaction
@@ -264,10 +336,111 @@ class BeforeCommitSubscribersManagerIntegrationTest(unittest.TestCase):
         self.assertEqual(
             getattr(transaction.get(), _CPS_BCH_TXN_ATTRIBUTE, _marker), None)
 
+class FlushedSubscriber(BeforeCommitSubscriber):
+    """Counts the processed keys in a persistent mapping."""
+
+    def __init__(self, mgr, data):
+        self.queue = []
+        self.data = data
+        BeforeCommitSubscriber.__init__(self, mgr)
+
+    def push(self, key):
+        self.queue.append(key)
+
+    def __call__(self):
+        queue = self.queue
+        self.queue = []
+        for key in queue:
+            log.append("process %s" % key)
+            self.data[key] = self.data.get(key, 0) + 1
+            if key == 'nested':
+                # As a catalog subtransaction would
+                savepoint()
+                transaction.savepoint()
+
+    def _getSavepointState(self):
+        return self.queue[:]
+
+    def _restoreSavepointState(self, state):
+        self.queue = state[:]
+
+class SavepointFlusherTest(unittest.TestCase):
+
+    # The flushed writes and the queue are rolled back together
+
+    def setUp(self):
+        transaction.abort()
+        self.db = DB(MappingStorage())
+        self.conn = self.db.open()
+        self.data = self.conn.root()
+
+    def tearDown(self):
+        transaction.abort()
+        self.conn.close()
+        self.db.close()
+        reset_log()
+
+    def checkRollback(self):
+        sub = FlushedSubscriber(get_before_commit_subscribers_manager(),
+                                self.data)
+        sub.setFlushAtSavepoint(True)
+        sub.push('a')
+        sp = savepoint()
+        self.assertEqual(log, ['process a'])
+        self.data['other'] = 1
+        sub.push('b')
+        sp.rollback()
+        transaction.commit()
+        self.assertEqual(log, ['process a'])
+        self.assertEqual(self.data.get('a'), 1)
+        self.failIf('b' in self.data)
+        self.failIf('other' in self.data)
+
+    def test_rollback_joined_during_flush(self):
+        # The connection joins the transaction during the flush
+        transaction.begin()
+        self.checkRollback()
+
+    def test_rollback_joined_before_flusher(self):
+        # The connection has joined the transaction before the flusher
+        transaction.begin()
+        self.data['x'] = 1
+        self.checkRollback()
+        self.assertEqual(self.data['x'], 1)
+
+    def test_nested_savepoint(self):
+        # Savepoints taken during a flush don't flush again
+        transaction.begin()
+        sub = FlushedSubscriber(get_before_commit_subscribers_manager(),
+                                self.data)
+        sub.setFlushAtSavepoint(True)
+        sub.push('nested')
+        sub.push('a')
+        savepoint()
+        self.assertEqual(log, ['process nested', 'process a'])
+        transaction.commit()
+        self.assertEqual(log, ['process nested', 'process a'])
+
+    def test_transaction_savepoint(self):
+        # Savepoints taken directly don't flush, but still restore the
+        # queue
+        transaction.begin()
+        sub = FlushedSubscriber(get_before_commit_subscribers_manager(),
+                                self.data)
+        sub.setFlushAtSavepoint(True)
+        sub.push('a')
+        sp = transaction.savepoint()
+        self.assertEqual(log, [])
+        sub.push('b')
+        sp.rollback()
+        transaction.commit()
+        self.assertEqual(log, ['process a'])
+
 def test_suite():
     return unittest.TestSuite((
         unittest.makeSuite(BeforeCommitSubscribersManagerTest),
         unittest.makeSuite(BeforeCommitSubscribersManagerIntegrationTest),
+        unittest.makeSuite(SavepointFlusherTest),
         ))
 
 if __name__ == '__main__':
@@ -0,0 +1,139 @@
+# -*- coding: iso-8859-15 -*-
+# (C) Copyright 2012 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Tests for bulk operations
+"""
+
+import unittest
+import transaction
+
+from Products.CPSCore.IndexationManager import get_indexation_manager
+from Products.CPSCore.TreeCacheManager import get_treecache_manager
+from Products.CPSCore.bulkoperation import BulkOperation
+from Products.CPSCore.bulkoperation import get_bulk_operation
+from Products.CPSCore.bulkoperation import start_bulk_operation
+
+
+class FakeEventService:
+
+    def __init__(self):
+        self.log = []
+
+    def notify(self, event_type, ob, infos):
+        # Same hook as EventServiceTool.notify
+        bulk = get_bulk_operation()
+        if bulk is not None and bulk.recordEvent(self, event_type, ob, infos):
+            return
+        self.log.append((event_type, ob.getPhysicalPath()))
+
+
+class FakeContent:
+
+    def __init__(self, id):
+        self.id = id
+
+    def getPhysicalPath(self):
+        return ('', self.id)
+
+
+class BulkOperationTest(unittest.TestCase):
+
+    def setUp(self):
+        transaction.begin()
+        self.evtool = FakeEventService()
+        self.ob = FakeContent('ob')
+        self.other = FakeContent('other')
+
+    def tearDown(self):
+        transaction.abort()
+
+    def test_bound_to_transaction(self):
+        self.assertEquals(get_bulk_operation(), None)
+        bulk = start_bulk_operation()
+        self.assertEquals(get_bulk_operation(), bulk)
+        self.assert_(bulk.isActive())
+        self.assert_(get_indexation_manager().isBulk())
+        self.assert_(get_treecache_manager().isBulk())
+        self.assertRaises(ValueError, start_bulk_operation)
+        transaction.abort()
+        self.assertEquals(get_bulk_operation(), None)
+
+    def test_coalesced_events(self):
+        evtool = self.evtool
+        bulk = start_bulk_operation()
+        evtool.notify('sys_add_object', self.ob, {})
+        evtool.notify('sys_modify_object', self.ob, {})
+        evtool.notify('sys_modify_object', self.ob, {})
+        evtool.notify('sys_modify_object', self.other, {})
+        evtool.notify('sys_modify_security', self.ob, {})
+        evtool.notify('sys_modify_object', self.ob, {})
+        # Only events that can't be coalesced are dispatched
+        self.assertEquals(evtool.log, [('sys_add_object', ('', 'ob'))])
+        bulk.finish()
+        self.failIf(bulk.isActive())
+        self.failIf(get_indexation_manager().isBulk())
+        self.failIf(get_treecache_manager().isBulk())
+        self.assertEquals(evtool.log, [
+            ('sys_add_object', ('', 'ob')),
+            ('sys_modify_object', ('', 'ob')),
+            ('sys_modify_object', ('', 'other')),
+            ('sys_modify_security', ('', 'ob')),
+            ])
+
+    def test_catch_up_at_commit(self):
+        evtool = self.evtool
+        start_bulk_operation()
+        evtool.notify('sys_modify_object', self.ob, {})
+        self.assertEquals(evtool.log, [])
+        transaction.commit()
+        self.assertEquals(evtool.log, [('sys_modify_object', ('', 'ob'))])
+        self.assertEquals(get_bulk_operation(), None)
+
+    def test_abort(self):
+        evtool = self.evtool
+        bulk = start_bulk_operation()
+        evtool.notify('sys_modify_object', self.ob, {})
+        bulk.abort()
+        self.failIf(bulk.isActive())
+        self.failIf(get_indexation_manager().isBulk())
+        transaction.commit()
+        self.assertEquals(evtool.log, [])
+
+    def test_context_manager(self):
+        evtool = self.evtool
+        bulk = BulkOperation()
+        self.assertEquals(bulk.__enter__(), bulk)
+        evtool.notify('sys_modify_object', self.ob, {})
+        bulk.__exit__(None, None, None)
+        self.assertEquals(evtool.log, [('sys_modify_object', ('', 'ob'))])
+
+        bulk = BulkOperation()
+        bulk.__enter__()
+        evtool.notify('sys_modify_object', self.ob, {})
+        self.assertEquals(bulk.__exit__(ValueError, ValueError(), None),
+                          False)
+        self.assertEquals(len(evtool.log), 1)
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(BulkOperationTest),
+        ))
+
+if __name__ == '__main__':
+    unittest.TextTestRunner().run(test_suite())
@@ -0,0 +1,175 @@
+# -*- coding: iso-8859-15 -*-
+# (C) Copyright 2012 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Tests for the after commit subscribers background executor
+"""
+
+import unittest
+import logging
+import threading
+import time
+
+from Products.CPSCore.commitexecutor import AfterCommitExecutor
+from Products.CPSCore.commitexecutor import get_after_commit_executor
+from Products.CPSCore.commithooks import AfterCommitSubscribersManager
+
+class FakeTransaction:
+    def addAfterCommitHook(self, hook):
+        pass
+
+log = []
+
+def hook(*args):
+    log.append((threading.currentThread().getName(),) + args)
+
+def failing_hook():
+    raise ValueError("failing")
+
+class BlockingHook:
+    """Blocks the worker until released."""
+    def __init__(self):
+        self.started = threading.Event()
+        self.released = threading.Event()
+    def __call__(self):
+        self.started.set()
+        self.released.wait()
+
+class AfterCommitExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        del log[:]
+        self.executor = AfterCommitExecutor()
+        # Don't pollute the output with expected errors
+        self.logger = logging.getLogger('CPSCore.commitexecutor')
+        self.logger.disabled = True
+
+    def tearDown(self):
+        self.executor.disable()
+        self.logger.disabled = False
+        del log[:]
+
+    def test_disabled(self):
+        self.failIf(self.executor.isEnabled())
+        self.failIf(self.executor.submit(hook, (1,)))
+        self.assertEquals(self.executor.drain(), 0)
+        self.assertEquals(log, [])
+
+    def test_ordering(self):
+        self.executor.enable(workers=1)
+        for i in range(20):
+            self.assert_(self.executor.submit(hook, (i,)))
+        self.assertEquals(self.executor.drain(), 0)
+        self.assertEquals([entry[1] for entry in log], range(20))
+        self.assertEquals(log[0][0], 'CPSAfterCommitWorker-0')
+        self.assertEquals(self.executor.executed, 20)
+
+        # Workers are started again on next submission
+        self.assert_(self.executor.submit(hook, (20,)))
+        self.executor.drain()
+        self.assertEquals(len(log), 21)
+
+    def test_errors(self):
+        self.executor.enable(workers=1)
+        self.executor.submit(failing_hook)
+        self.executor.submit(hook, (1,))
+        self.executor.drain()
+        self.assertEquals(self.executor.errors, 1)
+        self.assertEquals([entry[1:] for entry in log], [(1,)])
+
+    def test_back_pressure(self):
+        self.executor.enable(workers=1, queue_size=1, put_timeout=0.01)
+        blocking = BlockingHook()
+        self.assert_(self.executor.submit(blocking))
+        blocking.started.wait()
+        self.assert_(self.executor.submit(hook, (1,)))
+        # The queue is full: the caller has to run it inline
+        self.failIf(self.executor.submit(hook, (2,)))
+        self.assertEquals(self.executor.rejected, 1)
+        blocking.released.set()
+        self.executor.drain()
+        self.assertEquals([entry[1:] for entry in log], [(1,)])
+
+    def test_overrun(self):
+        self.executor.enable(workers=1, call_timeout=-1)
+        self.executor.submit(hook, (1,))
+        self.executor.drain()
+        self.assertEquals(self.executor.overruns, 1)
+
+    def test_drain_timeout(self):
+        self.executor.enable(workers=1, queue_size=10)
+        blocking = BlockingHook()
+        self.executor.submit(blocking)
+        blocking.started.wait()
+        self.executor.submit(hook, (1,))
+        # The queued call is dropped, the running one is reported
+        self.assertEquals(self.executor.drain(timeout=0.05), 2)
+        self.assertEquals(len(self.executor.getRunning()), 1)
+        blocking.released.set()
+        self.assertEquals(log, [])
+
+    def test_drain_waits_running(self):
+        self.executor.enable(workers=1)
+        def slow_hook():
+            time.sleep(0.1)
+            hook('slow')
+        self.executor.submit(slow_hook)
+        # Wait for the worker to take it
+        while not self.executor.getRunning():
+            time.sleep(0.001)
+        self.assertEquals(self.executor.drain(), 0)
+        self.assertEquals([entry[1:] for entry in log], [('slow',)])
+        self.assertEquals(self.executor.executed, 1)
+
+    def test_counters(self):
+        self.executor.enable(workers=4)
+        for i in range(200):
+            self.assert_(self.executor.submit(hook, (i,)))
+        self.assertEquals(self.executor.drain(), 0)
+        self.assertEquals(self.executor.submitted, 200)
+        self.assertEquals(self.executor.executed, 200)
+        self.assertEquals(len(log), 200)
+
+    def test_manager(self):
+        executor = get_after_commit_executor()
+        executor.enable(workers=1)
+        try:
+            mgr = AfterCommitSubscribersManager(FakeTransaction())
+            mgr.addSubscriber(hook, (1,), background=True)
+            mgr.addSubscriber(hook, (2,))
+            mgr()
+            executor.drain()
+        finally:
+            executor.disable()
+        log.sort()
+        self.assertEquals(log, [('CPSAfterCommitWorker-0', True, 1),
+                                ('MainThread', True, 2)])
+
+        # Disabled executor: run inline
+        del log[:]
+        mgr.addSubscriber(hook, (1,), background=True)
+        mgr()
+        self.assertEquals(log, [('MainThread', True, 1)])
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(AfterCommitExecutorTest),
+        ))
+
+if __name__ == '__main__':
+    unittest.TextTestRunner().run(test_suite())
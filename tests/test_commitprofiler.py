@@ -0,0 +1,143 @@
+# -*- coding: iso-8859-15 -*-
+# (C) Copyright 2012 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Tests for the commit subscribers profiler
+"""
+
+import unittest
+
+from Products.CPSCore.commitprofiler import CommitProfiler
+from Products.CPSCore.commitprofiler import RollingStatistics
+from Products.CPSCore.commitprofiler import get_commit_profiler
+from Products.CPSCore.commitprofiler import subscriber_name
+from Products.CPSCore.commitprofiler import percentile
+from Products.CPSCore.commitprofiler import BEFORE_COMMIT, TOTAL
+from Products.CPSCore.commithooks import BeforeCommitSubscribersManager
+
+class FakeTransaction:
+    def addBeforeCommitHook(self, hook):
+        pass
+
+def hook(*args, **kws):
+    pass
+
+class QueuedSubscriber:
+    def __init__(self):
+        self.queue = [1, 2, 3]
+    def queueSize(self):
+        return len(self.queue)
+    def __call__(self):
+        self.queue = []
+
+class CommitProfilerTest(unittest.TestCase):
+
+    def getStats(self, profiler, name):
+        for stats in profiler.getStatistics():
+            if stats['subscriber'] == name:
+                return stats
+        self.fail("No statistics for %s" % name)
+
+    def test_subscriber_name(self):
+        self.assertEquals(subscriber_name(hook), '%s.hook' % __name__)
+        sub = QueuedSubscriber()
+        self.assertEquals(subscriber_name(sub),
+                          '%s.QueuedSubscriber' % __name__)
+        self.assertEquals(subscriber_name(sub.queueSize),
+                          '%s.QueuedSubscriber.queueSize' % __name__)
+
+    def test_percentile(self):
+        values = range(101)
+        self.assertEquals(percentile(values, 0.5), 50)
+        self.assertEquals(percentile(values, 0.95), 95)
+        self.assertEquals(percentile([], 0.5), 0.0)
+
+    def test_rolling_window(self):
+        stats = RollingStatistics(3)
+        for value in (10.0, 1.0, 2.0, 3.0):
+            stats.add(value, 1, None)
+        summary = stats.summary()
+        self.assertEquals(summary['transactions'], 4)
+        self.assertEquals(summary['calls'], 4)
+        # The first value went out of the window
+        self.assertEquals(summary['p95'], 3.0)
+        self.assertEquals(summary['max'], 3.0)
+
+    def test_phase(self):
+        profiler = CommitProfiler()
+        sub = QueuedSubscriber()
+        record = profiler.startPhase(BEFORE_COMMIT, 3)
+        record.call(hook, (), {})
+        record.call(hook, (1,), {'a': 2})
+        record.call(sub, (), {})
+        profiler.endPhase(record)
+
+        stats = self.getStats(profiler, '%s.hook' % __name__)
+        self.assertEquals(stats['phase'], BEFORE_COMMIT)
+        self.assertEquals(stats['transactions'], 1)
+        self.assertEquals(stats['calls'], 2)
+        stats = self.getStats(profiler, '%s.QueuedSubscriber' % __name__)
+        self.assertEquals(stats['calls'], 1)
+        self.assertEquals(stats['queue_max'], 3)
+        stats = self.getStats(profiler, TOTAL)
+        self.assertEquals(stats['calls'], 3)
+        self.assertEquals(stats['queue_max'], 3)
+
+        profiler.reset()
+        self.assertEquals(profiler.getStatistics(), [])
+
+    def test_slow_commits(self):
+        profiler = CommitProfiler(slow_threshold=-1)
+        record = profiler.startPhase(BEFORE_COMMIT, 1)
+        record.call(hook, (), {})
+        profiler.endPhase(record)
+        self.assertEquals(profiler.slow_commits, 1)
+        profiler.setSlowThreshold(None)
+        record = profiler.startPhase(BEFORE_COMMIT, 1)
+        profiler.endPhase(record)
+        self.assertEquals(profiler.slow_commits, 1)
+
+    def test_disabled(self):
+        profiler = CommitProfiler()
+        # Enabled by default
+        self.failIf(profiler.startPhase(BEFORE_COMMIT, 0) is None)
+        profiler.disable()
+        self.assertEquals(profiler.startPhase(BEFORE_COMMIT, 0), None)
+        profiler.enable()
+        self.failIf(profiler.startPhase(BEFORE_COMMIT, 0) is None)
+
+    def test_manager(self):
+        profiler = get_commit_profiler()
+        profiler.reset()
+        profiler.enable()
+        mgr = BeforeCommitSubscribersManager(FakeTransaction())
+        mgr.addSubscriber(hook)
+        mgr.addSubscriber(hook)
+        mgr()
+        stats = self.getStats(profiler, '%s.hook' % __name__)
+        self.assertEquals(stats['calls'], 2)
+        self.assertEquals(self.getStats(profiler, TOTAL)['queue_max'], 2)
+        profiler.reset()
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(CommitProfilerTest),
+        ))
+
+if __name__ == '__main__':
+    unittest.TextTestRunner().run(test_suite())
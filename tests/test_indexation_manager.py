@@ -29,6 +29,10 @@ from Products.CPSCore.IndexationManager import get_indexation_manager
 from Products.CPSCore.IndexationManager import ACTION_INDEX
 from Products.CPSCore.IndexationManager import ACTION_UNINDEX
 from Products.CPSCore.IndexationManager import ACTION_REINDEX
+from Products.CPSCore.IndexationManager import get_indexation_counters
+from Products.CPSCore.indexationstats import get_indexation_statistics
+from Products.CPSCore.indexationstats import TIMERS
+from Products.CPSCore.commithooks import savepoint
 
 import transaction
 
@@ -51,16 +55,28 @@ class FakeRoot:
         return id
 
     def unrestrictedTraverse(self, path, default):
-        dummy, id = path
-        assert dummy == ''
-        return self.getContent(int(id))
+        if isinstance(path, str):
+            # The root is the only container
+            path = ('', path)
+        if path == ('',):
+            return self
+        assert path[0] == ''
+        ob = self.getContent(int(path[1]))
+        for id in path[2:]:
+            if ob is None:
+                break
+            ob = ob.unrestrictedTraverse(id, None)
+        return ob
 
-    def addContent(self, cls=None):
+    def addContent(self, cls=None, parent=None):
         id = self.generateId()
         if cls is None:
             cls = FakeContent
         ob = cls(id)
         self.__objects__[id] = ob
+        if parent is not None:
+            ob.parent = parent
+            parent.children[str(id)] = ob
         return ob
 
     def getContent(self, id):
@@ -82,13 +98,25 @@ class FakeCatalog:
         ob.unindex(path=path)
 
 
+class FakeCPSCatalog:
+    """Catalog supporting batches."""
+
+    def catalogCPSObjects(self, items):
+        for ob, uid, idxs in items:
+            ob.log.append('catalog %s %r' % (uid, idxs))
+
+FakeRoot.portal_catalog = FakeCPSCatalog()
+
+
 class FakeContent:
 
     portal_catalog = FakeCatalog()
+    parent = None
 
     def __init__(self, id):
         self.id = id
         self.log = []
+        self.children = {}
 
     def getLog(self):
         # get and clear log
@@ -100,7 +128,12 @@ class FakeContent:
         return root
 
     def getPhysicalPath(self):
-        return ('', str(self.id))
+        if self.parent is None:
+            return ('', str(self.id))
+        return self.parent.getPhysicalPath() + (str(self.id),)
+
+    def unrestrictedTraverse(self, id, default):
+        return self.children.get(id, default)
 
     def _reindexObject(self, idxs=[]):
         self.log.append('idxs %s %r' % (self.id, idxs))
@@ -108,6 +141,9 @@ class FakeContent:
     def _reindexObjectSecurity(self, skip_self=False):
         self.log.append('secu %s %r' % (self.id, skip_self))
 
+    def _notifySecurityModified(self):
+        self.log.append('notify secu %s' % self.id)
+
     def unindex(self, path=None):
         """Specific of FakeContent"""
         msg = 'Unindex %s' % self.id
@@ -126,6 +162,17 @@ class FakeContentCausingReindex(FakeContent):
         FakeContent._reindexObject(self, idxs)
 
 
+class FakeProxy(FakeContent):
+    """Content whose cataloging can be done in batches."""
+
+    def _prepareReindexObject(self, idxs=[]):
+        self.log.append('prepare %s %r' % (self.id, idxs))
+        return idxs
+
+    def notifyModified(self):
+        self.log.append('modified %s' % self.id)
+
+
 class IndexationManagerTest(unittest.TestCase):
 
     def tearDown(self):
@@ -258,6 +305,25 @@ class IndexationManagerTest(unittest.TestCase):
                           ["idxs %s ['allowedRolesAndUsers', 'foo']"%dummy.id,
                            "secu %s True"%dummy.id])
 
+    def test_secu_coalescing(self):
+        # Security reindexing recurses, so descendants of an object whose
+        # security is reindexed don't need their own
+        mgr, folder = self.get_stuff()
+        sub = root.addContent(parent=folder)
+        doc = root.addContent(parent=sub)
+        other = root.addContent()
+        mgr.push(doc, idxs=['foo'], with_security=True)
+        mgr.push(sub, with_security=True)
+        mgr.push(other, with_security=True)
+        mgr.push(folder, with_security=True)
+        mgr()
+        self.assertEquals(folder.getLog(), ["secu %s None" % folder.id])
+        # Their security events are still sent
+        self.assertEquals(sub.getLog(), ["notify secu %s" % sub.id])
+        self.assertEquals(doc.getLog(), ["idxs %s ['foo']" % doc.id,
+                                         "notify secu %s" % doc.id])
+        self.assertEquals(other.getLog(), ["secu %s None" % other.id])
+
     def test_index_unindex(self):
         # index + unindex == nothing to do
         mgr, dummy = self.get_stuff()
@@ -327,6 +393,86 @@ class IndexationManagerTest(unittest.TestCase):
         self.assertEquals(dummy.getLog(), ['idxs %s []' % dummy.id,
                                            "secu %s True" %dummy.id])
 
+    def test_reindex_unindex_reindex(self):
+        # the object is processed once, at its last position
+        mgr, dummy = self.get_stuff()
+        other = root.addContent()
+        mgr.push(dummy, idxs=['foo'], action=ACTION_REINDEX)
+        mgr.push(other, idxs=['bar'])
+        mgr.push(dummy, action=ACTION_UNINDEX)
+        mgr.push(dummy, idxs=['foo'], action=ACTION_REINDEX)
+        self.assertEquals(len(mgr._infos), 2)
+        log = []
+        dummy.log = other.log = log
+        mgr()
+        self.assertEquals(log, ["idxs %s ['bar']" % other.id,
+                                "idxs %s []" % dummy.id])
+
+    def test_spill(self):
+        mgr, dummy = self.get_stuff()
+        mgr.SPILL_THRESHOLD = 1
+        other = root.addContent()
+        removed = root.addContent()
+        mgr.push(dummy, idxs=['foo'])
+        mgr.push(other, idxs=['bar'], with_security=True)
+        mgr.push(removed, idxs=['bar'])
+        mgr.push(other, idxs=['baz'])
+        infos = [mgr._infos[i] for i, info in mgr._queue]
+        self.assertEquals(infos[0]['object'], dummy)
+        self.assertEquals(infos[1]['object'], None)
+        self.assertEquals(infos[1]['idxs'], ['bar', 'baz'])
+        self.assertEquals(infos[2]['object'], None)
+        del root.__objects__[removed.id]
+        mgr()
+        self.assertEquals(dummy.getLog(), ["idxs %s ['foo']" % dummy.id])
+        self.assertEquals(other.getLog(), ["idxs %s ['bar', 'baz']" % other.id,
+                                           "secu %s False" % other.id])
+        self.assertEquals(removed.getLog(), [])
+
+    def test_spill_unindex(self):
+        # Objects to unindex are kept, they can't be traversed anymore
+        mgr, dummy = self.get_stuff()
+        mgr.SPILL_THRESHOLD = 0
+        mgr.push(dummy, idxs=['foo'], action=ACTION_REINDEX)
+        self.assertEquals(mgr._infos.values()[0]['object'], None)
+        mgr.push(dummy, action=ACTION_UNINDEX)
+        self.assertEquals(mgr._infos.values()[0]['object'], dummy)
+        del root.__objects__[dummy.id]
+        mgr()
+        did = dummy.id
+        self.assertEquals(dummy.getLog(), ["Unindex %s path=/%s" % (did, did)])
+
+    def test_bulk(self):
+        # In bulk mode, everything is spilled
+        mgr, dummy = self.get_stuff()
+        mgr.startBulk()
+        self.assert_(mgr.isBulk())
+        mgr.push(dummy, idxs=['foo'])
+        self.assertEquals(mgr._infos.values()[0]['object'], None)
+        mgr.endBulk()
+        self.failIf(mgr.isBulk())
+        mgr()
+        self.assertEquals(dummy.getLog(), ["idxs %s ['foo']" % dummy.id])
+
+    def test_detach_attach(self):
+        mgr, dummy = self.get_stuff()
+        other = root.addContent()
+        mgr.push(dummy, idxs=['foo'])
+        mgr.push(other, idxs=['bar'])
+        queue, qroot = mgr.detachQueue()
+        self.assertEquals(len(queue), 2)
+        self.assertEquals(mgr._queue, [])
+        mgr()
+        self.assertEquals(dummy.getLog(), [])
+        # Attached to a new manager, merged with what's there
+        mgr, dummy2 = self.get_stuff()
+        mgr.push(other, idxs=['baz'])
+        mgr.attachQueue(queue, qroot)
+        mgr()
+        self.assertEquals(dummy.getLog(), ["idxs %s ['foo']" % dummy.id])
+        self.assertEquals(other.getLog(), ["idxs %s ['baz', 'bar']"
+                                           % other.id])
+
     def test_synchronous(self):
         mgr, dummy = self.get_stuff()
         self.assertEquals(dummy.getLog(), [])
@@ -421,6 +567,69 @@ class IndexationManagerTest(unittest.TestCase):
         # Object is gone from queue after that.
         self.assertEquals(dummy.getLog(), [])
 
+class BatchIndexationManagerTest(IndexationManagerTest):
+
+    # Same tests, with the batch processing
+
+    def get_stuff(self):
+        mgr, dummy = IndexationManagerTest.get_stuff(self)
+        mgr.BATCH_THRESHOLD = 1
+        return mgr, dummy
+
+    def test_reindex_unindex_reindex(self):
+        # Batches are processed in path order
+        mgr, dummy = self.get_stuff()
+        other = root.addContent()
+        mgr.push(dummy, idxs=['foo'], action=ACTION_REINDEX)
+        mgr.push(other, idxs=['bar'])
+        mgr.push(dummy, action=ACTION_UNINDEX)
+        mgr.push(dummy, idxs=['foo'], action=ACTION_REINDEX)
+        self.assertEquals(len(mgr._infos), 2)
+        mgr()
+        self.assertEquals(dummy.getLog(), ["idxs %s []" % dummy.id])
+        self.assertEquals(other.getLog(), ["idxs %s ['bar']" % other.id])
+
+    def test_batch(self):
+        mgr = IndexationManager(FakeBeforeCommitSubscribersManager())
+        mgr.BATCH_THRESHOLD = 3
+        proxies = [root.addContent(cls=FakeProxy) for i in range(4)]
+        proxies.sort(key=lambda ob: ob.id)
+        p1, p2, p3, p4 = proxies
+        mgr.push(p3, idxs=['foo'], with_security=True)
+        mgr.push(p2, idxs=[])
+        mgr.push(p1, idxs=['foo'])
+        mgr.push(p4, action=ACTION_UNINDEX)
+        mgr()
+        self.assertEquals(p1.getLog(), ["prepare %s ['foo']" % p1.id,
+                                        "catalog /%s ['foo']" % p1.id])
+        self.assertEquals(p2.getLog(), ["prepare %s []" % p2.id,
+                                        "modified %s" % p2.id,
+                                        "catalog /%s []" % p2.id])
+        self.assertEquals(p3.getLog(), ["prepare %s ['foo']" % p3.id,
+                                        "catalog /%s ['foo']" % p3.id,
+                                        "secu %s False" % p3.id])
+        self.assertEquals(p4.getLog(), ["Unindex %s path=/%s"
+                                        % (p4.id, p4.id)])
+        self.assertEquals(mgr._queue, [])
+        self.assertEquals(mgr._infos, {})
+
+    def test_batch_below_threshold(self):
+        mgr = IndexationManager(FakeBeforeCommitSubscribersManager())
+        mgr.BATCH_THRESHOLD = 2
+        proxy = root.addContent(cls=FakeProxy)
+        mgr.push(proxy, idxs=['foo'])
+        mgr()
+        self.assertEquals(proxy.getLog(), ["idxs %s ['foo']" % proxy.id])
+
+    def test_batch_disappeared(self):
+        mgr, dummy = self.get_stuff()
+        proxy = root.addContent(cls=FakeProxy)
+        mgr.push(proxy, idxs=[])
+        root.clear()
+        mgr()
+        self.assertEquals(proxy.getLog(), [])
+
+
 class TransactionIndexationManagerTest(unittest.TestCase):
 
     # These really test the beforeCommitHook
@@ -462,10 +671,114 @@ class TransactionIndexationManagerTest(unittest.TestCase):
         self.assertEquals(other.getLog(), ["idxs %s ['bob']" % other.id])
         root.clear()
 
+    def test_transaction_savepoint(self):
+        transaction.begin()
+        mgr = get_indexation_manager()
+        mgr.setFlushAtSavepoint(True)
+        self.assert_(mgr.isFlushAtSavepoint())
+        dummy = root.addContent()
+        mgr.push(dummy, idxs=['bar'])
+        savepoint()
+        # Flushed
+        self.assertEquals(dummy.getLog(), ["idxs %s ['bar']" % dummy.id])
+        self.assertEquals(mgr._infos, {})
+        mgr.push(dummy, idxs=['baz'])
+        transaction.commit()
+        self.assertEquals(dummy.getLog(), ["idxs %s ['baz']" % dummy.id])
+        root.clear()
+
+    def test_transaction_savepoint_rollback(self):
+        transaction.begin()
+        mgr = get_indexation_manager()
+        mgr.setFlushAtSavepoint(True)
+        dummy = root.addContent()
+        other = root.addContent()
+        mgr.push(dummy, idxs=['bar'])
+        sp = savepoint()
+        self.assertEquals(dummy.getLog(), ["idxs %s ['bar']" % dummy.id])
+        mgr.push(other, idxs=['baz'])
+        # The work queued after the savepoint is dropped, the flushed
+        # work is kept
+        sp.rollback()
+        self.assertEquals(mgr._infos, {})
+        mgr.push(dummy, idxs=['foo'])
+        # Rolling back twice to the same savepoint is possible
+        sp.rollback()
+        transaction.commit()
+        # Nothing is processed twice
+        self.assertEquals(dummy.getLog(), [])
+        self.assertEquals(other.getLog(), [])
+        root.clear()
+
+    def test_transaction_savepoint_not_flushed(self):
+        transaction.begin()
+        mgr = get_indexation_manager()
+        mgr.setFlushAtSavepoint(True)
+        mgr.setFlushAtSavepoint(False)
+        self.failIf(mgr.isFlushAtSavepoint())
+        dummy = root.addContent()
+        mgr.push(dummy, idxs=['bar'])
+        savepoint()
+        self.assertEquals(dummy.getLog(), [])
+        transaction.commit()
+        self.assertEquals(dummy.getLog(), ["idxs %s ['bar']" % dummy.id])
+        root.clear()
+
+    def test_transaction_counters(self):
+        transaction.begin()
+        mgr = get_indexation_manager()
+        dummy = root.addContent()
+        other = root.addContent()
+        new = root.addContent()
+        mgr.push(dummy, idxs=['foo'])
+        mgr.push(dummy, idxs=['bar'], with_security=True)
+        mgr.push(other, idxs=['baz'], action=ACTION_REINDEX)
+        mgr.push(other, action=ACTION_UNINDEX)
+        mgr.push(new, idxs=[])
+        mgr.push(new, action=ACTION_UNINDEX)
+        counters = get_indexation_counters()
+        self.assertEquals(counters['pushes'], 6)
+        self.assertEquals(counters['idxs_merges'], 1)
+        self.assertEquals(counters['cancellations'], 2)
+        self.assertEquals(counters['processed'], 0)
+        stats = get_indexation_statistics()
+        stats.reset()
+        transaction.commit()
+        # dummy indexed, other unindexed
+        self.assertEquals(counters['processed'], 2)
+        self.assertEquals(counters['secu_reindexes'], 1)
+        for name in TIMERS:
+            self.assert_(counters[name] >= 0.0)
+        # Recorded after commit
+        self.assertEquals(stats.transactions, 1)
+        summary = dict([(s['name'], s) for s in stats.getStatistics()])
+        self.assertEquals(summary['pushes']['total'], 6)
+        # A new transaction has new counters
+        self.assertEquals(get_indexation_counters()['pushes'], 0)
+        root.clear()
+
+    def test_transaction_counters_aborted(self):
+        transaction.begin()
+        stats = get_indexation_statistics()
+        stats.reset()
+        get_indexation_manager().push(root.addContent(), idxs=['foo'])
+        transaction.abort()
+        self.assertEquals(stats.transactions, 0)
+        root.clear()
+
+    def test_transaction_nested_batch(self):
+        threshold = IndexationManager.BATCH_THRESHOLD
+        IndexationManager.BATCH_THRESHOLD = 1
+        try:
+            self.test_transaction_nested()
+        finally:
+            IndexationManager.BATCH_THRESHOLD = threshold
+
 
 def test_suite():
     return unittest.TestSuite((
         unittest.makeSuite(IndexationManagerTest),
+        unittest.makeSuite(BatchIndexationManagerTest),
         unittest.makeSuite(TransactionIndexationManagerTest),
         ))
 
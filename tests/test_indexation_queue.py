@@ -0,0 +1,371 @@
+# -*- coding: iso-8859-15 -*-
+# (C) Copyright 2012 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Tests for the deferred indexation queue
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import transaction
+
+from ZODB.DB import DB
+from ZODB.FileStorage import FileStorage
+from ZODB.POSException import ConflictError
+
+from Products.CPSCore.IndexationManager import IndexationManager
+from Products.CPSCore.IndexationManager import ACTION_INDEX
+from Products.CPSCore.IndexationManager import ACTION_REINDEX
+from Products.CPSCore.IndexationManager import ACTION_UNINDEX
+from Products.CPSCore.indexationqueue import IndexationQueue
+from Products.CPSCore.indexationqueue import get_indexation_queue
+from Products.CPSCore.indexationqueue import process_indexation_queue
+from Products.CPSCore.indexationqueue import flush_indexation_queue
+
+class FakeBeforeCommitSubscribersManager:
+    def addSubscriber(self, hook, order):
+        pass
+
+log = []
+
+class FakeCatalog:
+
+    def getPhysicalRoot(self):
+        return root
+
+    def indexes(self):
+        return ['path', 'allowedRolesAndUsers', 'Title', 'SearchableText']
+
+    def catalogCPSObjects(self, items):
+        for ob, uid, idxs in items:
+            log.append(('catalog', uid, idxs))
+
+    def unindexCPSPath(self, path):
+        log.append(('unindex', path))
+
+class FakeFolder:
+
+    portal_catalog = FakeCatalog()
+
+    def __init__(self, id, path=()):
+        self.id = id
+        self.path = path + (id,)
+        self.items = {}
+
+    def getPhysicalPath(self):
+        return self.path
+
+    def getPhysicalRoot(self):
+        return root
+
+    def unrestrictedTraverse(self, path, default):
+        if isinstance(path, str):
+            path = (path,)
+        ob = self
+        if path[0] == '':
+            ob = root
+            path = path[1:]
+        for id in path:
+            ob = ob.items.get(id)
+            if ob is None:
+                return default
+        return ob
+
+    def add(self, id):
+        ob = self.items[id] = FakeProxy(id, self.path)
+        return ob
+
+class FakeProxy(FakeFolder):
+
+    def _prepareReindexObject(self, idxs=[]):
+        log.append(('prepare', '/'.join(self.path), idxs))
+        return idxs
+
+    def notifyModified(self):
+        log.append(('modified', '/'.join(self.path)))
+
+    def _reindexObjectSecurity(self, skip_self=False):
+        log.append(('secu', '/'.join(self.path), skip_self))
+
+root = FakeFolder('')
+
+
+class IndexationQueueTest(unittest.TestCase):
+
+    def test_push(self):
+        queue = IndexationQueue()
+        queue.push('a', ACTION_INDEX, ['foo'])
+        queue.push('b', ACTION_REINDEX, None, True)
+        queue.push('c', ACTION_UNINDEX)
+        self.assertEquals(len(queue), 3)
+        self.assertEquals(queue.get('a'), (ACTION_INDEX, ('foo',), False))
+        self.assertEquals(queue.get('b'), (ACTION_REINDEX, None, True))
+        self.assertEquals(queue.get('c'), (ACTION_UNINDEX, None, False))
+
+    def test_merge_idxs(self):
+        queue = IndexationQueue()
+        queue.push('a', ACTION_REINDEX, ['foo'])
+        queue.push('a', ACTION_REINDEX, ['bar', 'foo'])
+        self.assertEquals(queue.get('a'),
+                          (ACTION_REINDEX, ('foo', 'bar'), False))
+        queue.push('a', ACTION_REINDEX, None, True)
+        self.assertEquals(queue.get('a'),
+                          (ACTION_REINDEX, ('foo', 'bar'), True))
+        queue.push('a', ACTION_REINDEX, [])
+        self.assertEquals(queue.get('a'), (ACTION_REINDEX, (), True))
+        queue.push('a', ACTION_REINDEX, ['baz'])
+        self.assertEquals(queue.get('a'), (ACTION_REINDEX, (), True))
+        self.assertEquals(len(queue), 1)
+
+    def test_index_unindex(self):
+        # index + unindex == nothing to do
+        queue = IndexationQueue()
+        queue.push('a', ACTION_INDEX, [])
+        queue.push('a', ACTION_UNINDEX)
+        self.assertEquals(queue.get('a'), None)
+        self.assertEquals(len(queue), 0)
+
+    def test_reindex_unindex(self):
+        # reindex + unindex == unindex
+        queue = IndexationQueue()
+        queue.push('a', ACTION_REINDEX, ['foo'], True)
+        queue.push('a', ACTION_UNINDEX)
+        self.assertEquals(queue.get('a'), (ACTION_UNINDEX, None, False))
+
+    def test_unindex_index(self):
+        # unindex + index == full reindex
+        queue = IndexationQueue()
+        queue.push('a', ACTION_UNINDEX)
+        queue.push('a', ACTION_INDEX, ['foo'])
+        self.assertEquals(queue.get('a'), (ACTION_REINDEX, (), False))
+        # and then unindexing still has to be done
+        queue.push('a', ACTION_UNINDEX)
+        self.assertEquals(queue.get('a'), (ACTION_UNINDEX, None, False))
+        self.assertEquals(len(queue), 1)
+
+    def test_batch(self):
+        queue = IndexationQueue()
+        for rpath in ('c', 'a/b', 'a'):
+            queue.push(rpath, ACTION_INDEX, [])
+        batch = queue.getBatch(2)
+        self.assertEquals([rpath for rpath, record in batch], ['a', 'a/b'])
+        # A record changed since it's been read is kept
+        queue.push('a/b', ACTION_REINDEX, None, True)
+        for rpath, record in batch:
+            queue.remove(rpath, record)
+        self.assertEquals(len(queue), 2)
+        self.assertEquals([rpath for rpath, record in queue.getBatch()],
+                          ['a/b', 'c'])
+        queue.clear()
+        self.assertEquals(len(queue), 0)
+
+
+class DeferredIndexationTest(unittest.TestCase):
+
+    def setUp(self):
+        root.items.clear()
+        self.catalog = FakeCatalog()
+        get_indexation_queue(FakeFolder.portal_catalog).clear()
+        del log[:]
+
+    def test_process(self):
+        folder = root.items['folder'] = FakeProxy('folder', ('',))
+        doc = folder.add('doc')
+        other = folder.add('other')
+        queue = get_indexation_queue(self.catalog)
+        self.assert_(get_indexation_queue(self.catalog) is queue)
+        queue.push('folder/other', ACTION_REINDEX, ['foo'])
+        queue.push('folder/doc', ACTION_REINDEX, [], True)
+        queue.push('folder/gone', ACTION_REINDEX, [])
+        queue.push('folder/deleted', ACTION_UNINDEX)
+
+        # Records are processed in path order, unindexings first
+        self.assertEquals(process_indexation_queue(self.catalog, 3), 3)
+        self.assertEquals(log, [('unindex', '/folder/deleted'),
+                                ('catalog', '/folder/doc', []),
+                                ('secu', '/folder/doc', True)])
+        self.assertEquals(len(queue), 1)
+
+        del log[:]
+        self.assertEquals(flush_indexation_queue(self.catalog), 1)
+        self.assertEquals(log, [('catalog', '/folder/other', ['foo'])])
+        self.assertEquals(len(queue), 0)
+        self.assertEquals(flush_indexation_queue(self.catalog), 0)
+
+    def test_manager(self):
+        folder = root.items['folder'] = FakeProxy('folder', ('',))
+        doc = folder.add('doc')
+        mgr = IndexationManager(FakeBeforeCommitSubscribersManager())
+        mgr.setDeferred(True)
+        self.assert_(mgr.isDeferred())
+        mgr.push(doc, idxs=['foo'])
+        mgr.push(folder, idxs=[])
+        mgr()
+        # Objects are prepared at commit time
+        self.assertEquals(log, [('prepare', '/folder/doc', ['foo']),
+                                ('prepare', '/folder', []),
+                                ('modified', '/folder')])
+        self.assertEquals(mgr._infos, {})
+        del log[:]
+
+        queue = get_indexation_queue(FakeFolder.portal_catalog)
+        self.assertEquals(queue.get('folder/doc'),
+                          (ACTION_INDEX, ('foo',), False))
+        self.assertEquals(queue.get('folder'), (ACTION_INDEX, (), False))
+
+        # Only the catalog is updated by the worker
+        flush_indexation_queue(FakeFolder.portal_catalog)
+        self.assertEquals(log, [('catalog', '/folder', []),
+                                ('catalog', '/folder/doc', ['foo'])])
+
+    def test_security_not_deferred(self):
+        folder = root.items['folder'] = FakeProxy('folder', ('',))
+        doc = folder.add('doc')
+        mgr = IndexationManager(FakeBeforeCommitSubscribersManager())
+        mgr.setDeferred(True)
+        mgr.push(doc, idxs=['foo'])
+        mgr.push(folder, idxs=[], with_security=True)
+        mgr()
+        # The security reindexing is processed right away
+        self.assertEquals(log, [('prepare', '/folder/doc', ['foo']),
+                                ('prepare', '/folder', []),
+                                ('modified', '/folder'),
+                                ('catalog', '/folder', []),
+                                ('secu', '/folder', True)])
+        queue = get_indexation_queue(FakeFolder.portal_catalog)
+        self.assertEquals(queue.get('folder'), None)
+        self.assertEquals(queue.get('folder/doc'),
+                          (ACTION_INDEX, ('foo',), False))
+        self.assertEquals(len(queue), 1)
+
+    def test_deferred_indexes(self):
+        folder = root.items['folder'] = FakeProxy('folder', ('',))
+        doc = folder.add('doc')
+        other = folder.add('other')
+        mgr = IndexationManager(FakeBeforeCommitSubscribersManager())
+        mgr.setDeferredIndexes(['SearchableText', 'allowedRolesAndUsers'])
+        # Security indexes are never deferred
+        self.assertEquals(mgr.getDeferredIndexes(), ('SearchableText',))
+        mgr.push(folder, idxs=[], with_security=True)
+        mgr.push(doc, idxs=['Title', 'SearchableText'])
+        mgr.push(other, idxs=['SearchableText'])
+        mgr()
+
+        # Other indexes, the metadata (an empty tuple of indexes) and the
+        # security are done right away
+        self.assertEquals(log, [
+            ('prepare', '/folder', []),
+            ('modified', '/folder'),
+            ('prepare', '/folder/doc', ['Title', 'SearchableText']),
+            ('prepare', '/folder/other', ['SearchableText']),
+            ('catalog', '/folder/other', ()),
+            ('catalog', '/folder/doc', ['Title']),
+            ('catalog', '/folder',
+             ['path', 'allowedRolesAndUsers', 'Title']),
+            ('secu', '/folder', True)])
+        queue = get_indexation_queue(FakeFolder.portal_catalog)
+        self.assertEquals(len(queue), 3)
+        for rpath in ('folder', 'folder/doc', 'folder/other'):
+            self.assertEquals(queue.get(rpath),
+                              (ACTION_REINDEX, ('SearchableText',), False))
+
+        # Further updates of the same object are coalesced
+        mgr.push(doc, idxs=['SearchableText'])
+        mgr()
+        self.assertEquals(len(queue), 3)
+
+        del log[:]
+        flush_indexation_queue(FakeFolder.portal_catalog)
+        self.assertEquals(log, [
+            ('catalog', '/folder', ['SearchableText']),
+            ('catalog', '/folder/doc', ['SearchableText']),
+            ('catalog', '/folder/other', ['SearchableText'])])
+
+
+class IndexationRecordConflictTest(unittest.TestCase):
+
+    def setUp(self):
+        # MappingStorage doesn't resolve conflicts
+        self.dir = tempfile.mkdtemp()
+        self.db = DB(FileStorage(os.path.join(self.dir, 'Data.fs')))
+        conn = self.db.open()
+        queue = conn.root()['queue'] = IndexationQueue()
+        queue.push('a', ACTION_REINDEX, ['foo'])
+        transaction.commit()
+        conn.close()
+
+    def tearDown(self):
+        transaction.abort()
+        self.db.close()
+        shutil.rmtree(self.dir)
+
+    def open(self):
+        tm = transaction.TransactionManager()
+        conn = self.db.open(transaction_manager=tm)
+        return tm, conn, conn.root()['queue']
+
+    def test_merged(self):
+        tm1, conn1, queue1 = self.open()
+        tm2, conn2, queue2 = self.open()
+        queue1.push('a', ACTION_REINDEX, ['bar'])
+        queue2.push('a', ACTION_REINDEX, ['baz'], True)
+        tm1.commit()
+        tm2.commit()
+        conn1.close()
+        conn2.close()
+        tm, conn, queue = self.open()
+        self.assertEquals(queue.get('a'),
+                          (ACTION_REINDEX, ('foo', 'bar', 'baz'), True))
+        self.assertEquals(len(queue), 1)
+        conn.close()
+
+    def test_push_while_processed(self):
+        # A push concurrent with the processing of the record isn't lost
+        tm1, conn1, queue1 = self.open()
+        tm2, conn2, queue2 = self.open()
+        for rpath, record in queue1.getBatch():
+            queue1.remove(rpath, record)
+        queue2.push('a', ACTION_REINDEX, ['bar'])
+        tm1.commit()
+        self.assertRaises(ConflictError, tm2.commit)
+        tm2.abort()
+        conn1.close()
+        conn2.close()
+
+    def test_unindex_conflict(self):
+        tm1, conn1, queue1 = self.open()
+        tm2, conn2, queue2 = self.open()
+        queue1.push('a', ACTION_UNINDEX)
+        queue2.push('a', ACTION_REINDEX, ['bar'])
+        tm1.commit()
+        self.assertRaises(ConflictError, tm2.commit)
+        tm2.abort()
+        conn1.close()
+        conn2.close()
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(IndexationQueueTest),
+        unittest.makeSuite(DeferredIndexationTest),
+        unittest.makeSuite(IndexationRecordConflictTest),
+        ))
+
+if __name__ == '__main__':
+    unittest.TextTestRunner().run(test_suite())
@@ -0,0 +1,82 @@
+# -*- coding: iso-8859-15 -*-
+# (C) Copyright 2012 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Tests for the indexation statistics
+"""
+
+import unittest
+
+from Products.CPSCore.indexationstats import IndexationStatistics
+from Products.CPSCore.indexationstats import format_counters
+from Products.CPSCore.indexationstats import COUNTERS, TIMERS
+
+
+class IndexationStatisticsTest(unittest.TestCase):
+
+    def getStats(self, stats):
+        return dict([(s['name'], s) for s in stats.getStatistics()])
+
+    def test_names(self):
+        stats = IndexationStatistics()
+        self.assertEquals([s['name'] for s in stats.getStatistics()],
+                          list(COUNTERS + TIMERS))
+
+    def test_rolling_window(self):
+        stats = IndexationStatistics(window=2)
+        for pushes in (10, 1, 3):
+            stats.record({'pushes': pushes, 'processed': 1,
+                          'time_index': 0.5})
+        self.assertEquals(stats.transactions, 3)
+        pushes = self.getStats(stats)['pushes']
+        self.assertEquals(pushes['total'], 14)
+        # The first transaction went out of the window
+        self.assertEquals(pushes['window'], 4)
+        self.assertEquals(pushes['mean'], 2.0)
+        self.assertEquals(pushes['max'], 3)
+        self.assertEquals(self.getStats(stats)['time_index']['total'], 1.5)
+
+    def test_nothing_indexed(self):
+        stats = IndexationStatistics()
+        stats.record({'pushes': 0, 'indexes_written': 3})
+        self.assertEquals(stats.transactions, 0)
+
+    def test_disabled(self):
+        stats = IndexationStatistics()
+        stats.disable()
+        stats.record({'pushes': 1})
+        self.assertEquals(stats.transactions, 0)
+        stats.enable()
+        stats.record({'pushes': 1})
+        self.assertEquals(stats.transactions, 1)
+        stats.reset()
+        self.assertEquals(stats.transactions, 0)
+        self.assertEquals(self.getStats(stats)['pushes']['total'], 0)
+
+    def test_format_counters(self):
+        line = format_counters({'pushes': 3, 'time_index': 0.25})
+        self.assert_(line.startswith('pushes=3 processed=0 '))
+        self.assert_(line.endswith(' time_index=0.2500 time_security=0.0000'))
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(IndexationStatisticsTest),
+        ))
+
+if __name__ == '__main__':
+    unittest.TextTestRunner().run(test_suite())
@@ -121,6 +121,68 @@ class IndexingTest(PortalTestCase):
         res = cat.unrestrictedSearchResults(localUsersWithRoles='user:bob')
         self.assertEquals(len(res), 1)
 
+    def test_change_detection(self):
+        from Products.CPSCore.IndexationManager import \
+             get_indexation_counters
+        dummy = self.portal.dummy
+        dummy.setLanguage('fr')
+        cat = self.portal.portal_catalog
+        cat.addColumn('Language')
+        cat.addIndex('path', 'PathIndex')
+        counters = get_indexation_counters()
+
+        def written():
+            res = {}
+            for key in ('indexes_written', 'indexes_skipped',
+                        'metadata_written', 'metadata_skipped'):
+                res[key] = counters[key]
+                counters[key] = 0
+            return res
+
+        written()
+        dummy.indexObject()
+        self.assertEquals(written(), {'indexes_written': 4,
+                                      'indexes_skipped': 0,
+                                      'metadata_written': 1,
+                                      'metadata_skipped': 0})
+
+        # Nothing changed: the path and the metadata are not written,
+        # the other indexes skip unchanged values themselves
+        dummy.reindexObject()
+        self.assertEquals(written(), {'indexes_written': 3,
+                                      'indexes_skipped': 1,
+                                      'metadata_written': 0,
+                                      'metadata_skipped': 1})
+
+        dummy.setLanguage('en')
+        dummy.reindexObject()
+        self.assertEquals(written(), {'indexes_written': 3,
+                                      'indexes_skipped': 1,
+                                      'metadata_written': 1,
+                                      'metadata_skipped': 0})
+        brains = cat.unrestrictedSearchResults(Language='en')
+        self.assertEquals([brain.Language for brain in brains], ['en'])
+        self.assertEquals(cat.unrestrictedSearchResults(Language='fr'), [])
+
+        # Security reindexing doesn't update metadata
+        dummy.manage_setLocalRoles('bob', ['Winner'])
+        dummy.reindexObjectSecurity()
+        self.assertEquals(written(), {'indexes_written': 2,
+                                      'indexes_skipped': 0,
+                                      'metadata_written': 0,
+                                      'metadata_skipped': 0})
+
+        # An empty tuple of indexes updates only the metadata
+        dummy.setLanguage('fr')
+        uid = '/'.join(dummy.getPhysicalPath())
+        cat.catalogCPSObjects([(dummy, uid, ())])
+        self.assertEquals(written(), {'indexes_written': 0,
+                                      'indexes_skipped': 0,
+                                      'metadata_written': 1,
+                                      'metadata_skipped': 0})
+        brains = cat.unrestrictedSearchResults(Language='en')
+        self.assertEquals([brain.Language for brain in brains], ['fr'])
+
 
 class ProxyIndexingTest(PortalTestCase):
 
@@ -288,6 +350,31 @@ class IndexableObjectWrapperTestCase(ZopeTestCase.PortalTestCase):
         wrapper = IndexableObjectWrapper({}, item)
         self.assertEqual(0, wrapper.position_in_container())
 
+    def test_compute_values(self):
+        from Products.CPSCore.patch.cmf.catalog import \
+             IndexableObjectWrapper
+        calls = []
+        class Item(SimpleItem):
+            def Title(self):
+                calls.append('Title')
+                return 'the title'
+        self.app.portal._setObject('item', Item('item'))
+        item = self.app.portal.item
+
+        wrapper = IndexableObjectWrapper({'review_state': 'work'}, item)
+        wrapper._cps_computeValues(['Title', 'review_state',
+                                    'position_in_container', 'nothere'])
+        self.assertEqual(calls, ['Title'])
+        # Values of the object are computed once
+        self.assertEqual(wrapper.Title, 'the title')
+        self.assertEqual(wrapper.Title, 'the title')
+        self.assertEqual(wrapper.review_state, 'work')
+        self.assertEqual(calls, ['Title'])
+        self.failIf(hasattr(wrapper, 'nothere'))
+        # Methods of the wrapper are untouched
+        self.failIf(wrapper.__dict__.has_key('Title'))
+        self.assertEqual(wrapper.position_in_container(), 0)
+
 def test_suite():
     return unittest.TestSuite((
         unittest.makeSuite(IndexingTest),
@@ -22,13 +22,15 @@
 
 import random
 import unittest
+from Acquisition import Implicit, aq_base
 from OFS.SimpleItem import SimpleItem
 
 from Products.CPSCore.interfaces import IBeforeCommitSubscriber
 from Products.CPSCore.TreeCacheManager import TreeCacheManager
 from Products.CPSCore.TreeCacheManager import get_treecache_manager
+from Products.CPSCore.commithooks import savepoint
 
-from Products.CPSCore.treemodification import ADD
+from Products.CPSCore.treemodification import ADD, REMOVE, MODIFY
 
 import transaction
 
@@ -36,10 +38,28 @@ class FakeBeforeCommitSubscribersManager:
     def addSubscriber(self, hook, order):
         pass
 
+class DummyFolder(Implicit):
+    def _getOb(self, id, default=None):
+        if not hasattr(aq_base(self), id):
+            return default
+        return getattr(self, id)
+
 class DummyTreeCache(SimpleItem):
     notified = 0
+    existing = ()
     def updateTree(self, tree):
         self.notified += 1
+        self.ops = list(tree.get())
+        self.ops.sort()
+    def getPhysicalRoot(self):
+        root = DummyFolder()
+        for path in self.existing:
+            ob = root
+            for id in path[1:]:
+                if not hasattr(aq_base(ob), id):
+                    setattr(ob, id, DummyFolder())
+                ob = getattr(ob, id)
+        return root
 
 
 class TreeCacheManagerTest(unittest.TestCase):
@@ -127,6 +147,36 @@ class TreeCacheManagerTest(unittest.TestCase):
         mgr()
         self.assertEquals(mgr._trees, {})
 
+    def test_bulk(self):
+        mgr = TreeCacheManager(FakeBeforeCommitSubscribersManager())
+        cache = DummyTreeCache()
+        cache.existing = [('', 'a'), ('', 'a', 'b'), ('', 'c')]
+        mgr.startBulk()
+        self.assert_(mgr.isBulk())
+        mgr.push(cache, ADD, ('', 'a', 'b'), None)
+        mgr.push(cache, MODIFY, ('', 'a'), {'full': True})
+        mgr.push(cache, REMOVE, ('', 'a', 'x'), None)
+        mgr.push(cache, MODIFY, ('', 'c'), {'order': True})
+        mgr.push(cache, ADD, ('', 'd'), None)
+        self.assertEquals(mgr._trees, {})
+        # Replayed at commit, once per top-most path
+        mgr()
+        self.failIf(mgr.isBulk())
+        self.assertEquals(cache.notified, 1)
+        self.assertEquals(cache.ops, [(ADD, ('', 'a'), {}),
+                                      (ADD, ('', 'c'), {}),
+                                      (REMOVE, ('', 'd'), {})])
+
+    def test_bulk_acquired(self):
+        # A removed object isn't found by acquisition from its parent
+        mgr = TreeCacheManager(FakeBeforeCommitSubscribersManager())
+        cache = DummyTreeCache()
+        cache.existing = [('', 'a'), ('', 'c')]
+        mgr.startBulk()
+        mgr.push(cache, REMOVE, ('', 'a', 'c'), None)
+        mgr()
+        self.assertEquals(cache.ops, [(REMOVE, ('', 'a', 'c'), {})])
+
 class TreeCacheManagerIntegrationTest(unittest.TestCase):
     # These really test the beforeCommitHook
 
@@ -148,6 +198,54 @@ class TreeCacheManagerIntegrationTest(unittest.TestCase):
         transaction.abort()
         self.assertEquals(cache.notified, 0)
 
+    def test_transaction_savepoint(self):
+        transaction.begin()
+        mgr = get_treecache_manager()
+        mgr.setFlushAtSavepoint(True)
+        self.assert_(mgr.isFlushAtSavepoint())
+        cache = DummyTreeCache()
+        mgr.push(cache, ADD, ('abc',), None)
+        savepoint()
+        self.assertEquals(cache.notified, 1)
+        self.assertEquals(mgr._trees, {})
+        transaction.commit()
+        self.assertEquals(cache.notified, 1)
+
+    def test_transaction_savepoint_rollback(self):
+        transaction.begin()
+        mgr = get_treecache_manager()
+        mgr.setFlushAtSavepoint(True)
+        cache = DummyTreeCache()
+        mgr.push(cache, ADD, ('abc',), None)
+        sp = savepoint()
+        self.assertEquals(cache.notified, 1)
+        mgr.push(cache, REMOVE, ('def',), None)
+        # The work queued after the savepoint is dropped, the flushed
+        # work is kept
+        sp.rollback()
+        self.assertEquals(mgr.queueSize(), 0)
+        mgr.push(cache, ADD, ('ghi',), None)
+        sp.rollback()
+        transaction.commit()
+        self.assertEquals(cache.notified, 1)
+        self.assertEquals(cache.ops, [(ADD, ('abc',), {})])
+
+    def test_transaction_savepoint_bulk(self):
+        # Paths touched by a bulk operation are kept until its end
+        transaction.begin()
+        mgr = get_treecache_manager()
+        mgr.setFlushAtSavepoint(True)
+        cache = DummyTreeCache()
+        cache.existing = [('', 'a')]
+        mgr.startBulk()
+        mgr.push(cache, ADD, ('', 'a'), None)
+        savepoint()
+        self.assertEquals(cache.notified, 0)
+        self.assert_(mgr.isBulk())
+        transaction.commit()
+        self.assertEquals(cache.notified, 1)
+        self.assertEquals(cache.ops, [(ADD, ('', 'a'), {})])
+
 def test_suite():
     return unittest.TestSuite((
         unittest.makeSuite(TreeCacheManagerTest),
@@ -0,0 +1,111 @@
+# -*- coding: iso-8859-15 -*-
+# (C) Copyright 2012 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Tests for the memo of getList results
+"""
+
+import unittest
+
+from Products.CPSCore.treelistcache import TreeListCache
+from Products.CPSCore.treelistcache import get_tree_list_cache
+
+
+class TreeListCacheTest(unittest.TestCase):
+
+    def test_get_set(self):
+        cache = TreeListCache()
+        self.assertEquals(cache.get('a'), None)
+        res = [{'rpath': 'a'}]
+        cache.set('a', res)
+        got = cache.get('a')
+        self.assertEquals(got, res)
+        stats = cache.getStatistics()
+        self.assertEquals(stats['hits'], 1)
+        self.assertEquals(stats['misses'], 1)
+        self.assertEquals(stats['hit_ratio'], 0.5)
+        self.assertEquals(stats['size'], 1)
+
+    def test_copies(self):
+        # Neither the stored nor the returned results can alter the memo
+        cache = TreeListCache()
+        res = [{'rpath': 'a'}]
+        cache.set('a', res)
+        res[0]['title'] = 'changed'
+        got = cache.get('a')
+        self.assertEquals(got, [{'rpath': 'a'}])
+        got[0]['title'] = 'changed'
+        got.append({'rpath': 'b'})
+        self.assertEquals(cache.get('a'), [{'rpath': 'a'}])
+
+    def test_nested_copies(self):
+        cache = TreeListCache()
+        res = [{'rpath': 'a', 'local_roles': {'user:bob': ('Owner',)},
+                'allowed_roles_and_users': ['Manager']}]
+        cache.set('a', res)
+        res[0]['local_roles']['user:alice'] = ('Reader',)
+        got = cache.get('a')
+        self.assertEquals(got[0]['local_roles'], {'user:bob': ('Owner',)})
+        got[0]['local_roles'].clear()
+        got[0]['allowed_roles_and_users'].append('user:bob')
+        got = cache.get('a')
+        self.assertEquals(got[0]['local_roles'], {'user:bob': ('Owner',)})
+        self.assertEquals(got[0]['allowed_roles_and_users'], ['Manager'])
+
+    def test_lru(self):
+        cache = TreeListCache(max_size=2)
+        cache.set('a', [])
+        cache.set('b', [])
+        cache.get('a')
+        cache.set('c', [])
+        # b was the least recently used
+        self.assertEquals(cache.get('b'), None)
+        self.assertEquals(cache.get('a'), [])
+        self.assertEquals(cache.get('c'), [])
+        self.assertEquals(len(cache), 2)
+        self.assertEquals(cache.getStatistics()['evictions'], 1)
+
+        cache.set('d', [])
+        self.assertEquals(cache.get('a'), None)
+        self.assertEquals(cache.get('c'), [])
+        self.assertEquals(cache.get('d'), [])
+
+    def test_disabled(self):
+        cache = TreeListCache(max_size=0)
+        cache.set('a', [])
+        self.assertEquals(cache.get('a'), None)
+        self.assertEquals(len(cache), 0)
+
+    def test_clear(self):
+        cache = TreeListCache()
+        cache.set('a', [])
+        cache.get('a')
+        cache.clear()
+        self.assertEquals(cache.get('a'), None)
+        self.assertEquals(cache.getStatistics()['hits'], 0)
+
+    def test_process_wide(self):
+        self.assert_(get_tree_list_cache() is get_tree_list_cache())
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(TreeListCacheTest),
+        ))
+
+if __name__ == '__main__':
+    unittest.TextTestRunner().run(test_suite())
@@ -24,12 +24,16 @@ import unittest
 import Testing.ZopeTestCase.ZopeLite
 
 from Acquisition import aq_parent, aq_inner
+from BTrees.OOBTree import OOBTree
 from OFS.SimpleItem import SimpleItem
 from OFS.Folder import Folder
 from OFS.OrderedFolder import OrderedFolder
 from Products.CMFCore.tests.base.testcase import SecurityRequestTest
 from Products.CPSCore.TreesTool import TreesTool, TreeCache, TreeCacheUpdater
+from Products.CPSCore.TreesTool import LOCALIZED_KEY
 from Products.CPSCore.treemodification import ADD, REMOVE, MODIFY
+from Products.CPSCore.treelistcache import get_tree_list_cache
+from Products.CPSCore.treestorage import TreePartitions
 from Products.CPSCore.tests import verbose_security_roles_clean
 
 class DummyTreeCache(SimpleItem):
@@ -38,7 +42,7 @@ class DummyTreeCache(SimpleItem):
         self.notified = 0
     def updateTree(self, tree):
         self.notified += len(tree)
-    def isCandidate(self, ob):
+    def isCandidate(self, ob, path=None):
         return True
     def getPhysicalPath(self):
         return (self.getId(),)
@@ -87,6 +91,22 @@ class DummyMember(SimpleItem):
     def getUser(self):
         return self
 
+class DummyResponse:
+    def __init__(self):
+        self.headers = {}
+        self.status = 200
+    def setHeader(self, name, value):
+        self.headers[name] = value
+    def setStatus(self, status):
+        self.status = status
+
+class DummyRequest:
+    def __init__(self, **headers):
+        self.headers = headers
+        self.RESPONSE = DummyResponse()
+    def get_header(self, name, default=None):
+        return self.headers.get(name, default)
+
 
 class TreesToolTest(unittest.TestCase):
 
@@ -177,6 +197,29 @@ class TreeCacheTest(SecurityRequestTest):
         ob = DummyObject(path='/cmf/root/foo')
         self.failIf(cache.isCandidate(ob))
 
+    def test_candidate_filter(self):
+        app = DummyApp()
+        app.cmf = Folder('cmf')
+        app.cmf.acl_users = SimpleItem()
+        app.cmf.portal_url = DummyUrlTool()
+        app.cmf.cache = self.makeOne()
+        cache = app.cmf.cache
+
+        ob = DummyObject(path='/cmf/root/foo/lots/stuff')
+        self.failIf(cache.isCandidate(ob))
+        # Compiled once
+        filter = cache._getFilter()
+        self.assert_(cache._getFilter() is filter)
+        # Recompiled when the properties change
+        cache.manage_changeProperties(excluded_rpaths=('root/foo/members',))
+        self.assert_(cache._getFilter() is not filter)
+        self.assert_(cache.isCandidate(ob))
+        self.assert_(cache.isCandidate(ob, ob.getPhysicalPath()))
+        ob = DummyObject(path='/cmf/root/foo/members')
+        self.failIf(cache.isCandidate(ob))
+        ob = DummyObject(path='/cmf/root')
+        self.failIf(cache.isCandidate(ob))
+
     def test_getRoot(self):
         cache = self.makeOne()
         self.assertEquals(cache.getRoot(), 'root/foo')
@@ -237,6 +280,48 @@ class TreeCacheTest(SecurityRequestTest):
         self.assertEquals([d['depth'] for d in l],
                           [0, 1, 1])
 
+    def test_localized_fields(self):
+        self.makeInfrastructure()
+        cmf = self.app.cmf
+        cache = cmf.portal_trees.cache
+        def info_method(doc=None):
+            return {
+                'title': doc.title,
+                'l10n_titles': {'en': doc.title, 'fr': ''},
+                'l10n_descriptions': {'fr': 'Description'},
+                }
+        cmf.info_method = info_method
+        cache.rebuild()
+
+        # Precomputed for each language
+        localized = cache._infos['root/foo'][LOCALIZED_KEY]
+        self.assertEquals(localized['en'], {'title': 'Foo',
+                                            'title_or_id': 'Foo',
+                                            'short_title': 'Foo'})
+        self.assertEquals(localized['fr'], {'title': '',
+                                            'title_or_id': 'foo',
+                                            'short_title': 'foo',
+                                            'description': 'Description'})
+
+        keys = ('title', 'title_or_id', 'short_title', 'description')
+        l = cache.getList(filter=False, locale_keys=keys, locale_lang='fr')
+        self.assertEquals(l[0]['title_or_id'], 'foo')
+        self.assertEquals(l[0]['description'], 'Description')
+        self.failIf(l[0].has_key(LOCALIZED_KEY))
+        l2 = cache.getList(filter=False, locale_keys=('description',),
+                           locale_lang='fr')
+        self.assertEquals(l2[0]['title'], 'Foo')
+        l2 = cache.getList(filter=False, locale_keys=keys, locale_lang='de')
+        self.assertEquals(l2[0]['title'], 'Foo')
+        self.failIf(l2[0].has_key('description'))
+
+        # Infos stored before are localized on the fly
+        info = cache._infos['root/foo']
+        del info[LOCALIZED_KEY]
+        cache._infos['root/foo'] = info
+        self.assertEquals(cache.getList(filter=False, locale_keys=keys,
+                                        locale_lang='fr'), l)
+
     def test_upgrade(self):
         # Test upgrade of an old-style tree
         self.makeInfrastructure()
@@ -263,6 +348,115 @@ class TreeCacheTest(SecurityRequestTest):
         self.assertEquals([d['depth'] for d in l],
                           [0, 1])
 
+    def test_upgrade_positions(self):
+        # Caches built before the preorder positions get them computed
+        self.makeInfrastructure()
+        cmf = self.app.cmf
+        cmf.root.foo._setObject('bar', DummyObject('bar', title='Bar'))
+        cmf.root.foo._setObject('baz', DummyObject('baz', title='Baz'))
+        cache = cmf.portal_trees.cache
+        cache.rebuild()
+        del cache._order
+        del cache._positions
+
+        l = cache.getList(filter=False)
+        self.assertEquals([d['rpath'] for d in l],
+                          ['root/foo', 'root/foo/bar', 'root/foo/baz'])
+        self.assertEquals(cache._positions['root/foo/baz'], ((1, 'baz'),))
+
+    def test_upgrade_structure(self):
+        # Caches storing the structure in the infos get it split out
+        self.makeInfrastructure()
+        cmf = self.app.cmf
+        cmf.root.foo._setObject('bar', DummyObject('bar', title='Bar'))
+        cmf.root.foo._setObject('baz', DummyObject('baz', title='Baz'))
+        cache = cmf.portal_trees.cache
+        cache.rebuild()
+        node = cache._structure['root/foo']
+        self.assertEquals(node.depth, 0)
+        self.assertEquals(node.children, ('root/foo/bar', 'root/foo/baz'))
+        self.failIf(cache._infos['root/foo'].has_key('children'))
+        expected = cache.getList(filter=False)
+        for rpath, node in cache._structure.items():
+            info = cache._infos[rpath]
+            info['depth'] = node.depth
+            info['children'] = list(node.children)
+            info['nb_children'] = len(node.children)
+            cache._infos[rpath] = info
+        del cache._structure
+
+        self.assertEquals(cache.getList(filter=False), expected)
+        node = cache._structure['root/foo/bar']
+        self.assertEquals((node.depth, node.children), (1, ()))
+        self.failIf(cache._infos['root/foo'].has_key('children'))
+
+    def test_upgrade_partitions(self):
+        # Caches keeping everything in single BTrees get partitioned
+        self.makeInfrastructure()
+        cmf = self.app.cmf
+        cmf.root.foo._setObject('bar', DummyObject('bar', title='Bar'))
+        cmf.root.foo.bar._setObject('a', DummyObject('a', title='A'))
+        cmf.root.foo._setObject('baz', DummyObject('baz', title='Baz'))
+        cache = cmf.portal_trees.cache
+        cache.rebuild()
+        expected = cache.getList(filter=False)
+        cache._infos = OOBTree(dict(cache._infos.items()))
+        structure = OOBTree()
+        for rpath, node in cache._structure.items():
+            structure[rpath] = (node.depth, node.children)
+        cache._structure = structure
+        del cache._order
+        del cache._positions
+
+        self.assertEquals(cache.getList(filter=False), expected)
+        self.assert_(isinstance(cache._infos, TreePartitions))
+        self.assertEquals(cache._infos.getPartitionName('root/foo/bar/a'),
+                          'bar')
+        node = cache._structure['root/foo/bar']
+        self.assertEquals(node.depth, 1)
+        self.assertEquals(node.children, ('root/foo/bar/a',))
+        self.assertEquals(cache._positions['root/foo/bar/a'],
+                          ((0, 'bar'), (0, 'a')))
+
+    def test_interned_principals(self):
+        self.makeInfrastructure()
+        cmf = self.app.cmf
+        cmf.root.foo._setObject('bar', DummyObject('bar', title='Bar'))
+        cache = cmf.portal_trees.cache
+        cache.rebuild()
+
+        info = cache._infos['root/foo/bar']
+        self.failIf(info.has_key('allowed_roles_and_users'))
+        names = [cache._principal_names[id] for id in info['_allowed']]
+        self.assert_('Manager' in names)
+        id = cache._principals['Manager']
+        self.assertEquals(cache._principal_names[id], 'Manager')
+
+        l = cache.getList(filter=False)
+        for d in l:
+            self.failIf(d.has_key('_allowed'))
+        self.assertEquals(l[1]['allowed_roles_and_users'], names)
+
+    def test_upgrade_principals(self):
+        # Caches built before the interning get their principals interned
+        self.makeInfrastructure()
+        cmf = self.app.cmf
+        cache = cmf.portal_trees.cache
+        cache.rebuild()
+        info = cache._infos['root/foo']
+        names = [cache._principal_names[id] for id in info['_allowed']]
+        del info['_allowed']
+        info['allowed_roles_and_users'] = names
+        cache._infos['root/foo'] = info
+        del cache._principals
+        del cache._principal_names
+
+        l = cache.getList(filter=False)
+        self.assertEquals(l[0]['allowed_roles_and_users'], names)
+        info = cache._infos['root/foo']
+        self.failIf(info.has_key('allowed_roles_and_users'))
+        self.assertEquals(len(info['_allowed']), len(names))
+
     def test_event_sys_add_cmf_object(self):
         self.makeInfrastructure()
         cmf = self.app.cmf
@@ -713,6 +907,314 @@ class TreeCacheTest(SecurityRequestTest):
                            'root/foo/bar/b/d/d1',
                            ])
 
+    def test_deep_ordered_updates(self):
+        # The preorder positions follow deletions and moves
+        cache = self.makeDeepStructure()
+        cache.flushEvents()
+        cmf = self.app.cmf
+        tool = cmf.portal_trees
+        foo = cmf.root.foo
+
+        # Subtree listing
+        l = cache.getList(prefix='root/foo/bar/b', filter=False)
+        self.assertEquals([d['rpath'] for d in l],
+                          ['root/foo/bar/b',
+                           'root/foo/bar/b/z',
+                           'root/foo/bar/b/d',
+                           'root/foo/bar/b/d/d2',
+                           'root/foo/bar/b/d/d1',
+                           ])
+
+        # Delete the first child, the next one moves up
+        tool.notify_tree('sys_del_object', foo.baz)
+        foo._delObject('baz')
+        tool.flushEvents()
+        self.assertEquals(cache._positions['root/foo/bar/b/d'],
+                          ((0, 'bar'), (0, 'b'), (1, 'd')))
+
+        # Reorder
+        foo.bar.b.moveObjectsDown('z')
+        tool.notify_tree('sys_order_object', foo.bar.b)
+        tool.flushEvents()
+        l = cache.getList(filter=False)
+        self.assertEquals([d['rpath'] for d in l],
+                          ['root/foo',
+                           'root/foo/bar',
+                           'root/foo/bar/b',
+                           'root/foo/bar/b/d',
+                           'root/foo/bar/b/d/d2',
+                           'root/foo/bar/b/d/d1',
+                           'root/foo/bar/b/z',
+                           ])
+        l = cache.getList(filter=False, stop_depth=2)
+        self.assertEquals([d['rpath'] for d in l],
+                          ['root/foo', 'root/foo/bar', 'root/foo/bar/b'])
+        self.assertEquals(len(cache._order), 7)
+
+    def test_list_pages(self):
+        cache = self.makeDeepStructure()
+        cache.flushEvents()
+        for kw in ({'filter': False},
+                   {'filter': False, 'order': False},
+                   {'filter': False, 'stop_depth': 2},
+                   {'prefix': 'root/foo/bar/b', 'filter': False},
+                   {'prefix': 'root/foo/bar', 'order': False},
+                   {},
+                   ):
+            expected = cache.getList(**kw)
+            self.assertEquals(list(cache.iterList(**kw)), expected)
+            res = []
+            token = None
+            while True:
+                page, token = cache.getListPage(limit=3, token=token, **kw)
+                res.extend(page)
+                if token is None:
+                    break
+                self.assertEquals(len(page), 3)
+            self.assertEquals(res, expected)
+            page, token = cache.getListPage(offset=2, limit=2, **kw)
+            self.assertEquals(page, expected[2:4])
+
+        # Continuing with iterList
+        page, token = cache.getListPage(filter=False, limit=2)
+        self.assertEquals([d['rpath'] for d in page],
+                          ['root/foo', 'root/foo/baz'])
+        self.assertEquals([d['rpath'] for d in
+                           cache.iterList(filter=False, token=token)][:2],
+                          ['root/foo/bar', 'root/foo/bar/b'])
+        self.assertRaises(ValueError, cache.getListPage, token='bad')
+        self.assertRaises(ValueError, cache.getListPage, filter=False,
+                          order=False, token=token)
+
+    def test_chunked_rebuild(self):
+        cache = self.makeDeepStructure()
+        cache.flushEvents()
+        cmf = self.app.cmf
+        tool = cmf.portal_trees
+        foo = cmf.root.foo
+        expected = cache.getList(filter=False)
+
+        self.assert_(cache.startBuild())
+        self.failIf(cache.buildChunk(3))
+        self.assertEquals(cache.getBuildStatus(), {'done': 3, 'pending': 1})
+        # The current tree is still served
+        self.assertEquals(cache.getList(filter=False), expected)
+
+        # Modifications are replayed on both trees, built part or not
+        foo.baz._setObject('q', DummyObject('q', title='Q'))
+        tool.notify_tree('sys_add_cmf_object', foo.baz.q)
+        tool.notify_tree('sys_del_object', foo.bar.b.z)
+        foo.bar.b._delObject('z')
+        tool.flushEvents()
+        rpaths = [d['rpath'] for d in cache.getList(filter=False)]
+        self.assert_('root/foo/baz/q' in rpaths)
+
+        while not cache.buildChunk(3):
+            pass
+        self.assertEquals(cache.getBuildStatus(), None)
+        res = cache.getList(filter=False)
+        self.assertEquals([d['rpath'] for d in res], rpaths)
+        cache.rebuild()
+        self.assertEquals(cache.getList(filter=False), res)
+
+    def test_rebuild_drops_build(self):
+        cache = self.makeDeepStructure()
+        cache.flushEvents()
+        self.assert_(cache.startBuild())
+        cache.rebuild()
+        self.assertEquals(cache.getBuildStatus(), None)
+        self.assert_(cache.buildChunk())
+
+    def fakeCommit(self, cache, serial):
+        """Make the version of the cache look stored and committed."""
+        cache._version._p_oid = '\0'*8
+        cache._version._p_serial = '\0'*7 + chr(serial)
+        cache._v_changed_in = None
+
+    def test_memoized_list(self):
+        cache = self.makeDeepStructure()
+        cache.flushEvents()
+        cmf = self.app.cmf
+        tool = cmf.portal_trees
+        memo = get_tree_list_cache()
+        memo.clear()
+        # Only stored caches are memoized, fake it
+        self.fakeCommit(cache, 1)
+        version = cache._version()
+
+        l = cache.getList(filter=False)
+        self.assertEquals(memo.getStatistics()['misses'], 1)
+        l[0]['title'] = 'Changed'
+        l = cache.getList(filter=False)
+        self.assertEquals(memo.getStatistics()['hits'], 1)
+        self.assertEquals(l[0]['title'], 'Foo')
+        self.assertEquals(len(l), 8)
+        # Other arguments
+        l = cache.getList(filter=False, stop_depth=1)
+        self.assertEquals(memo.getStatistics()['misses'], 2)
+        self.assertEquals(len(l), 3)
+
+        # Updates change the version
+        tool.notify_tree('sys_del_object', cmf.root.foo.baz)
+        cmf.root.foo._delObject('baz')
+        tool.flushEvents()
+        self.assertEquals(cache._version(), version+1)
+        # Not memoized until committed
+        cache.getList(filter=False)
+        self.assertEquals(memo.getStatistics()['misses'], 2)
+        self.fakeCommit(cache, 2)
+        l = cache.getList(filter=False)
+        self.assertEquals(memo.getStatistics()['misses'], 3)
+        self.assertEquals(len(l), 7)
+        memo.clear()
+
+    def test_list_etag(self):
+        cache = self.makeDeepStructure()
+        cache.flushEvents()
+        cmf = self.app.cmf
+        # No ETag until the version is stored
+        self.assertEquals(cache.getListETag(), None)
+        self.fakeCommit(cache, 1)
+
+        etag = cache.getListETag()
+        self.assert_(etag.startswith('"'))
+        self.assertEquals(cache.getListETag(), etag)
+        self.assertNotEquals(cache.getListETag(stop_depth=1), etag)
+
+        cmf.portal_trees.notify_tree('sys_del_object', cmf.root.foo.baz)
+        cmf.root.foo._delObject('baz')
+        cmf.portal_trees.flushEvents()
+        self.assertEquals(cache.getListETag(), None)
+        self.fakeCommit(cache, 2)
+        self.assertNotEquals(cache.getListETag(), etag)
+
+    def test_list_json(self):
+        try:
+            import json
+        except ImportError:
+            try:
+                import simplejson as json
+            except ImportError:
+                self.failIf(hasattr(TreeCache, 'getListJSON'))
+                return
+        cache = self.makeDeepStructure()
+        cache.flushEvents()
+        self.fakeCommit(cache, 1)
+
+        request = DummyRequest()
+        data = cache.getListJSON(stop_depth='1', REQUEST=request)
+        response = request.RESPONSE
+        self.assertEquals(response.status, 200)
+        self.assertEquals(response.headers['Content-Type'],
+                          'application/json')
+        etag = response.headers['ETag']
+        self.assertEquals([d['rpath'] for d in json.loads(data)],
+                          ['root/foo', 'root/foo/baz', 'root/foo/bar'])
+
+        request = DummyRequest(**{'If-None-Match': etag})
+        data = cache.getListJSON(stop_depth='1', REQUEST=request)
+        self.assertEquals(request.RESPONSE.status, 304)
+        self.assertEquals(data, '')
+
+        request = DummyRequest(**{'If-None-Match': '"other"'})
+        cache.getListJSON(REQUEST=request)
+        self.assertEquals(request.RESPONSE.status, 200)
+
+        # Arguments passed from the web as strings
+        request = DummyRequest(**{'If-None-Match': etag})
+        cache.getListJSON(order='True', stop_depth='1', REQUEST=request)
+        self.assertEquals(request.RESPONSE.status, 304)
+        request = DummyRequest()
+        cache.getListJSON(stop_depth='1', locale_keys='title, description',
+                          REQUEST=request)
+        self.assertEquals(request.RESPONSE.headers['ETag'],
+                          cache.getListETag(stop_depth=1,
+                                            locale_keys=['title',
+                                                         'description']))
+
+    def test_list_json_private(self):
+        try:
+            import json
+        except ImportError:
+            try:
+                import simplejson as json
+            except ImportError:
+                return
+        cache = self.makeDeepStructure()
+        cache.flushEvents()
+        self.fakeCommit(cache, 1)
+
+        # Unviewable entries are skipped even when asked not to filter,
+        # the principals aren't served
+        request = DummyRequest()
+        data = json.loads(cache.getListJSON(filter='0', REQUEST=request))
+        self.assertEquals([d['rpath'] for d in data],
+                          ['root/foo', 'root/foo/baz', 'root/foo/bar',
+                           'root/foo/bar/b', 'root/foo/bar/b/z'])
+        for d in data:
+            self.failIf('allowed_roles_and_users' in d)
+            self.failIf('local_roles' in d)
+            self.assertEquals(d['visible'], True)
+        self.assertEquals(request.RESPONSE.headers['Cache-Control'],
+                          'private, must-revalidate')
+
+    def test_deep_security_update(self):
+        # Security of descendants derived from their parent's is the same
+        # as when computed from scratch
+        cache = self.makeDeepStructure()
+        cache.flushEvents()
+        cmf = self.app.cmf
+        tool = cmf.portal_trees
+        foo = cmf.root.foo
+        foo.__ac_local_roles__ = {'alice': ['Anonymous'],
+                                  'bob': ['SomeRole']}
+        tool.notify_tree('sys_modify_security', foo)
+        tool.flushEvents()
+
+        def getAllowed():
+            res = {}
+            for d in cache.getList(filter=False):
+                allowed = d['allowed_roles_and_users']
+                verbose_security_roles_clean(allowed)
+                allowed.sort()
+                res[d['rpath']] = allowed
+            return res
+        allowed = getAllowed()
+        self.assert_('user:alice' in allowed['root/foo/bar/b'])
+        self.failIf('user:alice' in allowed['root/foo/bar/b/d'])
+        self.assert_('user:bob' in allowed['root/foo/bar/b/d/d1'])
+        cache.rebuild()
+        self.assertEquals(allowed, getAllowed())
+
+    def test_nested_security_update(self):
+        # A descendant whose own security changed in the same transaction
+        # as its ancestor's is computed from its object
+        cache = self.makeDeepStructure()
+        cache.flushEvents()
+        cmf = self.app.cmf
+        tool = cmf.portal_trees
+        foo = cmf.root.foo
+        b = foo.bar.b
+        foo.__ac_local_roles__ = {'bob': ['SomeRole']}
+        b.__ac_local_roles__ = {'alice': ['Anonymous']}
+        tool.notify_tree('sys_modify_security', foo)
+        tool.notify_tree('sys_modify_security', b)
+        tool.flushEvents()
+
+        def getAllowed():
+            res = {}
+            for d in cache.getList(filter=False):
+                allowed = d['allowed_roles_and_users']
+                verbose_security_roles_clean(allowed)
+                allowed.sort()
+                res[d['rpath']] = allowed
+            return res
+        allowed = getAllowed()
+        self.assert_('user:alice' in allowed['root/foo/bar/b'])
+        self.failIf('user:alice' in allowed['root/foo/bar'])
+        cache.rebuild()
+        self.assertEquals(allowed, getAllowed())
+
     def test_deep_with_filtering(self):
         # With visibility filtering, not visible starting from d
         cache = self.makeDeepStructure()
@@ -0,0 +1,336 @@
+# -*- coding: iso-8859-15 -*-
+# (C) Copyright 2012 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Tests for the storage of the tree caches
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import transaction
+
+from ZODB.DB import DB
+from ZODB.FileStorage import FileStorage
+from ZODB.POSException import ConflictError
+
+from Products.CPSCore.treestorage import merge_children
+from Products.CPSCore.treestorage import merge_items
+from Products.CPSCore.treestorage import TreeNode
+from Products.CPSCore.treestorage import TreePartitions
+from Products.CPSCore.treestorage import TreePositions
+from Products.CPSCore.treestorage import RPATH_KEYS, POSITION_KEYS
+from Products.CPSCore.treestorage import MAX_POSITION
+
+
+class MergeChildrenTest(unittest.TestCase):
+
+    def test_appends(self):
+        self.assertEquals(merge_children(('a',), ('a', 'x'), ('a', 'y')),
+                          ('a', 'x', 'y'))
+
+    def test_inserts(self):
+        self.assertEquals(merge_children(('a', 'b'), ('x', 'a', 'b'),
+                                         ('a', 'y', 'b')),
+                          ('x', 'a', 'y', 'b'))
+
+    def test_removes(self):
+        self.assertEquals(merge_children(('a', 'b', 'c'), ('a', 'c'),
+                                         ('a', 'b')),
+                          ('a',))
+        self.assertEquals(merge_children(('a', 'b'), ('b',), ('b', 'x')),
+                          ('b', 'x'))
+
+    def test_remove_and_add(self):
+        # committed removed the predecessor of the addition
+        self.assertEquals(merge_children(('a', 'b'), ('a',),
+                                         ('a', 'b', 'c')),
+                          ('a', 'c'))
+        self.assertEquals(merge_children(('a', 'b'), ('a', 'x'),
+                                         ('a', 'b', 'c')),
+                          ('a', 'x', 'c'))
+        self.assertEquals(merge_children(('a', 'b'), ('b',),
+                                         ('a', 'y', 'b')),
+                          ('y', 'b'))
+
+    def test_same_change(self):
+        self.assertEquals(merge_children(('a',), ('a', 'x'), ('a', 'x')),
+                          ('a', 'x'))
+
+    def test_reorder(self):
+        self.assertRaises(ValueError, merge_children,
+                          ('a', 'b'), ('b', 'a'), ('a', 'b', 'x'))
+        self.assertRaises(ValueError, merge_children,
+                          ('a', 'b'), ('a', 'b', 'x'), ('b', 'a'))
+
+
+class MergeItemsTest(unittest.TestCase):
+
+    def test_lazy_sources(self):
+        opened = []
+        def source(name, keys):
+            def items():
+                opened.append(name)
+                return [(key, name) for key in keys]
+            return items
+        merged = merge_items([(None, source('x', ['b', 'e'])),
+                              ('a', source('a', ['a', 'f'])),
+                              ('c', source('c', ['c', 'd'])),
+                              ('g', source('g', ['g']))])
+        self.assertEquals(merged.next(), ('a', 'a'))
+        self.assertEquals(merged.next(), ('b', 'x'))
+        self.assertEquals(opened, ['x', 'a'])
+        self.assertEquals([key for key, name in merged],
+                          ['c', 'd', 'e', 'f', 'g'])
+        self.assertEquals(opened, ['x', 'a', 'c', 'g'])
+
+
+class TreePartitionsTest(unittest.TestCase):
+
+    def test_rpath_keys(self):
+        tree = TreePartitions(RPATH_KEYS, 'root')
+        for rpath in ('root', 'root/b', 'root/b/x', 'root/a', 'root/a/y',
+                      'other'):
+            tree[rpath] = rpath.upper()
+        self.assertEquals(tree.getPartitionName('root/b/x'), 'b')
+        self.assertEquals(tree.getPartitionName('root'), '')
+        self.assertEquals(tree['root/a/y'], 'ROOT/A/Y')
+        self.assertEquals(tree.get('root/a/z'), None)
+        self.assert_(tree.has_key('other'))
+        self.assertEquals(len(tree), 6)
+        self.assertEquals(list(tree.keys('root/b/', 'root/b/\xFF')),
+                          ['root/b/x'])
+        self.assertEquals(list(tree.keys('root/', 'root/\xFF')),
+                          ['root/a', 'root/a/y', 'root/b', 'root/b/x'])
+        del tree['root/b/x']
+        self.assertEquals(list(tree.keys('root/b', 'root/b/\xFF')),
+                          ['root/b'])
+        self.assertRaises(KeyError, tree.__delitem__, 'root/c')
+
+    def test_overlapping_partitions(self):
+        # 'root/b-c' sorts between 'root/b' and 'root/b/x'
+        tree = TreePartitions(RPATH_KEYS, 'root')
+        rpaths = ['root', 'root/b', 'root/b-c', 'root/b-c/z', 'root/b/x',
+                  'root/c']
+        for rpath in rpaths:
+            tree[rpath] = rpath
+        self.assertEquals(list(tree.keys()), rpaths)
+        self.assertEquals(list(tree.values('root/b-c')), rpaths[2:])
+        self.assertEquals([key for key, value in tree.items(max='root/b/x')],
+                          rpaths[:-1])
+
+    def test_position_keys(self):
+        tree = TreePartitions(POSITION_KEYS)
+        keys = [(), ((0, 'b'),), ((0, 'b'), (0, 'x')), ((1, 'a'),)]
+        for key in keys:
+            tree[key] = key
+        self.assertEquals(tree.getPartitionName(((1, 'a'),)), 'a')
+        # Ordered across partitions
+        self.assertEquals(list(tree.keys()), keys)
+
+    def test_position_bounds(self):
+        tree = CountingPartitions(POSITION_KEYS)
+        tree[()] = ''
+        for i in range(10):
+            key = ((i, 'c%d' % i),)
+            tree[key] = i
+            tree[key + ((0, 'x'),)] = i
+        # A moved partition keeps bounding its keys
+        del tree[((9, 'c9'),)]
+        tree[((2, 'c9'),)] = 9
+        self.assertEquals(list(tree.keys(((3, 'c3'),),
+                                         ((5, 'c5'), MAX_POSITION))),
+                          [((3, 'c3'),), ((3, 'c3'), (0, 'x')),
+                           ((4, 'c4'),), ((4, 'c4'), (0, 'x')),
+                           ((5, 'c5'),), ((5, 'c5'), (0, 'x'))])
+        # c9 still spans from its old to its new position
+        self.assertEquals(tree.opened, ['c9', 'c3', 'c4', 'c5'])
+        del tree.opened[:]
+        list(tree.keys(((0, 'c0'),), ((1, 'c1'), MAX_POSITION)))
+        self.assertEquals(tree.opened, ['c0', 'c1'])
+        del tree.opened[:]
+        self.assertEquals(list(tree.values(((2, 'c2'), MAX_POSITION),
+                                           ((2, 'c9'), MAX_POSITION))),
+                          [9])
+        self.assertEquals(tree.opened, ['c9'])
+
+    def test_shallow_positions(self):
+        # A shallow walk opens each partition once
+        cache = DummyCache()
+        cache._order = CountingPartitions(POSITION_KEYS)
+        cache.add(None, 'r')
+        for i in range(10):
+            cache.add('r', 'r/c%d' % i)
+            cache.add('r/c%d' % i, 'r/c%d/x' % i)
+        positions = TreePositions(cache)
+        positions.index('r', ())
+        self.assertEquals(len(positions.iterRpaths((), 1)), 11)
+        opened = cache._order.opened
+        self.assertEquals(len(opened), 11)
+        opened.sort()
+        self.assertEquals(opened, [''] + ['c%d' % i for i in range(10)])
+
+
+class CountingPartitions(TreePartitions):
+    """Records the partitions opened by range searches."""
+
+    def __init__(self, kind, root=''):
+        TreePartitions.__init__(self, kind, root)
+        self.opened = []
+
+    def _rangeItems(self, tree, min, max):
+        opened = self.opened
+        def items():
+            opened.append(self.getPartitionName(tree.minKey()))
+            return tree.items(min, max)
+        return items
+
+
+class DummyCache:
+
+    def __init__(self):
+        self._structure = TreePartitions(RPATH_KEYS, 'r')
+        self._order = TreePartitions(POSITION_KEYS)
+        self._positions = TreePartitions(RPATH_KEYS, 'r')
+
+    def add(self, parent, rpath):
+        if parent is None:
+            self._structure[rpath] = TreeNode(0)
+            return
+        node = self._structure[parent]
+        self._structure[rpath] = TreeNode(node.depth+1)
+        node.children = node.children + (rpath,)
+
+
+class TreePositionsTest(unittest.TestCase):
+
+    def makeCache(self):
+        cache = DummyCache()
+        cache.add(None, 'r')
+        for rpath in ('r/a', 'r/b', 'r/c'):
+            cache.add('r', rpath)
+        cache.add('r/a', 'r/a/x')
+        cache.add('r/b', 'r/b/y')
+        TreePositions(cache).index('r', ())
+        return cache
+
+    def test_index(self):
+        cache = self.makeCache()
+        positions = TreePositions(cache)
+        self.assertEquals(positions.iterRpaths((), 999),
+                          ['r', 'r/a', 'r/a/x', 'r/b', 'r/b/y', 'r/c'])
+        self.assertEquals(positions.iterRpaths((), 1),
+                          ['r', 'r/a', 'r/b', 'r/c'])
+        self.assertEquals(cache._positions['r/b/y'], ((1, 'b'), (0, 'y')))
+        self.assertEquals(positions.getChildKeys(()),
+                          [((0, 'a'),), ((1, 'b'),), ((2, 'c'),)])
+
+    def test_index_node(self):
+        cache = self.makeCache()
+        positions = TreePositions(cache)
+        positions.indexNode('r/b', ((5, 'b'),))
+        # The subtree is positioned separately
+        self.assertEquals(positions.iterRpaths((), 999),
+                          ['r', 'r/a', 'r/a/x', 'r/c', 'r/b'])
+        self.assertEquals(cache._positions.get('r/b/y'), None)
+
+    def test_iter_positions(self):
+        cache = self.makeCache()
+        positions = TreePositions(cache)
+        walked = list(positions.iterPositions((), 999))
+        self.assertEquals([rpath for key, rpath in walked],
+                          ['r', 'r/a', 'r/a/x', 'r/b', 'r/b/y', 'r/c'])
+        # Resuming after a key
+        after = cache._positions['r/a']
+        self.assertEquals([rpath for key, rpath
+                           in positions.iterPositions((), 999, after)],
+                          ['r/a/x', 'r/b', 'r/b/y', 'r/c'])
+        self.assertEquals([rpath for key, rpath
+                           in positions.iterPositions((), 1, after)],
+                          ['r/b', 'r/c'])
+        self.assertEquals([rpath for key, rpath
+                           in positions.iterPositions((), 999, walked[-1][0])],
+                          [])
+
+    def test_renumber(self):
+        cache = self.makeCache()
+        positions = TreePositions(cache)
+        node = cache._structure['r']
+        node.children = ('r/c', 'r/b')
+        positions.unindexPath('r/a')
+        positions.renumberChildren('r')
+        self.assertEquals(positions.iterRpaths((), 999),
+                          ['r', 'r/c', 'r/b', 'r/b/y'])
+        self.assertEquals(len(cache._order), 4)
+        self.assertEquals(cache._positions.get('r/a/x'), None)
+
+
+class TreeNodeConflictTest(unittest.TestCase):
+
+    def setUp(self):
+        # MappingStorage doesn't resolve conflicts
+        self.dir = tempfile.mkdtemp()
+        self.db = DB(FileStorage(os.path.join(self.dir, 'Data.fs')))
+        conn = self.db.open()
+        conn.root()['node'] = TreeNode(0, ('a',))
+        transaction.commit()
+        conn.close()
+
+    def tearDown(self):
+        transaction.abort()
+        self.db.close()
+        shutil.rmtree(self.dir)
+
+    def change(self, children):
+        tm = transaction.TransactionManager()
+        conn = self.db.open(transaction_manager=tm)
+        conn.root()['node'].children = children
+        return tm, conn
+
+    def test_merged(self):
+        tm1, conn1 = self.change(('a', 'x'))
+        tm2, conn2 = self.change(('a', 'y'))
+        tm1.commit()
+        tm2.commit()
+        conn1.close()
+        conn2.close()
+        conn = self.db.open()
+        self.assertEquals(conn.root()['node'].children, ('a', 'x', 'y'))
+        conn.close()
+
+    def test_conflict(self):
+        tm1, conn1 = self.change(('x',))
+        tm2, conn2 = self.change(())
+        conn2.root()['node'].depth = 3
+        tm1.commit()
+        self.assertRaises(ConflictError, tm2.commit)
+        tm2.abort()
+        conn1.close()
+        conn2.close()
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(MergeChildrenTest),
+        unittest.makeSuite(TreePartitionsTest),
+        unittest.makeSuite(TreePositionsTest),
+        unittest.makeSuite(TreeNodeConflictTest),
+        ))
+
+if __name__ == '__main__':
+    unittest.TextTestRunner().run(test_suite())
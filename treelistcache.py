@@ -0,0 +1,152 @@
+# -*- coding: iso-8859-15 -*-
+# (C) Copyright 2012 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Process wide memo of TreeCache.getList results.
+
+Navigation portlets ask the same tree caches for the same listings over
+and over, while the caches only change when the TreeCacheManager replays
+modifications. Results are memoized in a bounded least recently used
+cache shared by all threads, keyed by the path and version of the tree
+cache, the arguments of getList and the principals of the user (see
+TreeCache.getList).
+
+Stored results are tuples of mappings that are never handed out
+directly: callers get a new list of copies of the mappings, their
+mutable values (such as the local roles) being copied as well.
+"""
+
+import threading
+from copy import deepcopy
+
+# Maximum number of results kept
+DEFAULT_MAX_SIZE = 1000
+
+# Slots of the nodes of the linked list
+PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
+
+
+def copy_info(info):
+    """Copy an entry of a result and its mutable values."""
+    res = info.copy()
+    for key, value in info.iteritems():
+        if isinstance(value, (dict, list)):
+            res[key] = deepcopy(value)
+    return res
+
+
+class TreeListCache(object):
+    """Thread safe LRU cache of getList results."""
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Forget all results and statistics."""
+        self._lock.acquire()
+        try:
+            self._data = {} # key -> node
+            # Circular doubly linked list, most recently used first
+            root = []
+            root[:] = [root, root, None, None]
+            self._root = root
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """Get copies of the result stored for key, or None."""
+        self._lock.acquire()
+        try:
+            node = self._data.get(key)
+            if node is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            # Move it first
+            root = self._root
+            node[PREV][NEXT] = node[NEXT]
+            node[NEXT][PREV] = node[PREV]
+            first = root[NEXT]
+            node[PREV] = root
+            node[NEXT] = first
+            first[PREV] = root[NEXT] = node
+            res = node[VALUE]
+        finally:
+            self._lock.release()
+        return [copy_info(info) for info in res]
+
+    def set(self, key, res):
+        """Store a copy of a result, evicting the least recently used."""
+        value = tuple([copy_info(info) for info in res])
+        self._lock.acquire()
+        try:
+            data = self._data
+            root = self._root
+            node = data.get(key)
+            if node is not None:
+                node[VALUE] = value
+                return
+            if len(data) >= self.max_size:
+                last = root[PREV]
+                if last is root:
+                    # max_size is 0
+                    return
+                last[PREV][NEXT] = root
+                root[PREV] = last[PREV]
+                del data[last[KEY]]
+                self.evictions += 1
+            first = root[NEXT]
+            node = [root, first, key, value]
+            first[PREV] = root[NEXT] = node
+            data[key] = node
+        finally:
+            self._lock.release()
+
+    def getStatistics(self):
+        """Return a mapping of the hits, misses, evictions and size."""
+        self._lock.acquire()
+        try:
+            lookups = self.hits + self.misses
+            if lookups:
+                ratio = float(self.hits) / lookups
+            else:
+                ratio = 0.0
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': ratio,
+                'evictions': self.evictions,
+                'size': len(self._data),
+                'max_size': self.max_size,
+                }
+        finally:
+            self._lock.release()
+
+
+_list_cache = TreeListCache()
+
+def get_tree_list_cache():
+    """Return the process wide cache of getList results."""
+    return _list_cache
@@ -0,0 +1,502 @@
+# -*- coding: iso-8859-15 -*-
+# (C) Copyright 2012 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Storage of the tree caches.
+
+A TreeCache keeps its data in mappings partitioned per top-level subtree
+of its root (TreePartitions), so that transactions replaying
+modifications in different subtrees don't write the same BTrees:
+
+- _infos: rpath -> info dict of the node,
+
+- _structure: rpath -> TreeNode (depth and children of the node),
+
+- _positions: rpath -> position key, and _order: position key -> rpath,
+  the preorder positions of the nodes (see TreePositions).
+
+The children of a node are in their own persistent TreeNode, which
+merges concurrent additions and removals of distinct children instead of
+raising a ConflictError.
+"""
+
+import sys
+from heapq import heappush, heapreplace, heappop
+
+from Persistence import Persistent
+from BTrees.OOBTree import OOBTree
+from ZODB.POSException import ConflictError
+
+# Greater than any element of a position key, used to bound the keys of
+# a subtree
+MAX_POSITION = (sys.maxint,)
+
+# Less than any element of a position key, used to start after a key
+MIN_POSITION = (-1,)
+
+# Kinds of keys of TreePartitions
+RPATH_KEYS = 'rpath'
+POSITION_KEYS = 'position'
+
+
+def merge_children(old, committed, new):
+    """Merge two concurrent changes of a children list.
+
+    Children added or removed by new are added to or removed from
+    committed. Additions are placed after their nearest predecessor in
+    new that is still there, after the children committed added there. Raises ValueError if
+    either change reordered the children.
+    """
+    old_set = dict.fromkeys(old)
+    for children in (committed, new):
+        children_set = dict.fromkeys(children)
+        kept = [child for child in children if child in old_set]
+        if kept != [child for child in old if child in children_set]:
+            raise ValueError("Children reordered")
+    new_set = dict.fromkeys(new)
+    committed_set = dict.fromkeys(committed)
+    res = [child for child in committed
+           if child in new_set or child not in old_set]
+    res_set = dict.fromkeys(res)
+    previous = None
+    for child in new:
+        if child not in res_set and child not in old_set:
+            if previous is None:
+                i = 0
+            else:
+                i = res.index(previous) + 1
+            # Skip the children added there by committed
+            while (i < len(res) and res[i] in committed_set
+                   and res[i] not in old_set):
+                i += 1
+            res.insert(i, child)
+            res_set[child] = None
+        if child in res_set:
+            # Children removed by committed don't anchor the additions
+            previous = child
+    return tuple(res)
+
+
+def merge_items(sources):
+    """Merge sources of sorted items, yielding them sorted by key.
+
+    sources is a list of (bound, items) sorted by bound, where bound is
+    less than or equal to the keys of the source, or None if unknown,
+    and items a callable returning an iterator over the items. A source
+    is only opened once the merge reaches its bound. Keys have to be
+    distinct.
+    """
+    sources = list(sources)
+    sources.reverse()
+    heap = []
+    while True:
+        # Open the sources that can have keys before the next one
+        while sources and (not heap or sources[-1][0] is None
+                           or sources[-1][0] <= heap[0][0]):
+            items = iter(sources.pop()[1]())
+            for item in items:
+                heappush(heap, (item[0], item, items))
+                break
+        if not heap:
+            break
+        key, item, items = heap[0]
+        yield item
+        for item in items:
+            heapreplace(heap, (item[0], item, items))
+            break
+        else:
+            heappop(heap)
+
+
+class TreeNode(Persistent):
+    """Structure of a node of a tree cache: depth and children rpaths.
+
+    Being a separate persistent object, changing the children of a node
+    only writes this small record, and concurrent changes adding or
+    removing distinct children are merged (see merge_children).
+    """
+
+    def __init__(self, depth, children=()):
+        self.depth = depth
+        self.children = tuple(children)
+
+    def _p_resolveConflict(self, old, committed, new):
+        if not (old['depth'] == committed['depth'] == new['depth']):
+            raise ConflictError
+        try:
+            children = merge_children(old['children'],
+                                      committed['children'],
+                                      new['children'])
+        except ValueError:
+            raise ConflictError
+        res = committed.copy()
+        res['children'] = children
+        return res
+
+    def __repr__(self):
+        return '<TreeNode %r %r>' % (self.depth, self.children)
+
+
+class TreePartitions(Persistent):
+    """Mapping split in one OOBTree per top-level subtree.
+
+    Keys are rpaths (RPATH_KEYS), the partition being the first element
+    after the root, or position keys (POSITION_KEYS), the partition being
+    the id of the first element. The root itself and what's outside of
+    the root are in the '' partition.
+
+    Lookups and changes touch only one partition. Range searches that
+    span several partitions merge them, as their ranges of keys can
+    overlap (for rpaths when an id is a prefix of the id of a sibling):
+    results are always in key order. Partitions are bounded without
+    being loaded: for rpaths by their name, for position keys by the
+    lowest and highest first elements set in them (which only grow, so
+    that concurrent changes can't make them too narrow). They are only
+    loaded once the search reaches them, and the ones outside of the
+    range are skipped.
+    """
+
+    # For position keys: name -> (lowest, highest) first element of the
+    # keys set in the partition. Partitions missing there are unbounded
+    _bounds = None
+
+    def __init__(self, kind, root=''):
+        self.kind = kind
+        self.prefix = root + '/'
+        self._partitions = OOBTree() # name -> OOBTree
+        if kind == POSITION_KEYS:
+            self._bounds = OOBTree()
+
+    def getPartitionName(self, key):
+        """Get the name of the partition of a key, or None for bounds."""
+        if self.kind == POSITION_KEYS:
+            if not key:
+                return ''
+            first = key[0]
+            if len(first) < 2:
+                return None
+            return first[1]
+        prefix = self.prefix
+        if not key.startswith(prefix):
+            return ''
+        rest = key[len(prefix):]
+        i = rest.find('/')
+        if i >= 0:
+            rest = rest[:i]
+        return rest
+
+    def _getPartition(self, key):
+        return self._partitions.get(self.getPartitionName(key))
+
+    def get(self, key, default=None):
+        tree = self._getPartition(key)
+        if tree is None:
+            return default
+        return tree.get(key, default)
+
+    def __getitem__(self, key):
+        tree = self._getPartition(key)
+        if tree is None:
+            raise KeyError(key)
+        return tree[key]
+
+    def has_key(self, key):
+        tree = self._getPartition(key)
+        return tree is not None and tree.has_key(key)
+
+    __contains__ = has_key
+
+    def __setitem__(self, key, value):
+        name = self.getPartitionName(key)
+        tree = self._partitions.get(name)
+        if self.kind == POSITION_KEYS and name:
+            self._extendBounds(name, key[0], tree is None)
+        if tree is None:
+            tree = self._partitions[name] = OOBTree()
+        tree[key] = value
+
+    def _extendBounds(self, name, first, new):
+        """Make the bounds of a position partition include first.
+
+        Bounds are only started for new partitions, the keys of existing
+        ones being unknown.
+        """
+        bounds = self._bounds
+        if bounds is None:
+            if not new:
+                return
+            bounds = self._bounds = OOBTree()
+        current = bounds.get(name)
+        if current is None:
+            if new:
+                bounds[name] = (first, first)
+            return
+        low, high = current
+        if first < low:
+            bounds[name] = (first, high)
+        elif first > high:
+            bounds[name] = (low, first)
+
+    def __delitem__(self, key):
+        tree = self._getPartition(key)
+        if tree is None:
+            raise KeyError(key)
+        del tree[key]
+
+    def _getRangePartitionName(self, min, max):
+        """Get the partition holding all the keys between min and max.
+
+        None if they can be in several partitions.
+        """
+        if min is None or max is None:
+            return None
+        if self.kind == POSITION_KEYS:
+            # Keys in between have the same first element
+            if not min or not max or min[0] != max[0] or len(min[0]) < 2:
+                return None
+            return min[0][1]
+        name = self.getPartitionName(min)
+        if not name:
+            return None
+        # Keys in between are under the same top-level node
+        top = self.prefix + name + '/'
+        if not (min.startswith(top) and max.startswith(top)):
+            return None
+        return name
+
+    def _getSources(self, min, max):
+        """Get the partitions where keys between min and max can be.
+
+        Returns a list of (bound, items) sorted by bound, as expected by
+        merge_items.
+        """
+        sources = []
+        prefix = self.prefix
+        bounds = self._bounds
+        for name, tree in self._partitions.items():
+            if not name:
+                if self.kind == POSITION_KEYS:
+                    # Only the key of the root, ()
+                    if min is not None and min > ():
+                        continue
+                    low = ()
+                else:
+                    low = None
+            elif self.kind == RPATH_KEYS:
+                # Keys are prefix+name or start with prefix+name+'/'
+                low = prefix + name
+                if max is not None and low > max:
+                    continue
+                if min is not None and low + '0' <= min:
+                    continue
+            elif bounds is not None and bounds.has_key(name):
+                # Keys start with a first element between the bounds
+                first, last = bounds[name]
+                low = (first,)
+                if max is not None and low > max:
+                    continue
+                if min is not None and (last, MAX_POSITION) <= min:
+                    continue
+            else:
+                low = None
+            sources.append((low, self._rangeItems(tree, min, max)))
+        sources.sort(key=lambda source: source[0])
+        return sources
+
+    def _rangeItems(self, tree, min, max):
+        return lambda: tree.items(min, max)
+
+    def _getRangeTree(self, min, max):
+        """Get the only partition where keys between min and max can be.
+
+        None if they can be in several partitions.
+        """
+        name = self._getRangePartitionName(min, max)
+        if name is None:
+            return None
+        tree = self._partitions.get(name)
+        if tree is None:
+            tree = OOBTree()
+        return tree
+
+    def items(self, min=None, max=None):
+        tree = self._getRangeTree(min, max)
+        if tree is not None:
+            return tree.items(min, max)
+        return merge_items(self._getSources(min, max))
+
+    def keys(self, min=None, max=None):
+        tree = self._getRangeTree(min, max)
+        if tree is not None:
+            return tree.keys(min, max)
+        return (key for key, value in self.items(min, max))
+
+    def values(self, min=None, max=None):
+        tree = self._getRangeTree(min, max)
+        if tree is not None:
+            return tree.values(min, max)
+        return (value for key, value in self.items(min, max))
+
+    def __len__(self):
+        res = 0
+        for tree in self._partitions.values():
+            res += len(tree)
+        return res
+
+
+def child_key(key, i, rpath):
+    """Get the position key of the i-th child of the node at key."""
+    return key + ((i, rpath[rpath.rfind('/')+1:]),)
+
+
+class TreePositions(object):
+    """Preorder positions of the nodes of a cache.
+
+    The position key of the root is (), the key of the i-th child of a
+    node is the key of the node + ((i, id of the child),). Sorting the
+    keys gives the nodes in depth first order, the keys of a subtree
+    being the ones between the key of its top node and that key +
+    (MAX_POSITION,). With the ids in the keys, transactions adding
+    distinct children to a node don't write the same keys.
+
+    The cache keeps them in _order (key -> rpath) and _positions
+    (rpath -> key). Only the nodes reachable from the root by their
+    children lists have a position.
+    """
+
+    def __init__(self, cache):
+        self.structure = getattr(cache, '_structure', None)
+        self.order = getattr(cache, '_order', None)
+        self.positions = getattr(cache, '_positions', None)
+
+    def index(self, rpath, key):
+        """Set the positions of a node and its subtree."""
+        structure = self.structure
+        order = self.order
+        positions = self.positions
+        stack = [(rpath, key)]
+        while stack:
+            rpath, key = stack.pop()
+            node = structure.get(rpath)
+            if node is None:
+                # Inconsistent tree
+                continue
+            order[key] = rpath
+            positions[rpath] = key
+            i = 0
+            for child in node.children:
+                stack.append((child, child_key(key, i, child)))
+                i += 1
+
+    def indexNode(self, rpath, key):
+        """Set the position of a node, but not of its subtree."""
+        self.unindexPath(rpath)
+        self.order[key] = rpath
+        self.positions[rpath] = key
+
+    def unindex(self, key):
+        """Remove the positions of the subtree at key."""
+        order = self.order
+        positions = self.positions
+        for subkey, rpath in list(order.items(key, key + (MAX_POSITION,))):
+            del order[subkey]
+            if positions.get(rpath) == subkey:
+                del positions[rpath]
+
+    def unindexPath(self, rpath):
+        """Remove the positions of the subtree at rpath."""
+        key = self.positions.get(rpath)
+        if key is not None:
+            self.unindex(key)
+
+    def getChildKeys(self, key):
+        """Get the keys of the children of the node at key, in order."""
+        order = self.order
+        res = []
+        size = len(key) + 1
+        min = key + ((0,),)
+        max = key + (MAX_POSITION,)
+        while min is not None:
+            start = min
+            min = None
+            for subkey in order.keys(start, max):
+                subkey = subkey[:size]
+                res.append(subkey)
+                min = subkey + (MAX_POSITION,)
+                break
+        return res
+
+    def renumberChildren(self, rpath):
+        """Update the positions after a change of a children list.
+
+        Only the children whose position changed are renumbered, with
+        their subtree.
+        """
+        key = self.positions.get(rpath)
+        node = self.structure.get(rpath)
+        if key is None or node is None:
+            # Not reachable from the root (yet)
+            return
+        order = self.order
+        expected = {}
+        i = 0
+        for child in node.children:
+            expected[child] = child_key(key, i, child)
+            i += 1
+        # Positions of children that moved or left
+        for subkey in self.getChildKeys(key):
+            if expected.get(order.get(subkey)) != subkey:
+                self.unindex(subkey)
+        for child in node.children:
+            subkey = expected[child]
+            if order.get(subkey) != child:
+                self.unindexPath(child)
+                self.index(child, subkey)
+
+    def iterPositions(self, key, stop_depth, after=None):
+        """Iterate over the (key, rpath) of the subtree at key, in order.
+
+        Subtrees deeper than stop_depth (a depth relative to the root)
+        are skipped. If after is given, starts after that key of the
+        subtree, as if the walk had stopped there.
+        """
+        order = self.order
+        max = key + (MAX_POSITION,)
+        if after is None:
+            min = key
+        elif len(after) >= stop_depth:
+            min = after + (MAX_POSITION,)
+        else:
+            min = after + (MIN_POSITION,)
+        while min is not None:
+            start = min
+            min = None
+            for subkey, rpath in order.items(start, max):
+                yield subkey, rpath
+                if len(subkey) >= stop_depth:
+                    # Skip the subtree
+                    min = subkey + (MAX_POSITION,)
+                    break
+
+    def iterRpaths(self, key, stop_depth):
+        """Return the rpaths of the subtree at key, in order.
+
+        Subtrees deeper than stop_depth (a depth relative to the root)
+        are skipped.
+        """
+        positions = self.iterPositions(key, stop_depth)
+        return [rpath for subkey, rpath in positions]
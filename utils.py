@@ -160,6 +160,16 @@ def getAllowedRolesAndUsersOfObject(ob):
         del allowed['Owner']
     return allowed.keys()
 
+def hasDefaultAllowedRolesAndUsers(ob):
+    """Tell if getAllowedRolesAndUsersOfObject uses its default implementation.
+
+    Code deriving the roles and users that can View an object from its
+    parent's relies on it.
+    """
+    aclu = getattr(ob, 'acl_users', None)
+    return not (bhasattr(aclu, 'getAllowedRolesAndUsersOfObject') or
+                bhasattr(aclu, '_allowedRolesAndUsers'))
+
 #
 # Patch CMFCore.utils for generic mergedLocalRoles
 #